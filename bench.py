@@ -0,0 +1,330 @@
+# offline benchmarks of a voting node. an election is run on in-process nodes and every stage of it is
+# timed: voter enrolment, vote ingestion, block sealing, chain validation, syncing follower nodes from a
+# localhost peer and tally queries. results are written as JSON and can be compared against an earlier run:
+#
+#   python bench.py --voters 500 --nodes 4 --output before.json
+#   python bench.py --voters 500 --nodes 4 --compare before.json
+#   python bench.py --compare before.json --input after.json
+#
+# the comparison exits with status 1 when a latency, throughput or memory figure got worse by more than
+# the threshold.
+import argparse
+import contextlib
+import gc
+import json
+import logging
+import os
+import platform
+import sys
+import tempfile
+import threading
+import tracemalloc
+from time import perf_counter
+
+from werkzeug.serving import make_server
+
+import main
+from blockchain import BlockChain, Transaction
+from keypool import KeyPool, wallet_address
+from metrics import percentile
+from storage import BlockStore
+from Crypto.PublicKey import RSA
+
+SCENARIOS = ('enrollment', 'ingestion', 'sealing', 'validation', 'sync', 'tally')
+RESULT_VERSION = 1
+
+# figures where a higher value is a regression, the rest are throughputs where a lower one is
+LATENCIES = ('p50_ms', 'p95_ms', 'p99_ms', 'peak_memory_bytes')
+
+
+class Measurement(object):
+    """ Latencies of the operations of one scenario and the peak memory allocated while it ran """
+
+    def __init__(self, trace_memory=True):
+        self.trace_memory = trace_memory
+        self.latencies = []
+        self.elapsed = 0
+        self.peak_memory = None
+
+    def __enter__(self):
+        gc.collect()
+        if self.trace_memory:
+            tracemalloc.start()
+        self.started = perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.elapsed = perf_counter() - self.started
+        if self.trace_memory:
+            self.peak_memory = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+    def time(self, function, *args):
+        start = perf_counter()
+        result = function(*args)
+        self.latencies.append(perf_counter() - start)
+        return result
+
+    def summary(self, **extra):
+        latencies = sorted(self.latencies)
+        summary = {
+            'count': len(latencies),
+            'seconds': self.elapsed,
+            # operations per second of wall time, setup between the timed calls included
+            'throughput': len(latencies) / self.elapsed if self.elapsed else None,
+            'mean_ms': 1000 * sum(latencies) / len(latencies) if latencies else None,
+            'p50_ms': None,
+            'p95_ms': None,
+            'p99_ms': None,
+            'max_ms': 1000 * latencies[-1] if latencies else None,
+            'peak_memory_bytes': self.peak_memory,
+        }
+        for name, fraction in (('p50_ms', 0.5), ('p95_ms', 0.95), ('p99_ms', 0.99)):
+            if latencies:
+                summary[name] = 1000 * percentile(latencies, fraction)
+        summary.update(extra)
+        return summary
+
+
+class Benchmark(object):
+    """ Runs an election on in-process nodes and times every stage of it """
+
+    def __init__(self, voters=200, candidates=3, nodes=3, block_size=50, key_bits=2048, tally_queries=1000,
+                 store=False, trace_memory=True, scenarios=SCENARIOS):
+        self.voters = voters
+        self.candidates = candidates
+        # the node running the election plus nodes - 1 followers syncing from it
+        self.nodes = nodes
+        self.block_size = block_size
+        self.key_bits = key_bits
+        self.tally_queries = tally_queries
+        self.store = store
+        self.trace_memory = trace_memory
+        self.scenarios = scenarios
+        self.results = {}
+        self.stores = []
+
+    def config(self):
+        return {
+            'voters': self.voters,
+            'candidates': self.candidates,
+            'nodes': self.nodes,
+            'block_size': self.block_size,
+            'key_bits': self.key_bits,
+            'tally_queries': self.tally_queries,
+            'store': self.store,
+            'trace_memory': self.trace_memory,
+            'scenarios': list(self.scenarios),
+        }
+
+    def measure(self):
+        return Measurement(self.trace_memory)
+
+    def node(self, name, nodes=None):
+        # every node keeps its admin key, and its chain with --store, in the working directory
+        store = None
+        if self.store:
+            store = BlockStore(os.path.join(self.directory, name))
+            self.stores.append(store)
+        return BlockChain(nodes if nodes is not None else set(), block_size=self.block_size, store=store,
+                          key_pool=KeyPool(bits=self.key_bits),
+                          admin_key_file=os.path.join(self.directory, f'{name}.pem'))
+
+    def admin_sign(self, data):
+        with open(os.path.join(self.directory, 'election.pem')) as f:
+            return Transaction.sign_data(data.encode('utf-8'), RSA.import_key(f.read()))
+
+    def run(self):
+        with tempfile.TemporaryDirectory() as self.directory:
+            self.election = self.node('election')
+            candidates = [self.election.new_candidate(f'Candidate {number}', self.admin_sign(f'Candidate {number}'))
+                          for number in range(1, self.candidates + 1)]
+            self.election.producer.flush()
+
+            credentials = self.enrollment()
+            self.ingestion(credentials, candidates)
+            if 'sealing' in self.scenarios:
+                self.sealing()
+            if 'validation' in self.scenarios:
+                self.validation()
+            if 'sync' in self.scenarios and self.nodes > 1:
+                self.sync()
+            if 'tally' in self.scenarios:
+                self.tally()
+            for store in self.stores:
+                store.close()
+        return {
+            'version': RESULT_VERSION,
+            'config': self.config(),
+            'environment': {
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'cpus': os.cpu_count(),
+            },
+            'scenarios': self.results,
+        }
+
+    def enrollment(self):
+        # voters are always enrolled since the other scenarios need them, only timed when asked for
+        with self.measure() as measurement:
+            credentials = [measurement.time(self.election.new_voter) for _ in range(self.voters)]
+            self.election.producer.flush()
+        if 'enrollment' in self.scenarios:
+            self.results['enrollment'] = measurement.summary()
+        return credentials
+
+    def ingestion(self, credentials, candidates):
+        # votes are signed up front, only their way into the chain is timed
+        votes = []
+        for position, (private_key, _, wallet) in enumerate(credentials):
+            transaction = Transaction(wallet, candidates[position % len(candidates)])
+            transaction.sign(private_key)
+            votes.append(transaction)
+        self.election.start_voting(self.admin_sign('StartVote'), 'StartVote')
+
+        with self.measure() as measurement:
+            for transaction in votes:
+                measurement.time(self.election.new_transaction, transaction)
+            self.election.producer.flush()
+        if 'ingestion' in self.scenarios:
+            self.results['ingestion'] = measurement.summary()
+
+    def sealing(self):
+        # blocks of block_size votes sealed on a separate node, the votes come from made up wallets
+        # so that nothing but hashing, encoding, storing and indexing the block is timed
+        node = self.node('sealing')
+        blocks = max(1, self.voters // self.block_size)
+        with self.measure() as measurement:
+            for number in range(blocks):
+                node.current_transactions = [{
+                    'sender': wallet_address(f'voter {number} {position}'.encode()),
+                    'receiver': wallet_address(f'candidate {position % self.candidates}'.encode()),
+                } for position in range(self.block_size)]
+                measurement.time(node.mine)
+        self.results['sealing'] = measurement.summary(votes_per_block=self.block_size)
+
+    def validation(self):
+        # every block after the genesis block checked on its own: hash, link and merkle root
+        chain = self.election.full_chain()
+        with self.measure() as measurement:
+            for previous, block in zip(chain, chain[1:]):
+                if not measurement.time(self.election.valid_suffix, [block], previous['hash']):
+                    raise AssertionError(f'block {block["index"]} does not validate')
+        self.results['validation'] = measurement.summary()
+
+    def sync(self):
+        # followers join one after another and download the election node's chain over localhost
+        main.blockchain = self.election
+        logging.getLogger('werkzeug').setLevel(logging.ERROR)
+        server = make_server('localhost', 0, main.app, threaded=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        address = f'localhost:{server.server_port}'
+        received = []
+        try:
+            with self.measure() as measurement:
+                for number in range(1, self.nodes):
+                    follower = measurement.time(self.node, f'follower{number}', {address})
+                    if follower.chain_head() != self.election.chain_head():
+                        raise AssertionError(f'follower {number} did not catch up')
+                    received.append(follower.peers.status()[address]['received'])
+        finally:
+            server.shutdown()
+        self.results['sync'] = measurement.summary(blocks=len(self.election.chain),
+                                                   bytes_per_node=sum(received) // len(received))
+
+    def tally(self):
+        main.blockchain = self.election
+        client = main.app.test_client()
+        with self.measure() as measurement:
+            for _ in range(self.tally_queries):
+                response = measurement.time(client.get, '/candidate/results')
+                if response.status_code != 200:
+                    raise AssertionError(f'tally query failed with status {response.status_code}')
+        self.results['tally'] = measurement.summary()
+
+
+def compare(baseline, current, threshold=0.1):
+    # returns (scenario, figure, baseline value, current value) for every figure that regressed by more
+    # than threshold. latencies and memory regress upwards, throughput downwards
+    regressions = []
+    for scenario, figures in current['scenarios'].items():
+        before = baseline['scenarios'].get(scenario)
+        if before is None:
+            continue
+        for figure in LATENCIES + ('throughput',):
+            old, new = before.get(figure), figures.get(figure)
+            if not old or new is None:
+                continue
+            change = (new - old) / old
+            if change > threshold if figure in LATENCIES else change < -threshold:
+                regressions.append((scenario, figure, old, new))
+    return regressions
+
+
+def report(baseline, current, regressions, out=sys.stderr):
+    if baseline['config'] != current['config']:
+        print('warning: the runs were made with different settings', file=out)
+    for scenario, figures in current['scenarios'].items():
+        before = baseline['scenarios'].get(scenario, {})
+        for figure in LATENCIES + ('throughput',):
+            old, new = before.get(figure), figures.get(figure)
+            if not old or new is None:
+                continue
+            flag = ' REGRESSION' if (scenario, figure, old, new) in regressions else ''
+            print(f'{scenario:<12}{figure:<20}{old:>14.3f}{new:>14.3f}{100 * (new - old) / old:>+9.1f}%{flag}', file=out)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark a voting node offline.')
+    parser.add_argument('--voters', type=int, default=200)
+    parser.add_argument('--candidates', type=int, default=3)
+    parser.add_argument('--nodes', type=int, default=3, help='the election node plus followers that sync from it')
+    parser.add_argument('--block-size', type=int, default=50)
+    parser.add_argument('--key-bits', type=int, default=2048)
+    parser.add_argument('--tally-queries', type=int, default=1000)
+    parser.add_argument('--store', action='store_true', help='keep the chains in block stores on disk')
+    parser.add_argument('--no-memory', action='store_true', help='skip tracemalloc, it slows everything down')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS),
+                        help='comma separated subset of ' + ', '.join(SCENARIOS))
+    parser.add_argument('--output', help='write the results here instead of stdout')
+    parser.add_argument('--compare', metavar='BASELINE', help='results of an earlier run to compare against')
+    parser.add_argument('--input', help='compare these results instead of running the benchmark')
+    parser.add_argument('--threshold', type=float, default=0.1, help='relative change counted as a regression')
+    args = parser.parse_args(argv)
+
+    args.scenarios = tuple(name for name in args.scenarios.split(',') if name)
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f'unknown scenarios: {", ".join(sorted(unknown))}')
+    return args
+
+
+def run(argv=None):
+    args = parse_args(argv)
+
+    if args.input:
+        with open(args.input) as f:
+            results = json.load(f)
+    else:
+        # the nodes print as they go, stdout is kept for the results
+        with contextlib.redirect_stdout(sys.stderr):
+            results = Benchmark(args.voters, args.candidates, args.nodes, args.block_size, args.key_bits,
+                                args.tally_queries, args.store, not args.no_memory, args.scenarios).run()
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(results, f, indent=2)
+        else:
+            json.dump(results, sys.stdout, indent=2)
+            print()
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(baseline, results, args.threshold)
+        report(baseline, results, regressions)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(run())
@@ -1,60 +1,193 @@
 from transaction import *
+from registry import Registry
+from producer import BlockProducer
+from peers import PeerPool
+from verifier import SignatureVerifier
+from storage import BlockStore, BlockStoreView
+from keypool import KeyPool
+from encoding import decode_block, encode_block, header_hash, read_records, write_record
+from merkle import block_leaves, block_root, merkle_proof
+from metrics import Metrics, timed
+from ingest import IngestQueue
+from snapshot import Snapshot
+from forkchoice import ForkChoice
+from gossip import Gossip
+from columnar import ColumnarState
+from checkpoint import Checkpoints
+import threading
+
+
+class VotingStarted(Exception):
+    """ The vote was started while voters were still being enrolled """
 
 
 class BlockChain(object):
     """ Main BlockChain class """
 
-    def __init__(self, nodes=set()):
-        self.chain = []
+    # blocks or headers transferred per request while syncing with a node
+    SYNC_PAGE_SIZE = 500
+    SYNC_TIMEOUT = 5
+    NOTIFY_TIMEOUT = 30
+
+    def __init__(self, nodes=None, block_size=1, block_interval=None, store=None, checkpoint_interval=1000,
+                 key_pool=None, admin_key_file='private.pem', ingest_queue_size=10000, max_reorg_depth=100,
+                 columnar=False, bootstrap=True):
+        # the chain is either a plain list or a BlockStore that keeps it on disk
+        self.store = store
+        self.chain = store if store is not None else []
+        self.checkpoint_interval = checkpoint_interval
         self.current_transactions = []
         self.candidates = []
         self.voters = []
-        self.nodes = nodes
+        self.nodes = nodes if nodes is not None else set()
+        self.metrics = Metrics()
+        self.peers = PeerPool(self.nodes, timeout=self.SYNC_TIMEOUT, metrics=self.metrics)
         self.started_voting = False
         self.ended_voting = False
+        self.registry = Registry()
+        # columns of the election state behind /stats, only kept when asked for
+        if columnar:
+            self.registry.columns = ColumnarState()
+        # writers take the lock and publish a new snapshot when they are done, readers only look at the snapshot
+        self.lock = threading.RLock()
+        self.snapshot = Snapshot(self.chain, self.registry)
+        self.producer = BlockProducer(self, block_size, block_interval)
+        self.verifier = SignatureVerifier()
+        # keys for new voters and candidates, generated on demand unless a filled pool is given
+        self.key_pool = key_pool if key_pool is not None else KeyPool()
+        # where the admin key of a new chain is written
+        self.admin_key_file = admin_key_file
+        self.register_gauges()
+        # votes from /transaction/new wait here for the committer thread
+        self.ingest = IngestQueue(self, ingest_queue_size)
+        # decides which branch we follow, at most max_reorg_depth of our blocks are ever replaced
+        self.forkchoice = ForkChoice(self, max_reorg_depth)
+        # host:port the other nodes reach us at, sent along with the blocks we push to them
+        self.address = None
+        self.gossip = Gossip(self)
+        # signed states every checkpoint_interval blocks, a new node starts from the latest one when bootstrap is set
+        self.checkpoints = Checkpoints(self, checkpoint_interval, bootstrap)
+
+        # a node that was stopped while checking the history below its checkpoint carries on with it
+        if not self.checkpoints.resume() and len(self.chain) > 0:
+            self.load_state()
 
         self.resolve_conflicts()
 
         # create the genesis block
         if len(self.chain) == 0:
             private_key = RSA.generate(2048)
-            f = open('private.pem', 'wb')
+            f = open(self.admin_key_file, 'wb')
             f.write(private_key.export_key('PEM'))
             f.close()
             print("Generated key")
             public_key = private_key.publickey().export_key()
             self.admin = public_key
+            self.checkpoints.key = private_key
             self.new_block(previous_hash=1)
         else:
-            self.admin = self.chain[0]["admin"].encode()
+            # the admin key is there on the node that created the chain, which signs the checkpoints
+            self.checkpoints.load_key(self.admin_key_file)
+
+    def register_gauges(self):
+        metrics = self.metrics
+        metrics.gauge('blockchain_height', 'Blocks on the chain', function=lambda: len(self.chain))
+        metrics.gauge('blockchain_pending', 'Operations waiting for the next block', ('kind',), function=lambda: {
+            ('votes',): len(self.current_transactions),
+            ('voters',): len(self.voters),
+            ('candidates',): len(self.candidates),
+        })
+        metrics.gauge('keypool_keys', 'Keypairs in the key pool', ('state',), function=lambda: {
+            ('available',): self.key_pool.stats()['available'],
+            ('target',): self.key_pool.size,
+        })
+        metrics.counter('keypool_served_total', 'Keypairs handed out by the key pool',
+                        function=lambda: self.key_pool.stats()['served'])
+        metrics.counter('keypool_exhausted_total', 'Keypairs generated on the request path because the pool was empty',
+                        function=lambda: self.key_pool.stats()['exhausted'])
 
     @staticmethod
     def hash(block):
-        # hashes a block
-        # also make sure that the transactions are ordered otherwise we will have insonsistent hashes!
-        block_string = json.dumps(block, sort_keys=True).encode()
-        return hashlib.sha256(block_string).hexdigest()
+        # hashes the block header in its canonical binary encoding, see encoding.py.
+        # the body is covered through the merkle root and the cached 'hash' field is not hashed
+        return header_hash(block)
 
+    @timed
     def new_block(self, previous_hash=None):
         # creates a new block in the blockchain
-        block = {
-            'admin': self.admin.decode("utf-8"),
-            'index': len(self.chain) + 1,
-            'timestamp': time(),
-            'voters': self.voters,
-            'candidates': self.candidates,
-            'transactions': self.current_transactions,
-            'previous_hash': previous_hash or self.hash(self.chain[-1]),
-            'started_voting': self.started_voting,
-            'ended_voting': self.ended_voting,
-        }
-
-        # reset the current list of transactions
-        self.voters = []
-        self.candidates = []
-        self.current_transactions = []
-        self.chain.append(block)
-        return block
+        return self.seal_block(previous_hash)[0]
+
+    def seal_block(self, previous_hash=None):
+        # new_block, returning the encoded block as well so it is not encoded again for the peers
+        with self.lock:
+            block = {
+                'admin': self.admin.decode("utf-8"),
+                'index': len(self.chain) + 1,
+                'timestamp': time(),
+                'voters': self.voters,
+                'candidates': self.candidates,
+                'transactions': self.current_transactions,
+                'previous_hash': previous_hash or self.chain[-1]['hash'],
+                'started_voting': self.started_voting,
+                'ended_voting': self.ended_voting,
+            }
+
+            # the hash is computed once when the block is sealed and travels with it
+            with self.metrics.track('hash_block'):
+                block['merkle_root'] = block_root(block)
+                block['hash'] = self.hash(block)
+                encoded = encode_block(block)
+
+            # reset the current list of transactions
+            self.voters = []
+            self.candidates = []
+            self.current_transactions = []
+            self.append_block(block, encoded)
+            self.publish()
+            return block, encoded
+
+    def append_block(self, block, encoded=None):
+        if self.store is not None:
+            self.store.append(block, encoded)
+        else:
+            self.chain.append(block)
+        self.registry.apply_block(block)
+        if self.store is not None and len(self.chain) % self.checkpoint_interval == 0:
+            self.store.save_checkpoint(len(self.chain), self.registry.state())
+        self.checkpoints.block_appended()
+
+    def publish(self):
+        # the one place readers learn about changes, called by writers holding the lock
+        self.snapshot = Snapshot(self.chain, self.registry)
+
+    def load_state(self):
+        # resume from the block store: the registry comes from the latest checkpoint
+        # and only the blocks after it are replayed
+        self.admin = self.chain[0]['admin'].encode()
+        height, state = self.store.load_checkpoint()
+        if state is None:
+            self.registry.rebuild(self.chain)
+        else:
+            self.registry.load_state(state)
+            # the columns are not part of the checkpoint and are built from every block
+            # one at a time, the whole store is not decoded into a list
+            if self.registry.columns is not None:
+                for position in range(height):
+                    self.registry.columns.apply_block(self.chain[position])
+            for block in self.chain[height:]:
+                self.registry.apply_block(block)
+        self.restore_voting_flags()
+        self.publish()
+
+    def restore_voting_flags(self):
+        self.started_voting = self.last_block['started_voting']
+        self.ended_voting = self.last_block['ended_voting']
+
+    @property
+    def first_held(self):
+        # position of the first block we hold, above 0 until the blocks below the checkpoint
+        # we bootstrapped from are checked
+        return getattr(self.chain, 'start', 0)
 
     @property
     def last_block(self):
@@ -67,50 +200,126 @@ class BlockChain(object):
         data_hash = SHA256.new(data)
         pkcs1_15.new(public_key_object).verify(data_hash, signature)
 
-    def new_transaction(self, transaction: Transaction):
-        # adds a new transaction into the list of transactions
-        # these transactions go into the next mined block
-        if not self.started_voting or self.ended_voting:
-            return False, "The vote is not started or ended"
+    @timed
+    def check_transaction(self, transaction: Transaction):
+        # cheap checks done before the signature, returns the voter or an error message
+        return self.check_vote_state(transaction)
 
-        current_voter = None
+    def check_vote_state(self, transaction: Transaction):
+        # whether the election as it is now takes the vote, returns the voter or an error message
+        if not self.started_voting or self.ended_voting:
+            return None, "The vote is not started or ended"
 
-        for voter in self.get_all_voters():
-            if voter['wallet_address'] == transaction.sender_address:
-                current_voter = voter
-                break
+        current_voter = self.registry.voters.get(transaction.sender_address)
 
         if current_voter is None:
-            return False, "This kind of voter is not present"
+            return None, "This kind of voter is not present"
 
-        if current_voter['voted']:
-            return False, "This voter has already voted"
+        if self.registry.has_voted(transaction.sender_address):
+            return None, "This voter has already voted"
 
-        current_candidate = None
-        for candidate in self.get_all_candidates():
-            if candidate['wallet_address'] == transaction.receiver_address:
-                current_candidate = candidate
-                break
+        if transaction.receiver_address not in self.registry.candidates:
+            return None, "Candidate is not present in the given vote"
 
-        if current_candidate is None:
-            return False, "Candidate is not present in the given vote"
+        return current_voter, None
 
+    @staticmethod
+    def signature_bytes(transaction: Transaction):
         try:
-            signature_byte = binascii.unhexlify(transaction.signature)
+            return binascii.unhexlify(transaction.signature)
         except:
-            signature_byte = transaction.signature
-
-        self.validate_signature(voter['public_key'], signature_byte, transaction.generate_data())
-
-        self.current_transactions.append({
-            "sender": transaction.sender_address,
-            "receiver": transaction.receiver_address
-        })
-
-        self.mine()
+            return transaction.signature
+
+    def commit_transaction(self, transaction: Transaction):
+        # queues an already verified vote for the next block
+        with self.lock:
+            # checked again, the vote could have ended, the chain been replaced or another vote of
+            # the same voter been queued since the checks made before the signature
+            _, message = self.check_vote_state(transaction)
+            if message is not None:
+                return False, message
+
+            self.registry.add_pending_vote(transaction.sender_address)
+            # the signature goes into the block so other nodes can check the vote themselves
+            self.current_transactions.append({
+                "sender": transaction.sender_address,
+                "receiver": transaction.receiver_address,
+                "signature": binascii.hexlify(self.signature_bytes(transaction)).decode("utf-8"),
+            })
 
         return True, None
 
+    @timed
+    def new_transaction(self, transaction: Transaction, verified=False):
+        # adds a new transaction into the list of transactions
+        # these transactions go into the next mined block.
+        # verified votes had their signature checked by a worker process of this node already
+        current_voter, message = self.check_transaction(transaction)
+        if message is not None:
+            return False, message
+
+        if not verified:
+            with self.metrics.track('verify_signature'):
+                self.verifier.verify(current_voter['public_key'], self.signature_bytes(transaction),
+                                     transaction.generate_data())
+
+        result, message = self.commit_transaction(transaction)
+        if result:
+            self.producer.submit()
+
+        return result, message
+
+    @timed
+    def new_transactions(self, transactions, verified=None):
+        # verifies a burst of votes together, possibly on several cores,
+        # and commits the valid ones in the order they arrived.
+        # everything accepted is handed to the producer at once so the batch ends up in as few blocks
+        # (and peer notifications) as possible
+        results = self.verify_transactions(transactions, verified)
+
+        accepted = 0
+        with self.lock:
+            for position, transaction in enumerate(transactions):
+                if results[position] is None:
+                    results[position] = self.commit_transaction(transaction)
+                    accepted += results[position][0]
+
+        if accepted:
+            self.producer.submit()
+
+        return results
+
+    def verify_transactions(self, transactions, verified=None):
+        # everything new_transactions checks before committing. verified holds a flag per vote,
+        # set for the ones whose signature a worker process already checked.
+        # returns (False, message) for every rejected vote and None for the others
+        results = [None] * len(transactions)
+        to_verify = []
+        senders = set()
+
+        for position, transaction in enumerate(transactions):
+            if transaction.sender_address in senders:
+                results[position] = (False, "This voter has already voted in this batch")
+                continue
+            senders.add(transaction.sender_address)
+
+            current_voter, message = self.check_transaction(transaction)
+            if message is not None:
+                results[position] = (False, message)
+                continue
+            if verified is not None and verified[position]:
+                continue
+            to_verify.append((position, (current_voter['public_key'], self.signature_bytes(transaction),
+                                         transaction.generate_data())))
+
+        with self.metrics.track('verify_batch'):
+            valid = self.verifier.verify_batch([item for _, item in to_verify])
+        for (position, _), is_valid in zip(to_verify, valid):
+            if not is_valid:
+                results[position] = (False, "The signature is not valid")
+        return results
+
+    @timed
     def new_candidate(self, name, signature):
         if self.started_voting:
             return -1;
@@ -118,20 +327,20 @@ class BlockChain(object):
         signature_byte = binascii.unhexlify(signature)
         self.validate_signature(self.admin.decode('utf-8'), signature_byte, name.encode('utf-8'))
 
-        private_key = RSA.generate(2048)
-        public_key = private_key.publickey().export_key()
-        hash_1 = self.calculate_hash(public_key, hash_function="sha256")
-        hash_2 = self.calculate_hash(hash_1, hash_function="ripemd160")
-        wallet_address = base58.b58encode(hash_2)
+        private_key, public_key, wallet_address = self.key_pool.get()
 
-        self.candidates.append({
-            "name": name,
-            "wallet_address": wallet_address.decode('utf-8')
-        })
+        with self.lock:
+            # checked again, the vote could have been started while the key was fetched
+            if self.started_voting:
+                return -1
+            self.candidates.append({
+                "name": name,
+                "wallet_address": wallet_address
+            })
 
-        self.mine()
+        self.producer.submit()
 
-        return wallet_address.decode('utf-8')
+        return wallet_address
 
     @staticmethod
     def calculate_hash(data, hash_function: str = "sha256"):
@@ -146,41 +355,74 @@ class BlockChain(object):
             h.update(data)
             return h.hexdigest()
 
+    @timed
     def new_voter(self):
         if self.started_voting:
             return -1
 
-        private_key = RSA.generate(2048)
-        public_key = private_key.publickey().export_key()
-        hash_1 = self.calculate_hash(public_key, hash_function="sha256")
-        hash_2 = self.calculate_hash(hash_1, hash_function="ripemd160")
-        wallet_address = base58.b58encode(hash_2)
+        private_key, public_key, wallet_address = self.key_pool.get()
 
-        self.voters.append({
-            "public_key": public_key.decode("utf-8"),
-            "wallet_address": wallet_address.decode("utf-8"),
-        })
+        with self.lock:
+            if self.started_voting:
+                return -1
+            self.voters.append({
+                "public_key": public_key.decode("utf-8"),
+                "wallet_address": wallet_address,
+            })
 
-        self.mine()
+        self.producer.submit()
 
-        return private_key, public_key.decode("utf-8"), wallet_address.decode('utf-8')
+        return private_key, public_key.decode("utf-8"), wallet_address
 
+    def new_voters(self, count, block_size=100):
+        # enrolls count voters at once, keys are generated in parallel and every block_size voters
+        # are sealed into a block. credentials are yielded once their block is on the chain,
+        # so only one block worth of them is held in memory.
+        # raises VotingStarted when the vote is started part way, the voters yielded so far are enrolled
+        if self.started_voting:
+            return
+
+        enrolled = []
+        for private_key, public_key, wallet_address in self.key_pool.get_many(count):
+            enrolled.append((private_key, public_key.decode("utf-8"), wallet_address))
+            if len(enrolled) == block_size:
+                yield from self.seal_voters(enrolled)
+                enrolled = []
+
+        if enrolled:
+            yield from self.seal_voters(enrolled)
+
+    def seal_voters(self, enrolled):
+        with self.lock:
+            # once the vote is started no block may enroll voters any more
+            if self.started_voting:
+                raise VotingStarted('Vote has started, the remaining voters were not enrolled')
+            self.voters.extend({
+                "public_key": public_key,
+                "wallet_address": wallet_address,
+            } for _, public_key, wallet_address in enrolled)
+            self.producer.flush()
+        return enrolled
+
+    @timed
     def mine(self):
         # first we need to run the proof of work algorithm to calculate the new proof..
         last_block = self.last_block
 
         # forge the new block by adding it to the chain
-        previous_hash = self.hash(last_block)
-        block = self.new_block(previous_hash)
-        self.inform_of_change()
+        previous_hash = last_block['hash']
+        with self.metrics.track('new_block'):
+            block, encoded = self.seal_block(previous_hash)
+        self.inform_of_change(block, encoded)
         return block
 
     def start_voting(self, signature: str, data: str):
         if not self.ended_voting:
             signature_byte = binascii.unhexlify(signature)
             self.validate_signature(self.admin, signature_byte, data.encode('utf-8'))
-            self.started_voting = True
-            self.mine()
+            with self.lock:
+                self.started_voting = True
+                self.producer.flush()
         else:
             return False
         return True
@@ -189,8 +431,9 @@ class BlockChain(object):
         if self.started_voting:
             signature_byte = binascii.unhexlify(signature)
             self.validate_signature(self.admin, signature_byte, data.encode('utf-8'))
-            self.ended_voting = True
-            self.mine()
+            with self.lock:
+                self.ended_voting = True
+                self.producer.flush()
         else:
             return False
         return True
@@ -215,112 +458,229 @@ class BlockChain(object):
         # add a new node to the list of nodes
         parsed_url = urlparse(address)
         self.nodes.add(parsed_url.netloc)
+        self.peers.add(parsed_url.netloc)
 
     def full_chain(self):
-        # xxx returns the full chain and a number of blocks
-        pass
+        # returns the full chain as a list, whatever it is stored in
+        return list(self.snapshot.blocks())
+
+    def common_prefix(self, chain):
+        # number of leading blocks the given chain shares with ours, judged by the cached hashes.
+        # hashes are chained so once they differ they differ for the rest of the chain
+        low, high = 0, min(len(chain), len(self.chain))
+        # of a partial chain only the blocks from the checkpoint's on are compared
+        start = self.first_held
+        if start:
+            if high <= start or chain[start].get('hash') != self.chain[start]['hash']:
+                return 0
+            low = start + 1
+        while low < high:
+            middle = (low + high) // 2
+            if chain[middle].get('hash') == self.chain[middle]['hash']:
+                low = middle + 1
+            else:
+                high = middle
+        return low
 
     def valid_chain(self, chain):
-
         # determine if a given blockchain is valid
-        last_block = chain[0]
-        current_index = 1
-
-        while current_index < len(chain):
-            block = chain[current_index]
+        # the prefix we share with our own chain was verified already, only the rest is checked
+        start = self.common_prefix(chain)
+        return self.forkchoice.check_branch(start, chain[start:]) is None
+
+    @timed
+    def valid_suffix(self, blocks, last_hash, hashed=False):
+        # checks blocks that should follow the block hashed as last_hash (None for genesis).
+        # hashed means the 'hash' fields were computed here, when the blocks were decoded
+        for block in blocks:
+            block_hash = block['hash'] if hashed else self.hash(block)
+            # a block received with a hash has to carry the right one
+            if block.get('hash', block_hash) != block_hash:
+                return False
+            # the header hash only covers the body through the merkle root
+            if block_root(block) != block['merkle_root']:
+                return False
             # check that the hash of the block is correct
-            if block['previous_hash'] != self.hash(last_block):
+            if last_hash is not None and block['previous_hash'] != last_hash:
                 return False
-            # check that the proof of work is correct
-
-            last_block = block
-            current_index += 1
+            block['hash'] = block_hash
+            last_hash = block_hash
 
         return True
 
+    def chain_head(self):
+        return self.snapshot.head
+
+    def blocks_since(self, since, limit):
+        return list(self.snapshot.blocks(since, since + limit))
+
+    def block_lines(self, since, until, snapshot=None):
+        # JSON encoded blocks, one per line, for API clients
+        snapshot = snapshot or self.snapshot
+        for block in snapshot.blocks(since, until):
+            yield json.dumps(block, sort_keys=True).encode() + b'\n'
+
+    def block_records(self, since, until, snapshot=None):
+        # length prefixed binary blocks for peers, a block store hands out the stored bytes as they are
+        snapshot = snapshot or self.snapshot
+        if isinstance(snapshot.chain, BlockStoreView):
+            for position in range(max(since, 0), min(until, snapshot.height)):
+                yield snapshot.chain.raw(position)
+            return
+        for block in snapshot.blocks(since, until):
+            record = bytearray()
+            write_record(record, encode_block(block))
+            yield bytes(record)
+
+    @staticmethod
+    def block_header(block):
+        # the block without its body, its hash can be checked without the body
+        return {key: value for key, value in block.items() if key not in ('voters', 'candidates', 'transactions')}
+
+    def headers_since(self, since, limit):
+        return [self.block_header(block) for block in self.blocks_since(since, limit)]
+
+    def vote_proof(self, wallet_address):
+        # merkle inclusion proof of the vote cast by the wallet, None if it has not voted on the chain
+        snapshot = self.snapshot
+        position = snapshot.vote_position(wallet_address)
+        if position is None or position < snapshot.start:
+            return None
+        block = snapshot.chain[position]
+        leaves = block_leaves(block)
+        offset = len(block['voters']) + len(block['candidates'])
+        for number, transaction in enumerate(block['transactions']):
+            if transaction['sender'] == wallet_address:
+                leaf = offset + number
+                return {
+                    'transaction': transaction,
+                    'leaf': leaves[leaf].hex(),
+                    'leaf_index': leaf,
+                    'proof': merkle_proof(leaves, leaf),
+                    'block': self.block_header(block),
+                }
+        return None
+
+    def fetch(self, node, path, **params):
+        return self.peers.get_json(node, path, **params)
+
+    def find_fork_point(self, node, length):
+        # number of blocks we share with the node. we walk back from our tip comparing headers,
+        # starting with a single header since usually the peer simply extends our chain.
+        # nothing below a checkpoint we bootstrapped from can be replaced, the walk stops at its block,
+        # nor anything deeper than a reorg may go: the walk stops one block below, out of reach
+        floor = max(0, self.forkchoice.final - 1, len(self.chain) - self.forkchoice.max_reorg_depth - 1)
+        end = min(len(self.chain), length)
+        page = 1
+        while end > floor:
+            start = max(floor, end - page)
+            headers = self.fetch(node, '/chain/headers', since=start, limit=end - start)['headers']
+            for position in range(len(headers) - 1, -1, -1):
+                if headers[position]['hash'] == self.chain[start + position]['hash']:
+                    return start + position + 1
+            end = start
+            page = min(page * 2, self.SYNC_PAGE_SIZE)
+        return floor
+
+    def fetch_blocks(self, node, since, length):
+        # downloads the blocks from position since up to length, one page at a time,
+        # in the binary encoding. hashes are computed from the received bytes
+        blocks = []
+        while since + len(blocks) < length:
+            response = self.peers.request(node, 'GET', '/chain', params={
+                'since': since + len(blocks),
+                'limit': self.SYNC_PAGE_SIZE,
+                'format': 'binary',
+            })
+            page = [decode_block(record) for record in read_records(response.content)]
+            if not page:
+                break
+            blocks.extend(page)
+        return blocks
+
+    def known_blocks(self, node, since, length):
+        # blocks of the node's chain from position since that we kept from an earlier branch
+        if not self.forkchoice.side_blocks or since >= length:
+            return []
+        headers = self.fetch(node, '/chain/headers', since=since, limit=min(length - since, self.SYNC_PAGE_SIZE))
+        return self.forkchoice.known_blocks(headers['headers'])
+
+    @timed
+    def sync_from(self, node, length):
+        fork = self.find_fork_point(node, length)
+        # a branch forking off too far below our tip is not even downloaded
+        if not self.forkchoice.within_reach(fork):
+            self.forkchoice.rejected.inc(reason='depth')
+            return False
+        if fork == 0:
+            # nothing in common, the node's latest checkpoint saves downloading its whole chain
+            bootstrapped = self.checkpoints.bootstrap(node, length)
+            if bootstrapped is not None:
+                return bootstrapped
+        blocks = self.known_blocks(node, fork, length)
+        blocks += self.fetch_blocks(node, fork + len(blocks), length)
+        return self.forkchoice.switch(fork, blocks)
+
+    @timed
     def resolve_conflicts(self):
         # this is our Consensus Algorithm, it resolves conflicts by replacing
         # our chain with the longest one in the network.
+        # nodes are asked for their height first and only the missing blocks are downloaded
 
-        neighbours = self.nodes
-        new_chain = None
-
-        # we are only looking for the chains longer than ours
-        max_length = len(self.chain)
+        head = self.chain_head()
+        better = []
 
-        # grab and verify chains from all the nodes in our network
-        for node in neighbours:
-            try:
-                # we utilize our own api to construct the list of chains :)
-                response = requests.get(f'http://{node}/chain')
-
-                if response.status_code == 200:
-
-                    length = response.json()['length']
-                    chain = response.json()['chain']
-
-                    # check if the chain is longer and whether the chain is valid
-                    if length > max_length and self.valid_chain(chain):
-                        max_length = length
-                        new_chain = chain
-            except:
+        # all healthy nodes are asked at once
+        heads = self.peers.map(lambda node: self.fetch(node, '/chain/head'))
+        for node, peer_head in heads.items():
+            if isinstance(peer_head, Exception):
                 print(node)
+                continue
 
-        # replace our chain if we discover a new longer valid chain
-        if new_chain:
-            self.chain = new_chain
-            return True
-
-        return False
+            # we are only looking for the chains that win over ours
+            if peer_head['hash'] != head['hash'] and self.forkchoice.wins(peer_head['length'], peer_head['hash']):
+                better.append((peer_head['length'], peer_head['hash'], node))
 
-    def inform_of_change(self):
-        neighbours = self.nodes
-
-        # grab and verify chains from all the nodes in our network
-        for node in neighbours:
-            # we utilize our own api to construct the list of chains :)
+        # try the best chain first and fall back to the next one if it does not check out
+        for length, _, node in sorted(better, key=lambda item: (-item[0], item[1])):
             try:
-                response = requests.get(f'http://{node}/miner/nodes/resolve',timeout=0.05)
-            except requests.exceptions.ReadTimeout:
-                pass
+                if self.sync_from(node, length):
+                    # votes only the blocks we left held are waiting for a block again
+                    if self.producer.pending():
+                        self.producer.submit()
+                    return True
+            except (requests.exceptions.RequestException, ValueError, KeyError):
+                print(node)
 
+        return False
 
+    @timed
+    def inform_of_change(self, block, encoded=None):
+        # push the new block to the nodes without waiting for them, they pass it on to theirs
+        self.gossip.publish(block, encoded)
         return False
 
     def candidate_votes(self):
-        results = [ item['receiver'] for item in self.get_all_transactions()]
-        count = Counter(results)
-        candidates = self.get_all_candidates().copy()
-        for candidate in candidates:
-            candidate['votes'] = count.get(candidate['wallet_address']) or 0
-        return candidates
+        return self.snapshot.results
 
-    def get_all_transactions(self):
-        transactions = []
-        for block in self.chain:
-            for transaction in block['transactions']:
-                transactions.append(transaction)
+    @timed
+    def candidate_results(self):
+        # (etag, version, results) for conditional requests on the tally
+        snapshot = self.snapshot
+        return snapshot.etag, snapshot.version, snapshot.results
 
-        return transactions
+    def get_all_transactions(self):
+        return self.snapshot.all_transactions()
 
+    @timed
     def get_all_voters(self):
-        votersAll = []
-        transactions = self.get_all_transactions()
-        for block in self.chain:
-            for voter in block['voters']:
-                curVoter = voter.copy()
-                if any(elem['sender'] == voter['wallet_address'] for elem in transactions):
-                    curVoter["voted"] = True
-                else:
-                    curVoter["voted"] = False
-                votersAll.append(curVoter)
-
-        return votersAll
+        return self.snapshot.all_voters()
 
     def get_all_candidates(self):
-        candidates = []
-        for block in self.chain:
-            for candidate in block['candidates']:
-                candidates.append(candidate)
+        return self.snapshot.all_candidates()
 
-        return candidates
+    def stats(self, window=None):
+        # None when the node keeps no columnar state
+        if self.registry.columns is None:
+            return None
+        return self.registry.columns.stats(window)
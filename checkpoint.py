@@ -0,0 +1,407 @@
+import binascii
+import json
+import os
+import shutil
+import threading
+from time import sleep
+
+import requests
+from Crypto.Hash import SHA256
+from Crypto.PublicKey import RSA
+from Crypto.Signature import pkcs1_15
+
+from forkchoice import BranchView
+from registry import Registry
+from storage import BlockStore
+
+# what a signature covers, the signature itself travels next to them
+FIELDS = ('height', 'hash', 'genesis', 'state')
+
+# progress of the validation of the blocks below a checkpoint
+VALIDATING = 'validating'
+COMPLETE = 'complete'
+FAILED = 'failed'
+
+
+def checkpoint_data(checkpoint):
+    # the canonical bytes of a checkpoint that get signed, the same after a trip through JSON
+    return json.dumps({field: checkpoint[field] for field in FIELDS}, sort_keys=True, separators=(',', ':')).encode()
+
+
+def sign_checkpoint(private_key, checkpoint):
+    signature = pkcs1_15.new(private_key).sign(SHA256.new(checkpoint_data(checkpoint)))
+    return dict(checkpoint, signature=binascii.hexlify(signature).decode('utf-8'))
+
+
+def verify_checkpoint(admin, checkpoint):
+    # True when the checkpoint carries a valid signature of the admin key, PEM as on the genesis block
+    try:
+        pkcs1_15.new(RSA.import_key(admin)).verify(SHA256.new(checkpoint_data(checkpoint)),
+                                                   binascii.unhexlify(checkpoint['signature']))
+    except (ValueError, TypeError, KeyError, binascii.Error):
+        return False
+    return True
+
+
+def same_state(state, other):
+    # registry states are equal up to the order of the voted list, which comes from a set
+    return dict(state, voted=sorted(state['voted'])) == dict(other, voted=sorted(other['voted']))
+
+
+class PartialChain(object):
+    """ The chain of a node that bootstrapped from a checkpoint, holding the blocks from position start on
+
+    it stands in for the chain list: the length is that of the whole chain and positions below start
+    raise IndexError until the blocks under the checkpoint have been checked and put in place.
+    a slice from the beginning gives the chain cut short, any other slice a list of blocks.
+    the blocks are a list, or a BlockStore on a node that keeps its chain on disk.
+    """
+
+    def __init__(self, start, blocks):
+        self.start = start
+        self.blocks = blocks
+
+    def __len__(self):
+        return self.start + len(self.blocks)
+
+    def __iter__(self):
+        # only the blocks held
+        return iter(self.blocks)
+
+    def __getitem__(self, position):
+        if isinstance(position, slice):
+            if position.step is not None:
+                raise TypeError('the chain cannot be sliced with a step')
+            stop = len(self) if position.stop is None else min(position.stop, len(self))
+            if not position.start:
+                if isinstance(self.blocks, BlockStore):
+                    # cut in place, snapshots read the store through their views
+                    del self.blocks[max(0, stop - self.start):]
+                    return PartialChain(self.start, self.blocks)
+                return PartialChain(self.start, self.blocks[:max(0, stop - self.start)])
+            if position.start < self.start:
+                raise IndexError('blocks below the checkpoint are not held yet')
+            return self.blocks[position.start - self.start:stop - self.start]
+        if position < 0:
+            position += len(self)
+        if not self.start <= position < len(self):
+            raise IndexError('block index out of range or below the checkpoint')
+        return self.blocks[position - self.start]
+
+    def append(self, block):
+        self.blocks.append(block)
+
+    def view(self):
+        # what a snapshot holds on to, see Snapshot
+        if isinstance(self.blocks, BlockStore):
+            return PartialChain(self.start, self.blocks.view())
+        return self
+
+
+class History(object):
+    """ Downloads and checks the blocks below the checkpoint a node bootstrapped from, in the background
+
+    the blocks are checked from genesis like any branch and replayed into a registry of their own,
+    which has to end up in the signed state. the node then holds the whole chain, columns included.
+    """
+
+    RETRY_INTERVAL = 5
+
+    def __init__(self, blockchain, checkpoint, source, store=None, columns=None):
+        self.blockchain = blockchain
+        self.checkpoint = checkpoint
+        # the node we bootstrapped from is asked first
+        self.source = source
+        # the block store and the columnar state set aside until the whole chain is there
+        self.store = store
+        self.columns = columns
+        self.status = VALIDATING
+        self.reason = None
+        self.validated = 0
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='history', daemon=True)
+        self.thread.start()
+        return self
+
+    def to_dict(self):
+        return {
+            'status': self.status,
+            'height': self.checkpoint['height'],
+            'validated': self.validated,
+            'reason': self.reason,
+        }
+
+    def run(self):
+        while self.status == VALIDATING:
+            # after a restart there is no node we bootstrapped from
+            sources = [self.source] if self.source is not None else []
+            for node in sources + sorted(self.blockchain.nodes - {self.source}):
+                try:
+                    blocks = self.download(node)
+                except (requests.exceptions.RequestException, ValueError, KeyError) as error:
+                    print('history from', node, 'failed', error)
+                    continue
+                if blocks is not None:
+                    self.complete(blocks)
+                return
+            sleep(self.RETRY_INTERVAL)
+
+    def download(self, node):
+        # the blocks below the checkpoint, checked page by page. None when they are not
+        # what the admin signed, ValueError when the node does not hand them out
+        blockchain = self.blockchain
+        forkchoice = blockchain.forkchoice
+        height = self.checkpoint['height']
+        registry = Registry()
+        blocks, previous, admin = [], None, None
+        self.validated = 0
+        while len(blocks) < height:
+            page = blockchain.fetch_blocks(node, len(blocks), min(height, len(blocks) + blockchain.SYNC_PAGE_SIZE))
+            if not page:
+                raise ValueError('the node does not have the blocks below the checkpoint')
+            page = page[:height - len(blocks)]
+            if admin is None:
+                admin = page[0]['admin']
+            reason = 'hash' if not blockchain.valid_suffix(page, previous and previous['hash'], True) else \
+                forkchoice.check_blocks(len(blocks), page, BranchView(registry, []), previous, admin)
+            if reason is not None:
+                return self.fail(f'block {len(blocks) + 1} and on: {reason}')
+            for block in page:
+                registry.apply_block(block)
+            blocks.extend(page)
+            previous = blocks[-1]
+            self.validated = len(blocks)
+
+        if blocks[0]['hash'] != self.checkpoint['genesis'] or previous['hash'] != self.checkpoint['hash']:
+            return self.fail('the blocks do not lead to the checkpoint')
+        if not same_state(registry.state(), self.checkpoint['state']):
+            return self.fail('the blocks do not add up to the signed state')
+        return blocks
+
+    def fail(self, reason):
+        # the admin signed something the chain does not back, the node stays on the checkpoint
+        self.status, self.reason = FAILED, reason
+        self.blockchain.checkpoints.histories.inc(outcome=FAILED)
+        print('history below the checkpoint is not valid:', reason)
+        return None
+
+    def complete(self, blocks):
+        # puts the checked blocks under the ones held. nothing else writes to the store or the
+        # columns meanwhile, so the history goes in before the lock is taken
+        blockchain = self.blockchain
+        start = self.checkpoint['height'] - 1
+        if self.store is not None:
+            self.store.extend(blocks[:start])
+        if self.columns is not None:
+            for block in blocks[:start]:
+                self.columns.apply_block(block)
+
+        with blockchain.lock:
+            held = blockchain.chain.blocks
+            if self.store is not None:
+                self.store.extend(held)
+                blockchain.chain = blockchain.store = self.store
+                # everything is in the store now, a restart no longer resumes from the checkpoint
+                held.close()
+                shutil.rmtree(held.path)
+            else:
+                blockchain.chain = blocks[:start] + held
+            if self.columns is not None:
+                for block in held:
+                    self.columns.apply_block(block)
+                blockchain.registry.columns = self.columns
+            if self.store is not None:
+                self.store.save_checkpoint(len(blockchain.chain), blockchain.registry.state())
+            self.status = COMPLETE
+            blockchain.publish()
+        blockchain.checkpoints.histories.inc(outcome=COMPLETE)
+
+
+class Checkpoints(object):
+    """ Registry states signed with the admin key, for new nodes to start from instead of genesis
+
+    a node holding the admin key takes the state every interval blocks and signs it once the block
+    is deeper than any reorg it would take. a node that shares no blocks with a peer loads the peer's
+    latest checkpoint, checks the signature against the genesis block and the blocks after it like any
+    branch, and syncs on from there. the blocks below are checked in the background, see History.
+    """
+
+    PATH = '/checkpoint'
+    # where a node keeping its chain on disk holds the blocks from the checkpoint on, until the
+    # history is checked, and the checkpoint it started from
+    PARTIAL = 'partial'
+    BOOTSTRAP = 'bootstrap.json'
+
+    def __init__(self, blockchain, interval=1000, enabled=True):
+        self.blockchain = blockchain
+        self.interval = interval
+        # False makes the node sync every block from genesis
+        self.enabled = enabled
+        # the admin's private key, only on the nodes that have it
+        self.key = None
+        # (height, hash, data) of a state waiting to be buried deep enough to be signed
+        self.pending = None
+        # the latest signed checkpoint and its JSON as served
+        self.latest = None
+        self.latest_json = None
+        self.history = None
+
+        metrics = blockchain.metrics
+        metrics.gauge('checkpoint_height', 'Height of the latest signed checkpoint',
+                      function=lambda: self.latest['height'] if self.latest is not None else 0)
+        self.signed = metrics.counter('checkpoints_signed_total', 'Checkpoints signed with the admin key')
+        self.bootstraps = metrics.counter('checkpoint_bootstraps_total', 'Attempts to start from a checkpoint',
+                                          ('outcome',))
+        self.histories = metrics.counter('checkpoint_histories_total', 'Validations of the blocks below a checkpoint',
+                                         ('outcome',))
+
+    def load_key(self, key_file):
+        # the key is only used when it is the admin key of our chain
+        try:
+            with open(key_file, 'rb') as f:
+                key = RSA.import_key(f.read())
+        except (OSError, ValueError):
+            return
+        if key.has_private() and key.publickey().export_key() == self.blockchain.admin:
+            self.key = key
+
+    def use(self, checkpoint):
+        self.latest = checkpoint
+        self.latest_json = json.dumps(checkpoint).encode()
+
+    def block_appended(self):
+        # called by the writer for every block it appends, holding the lock
+        if self.key is None:
+            return
+        chain = self.blockchain.chain
+        height = len(chain)
+        if self.pending is not None and height >= self.pending[0] + self.blockchain.forkchoice.max_reorg_depth:
+            pending_height, pending_hash, data = self.pending
+            self.pending = None
+            # the state is dropped when its block was replaced meanwhile
+            if chain[pending_height - 1]['hash'] == pending_hash:
+                self.use(sign_checkpoint(self.key, json.loads(data)))
+                self.signed.inc()
+        if height % self.interval == 0 and self.pending is None:
+            # the registry keeps changing, so the state is taken as JSON right away
+            checkpoint = {
+                'height': height,
+                'hash': chain[-1]['hash'],
+                'genesis': chain[0]['hash'],
+                'state': self.blockchain.registry.state(),
+            }
+            self.pending = (height, checkpoint['hash'], checkpoint_data(checkpoint))
+
+    def fetch(self, node):
+        # the node's latest checkpoint, None when it has none
+        response = self.blockchain.peers.request(node, 'GET', self.PATH, check_status=False)
+        if response.status_code == 404:
+            return None
+        response.raise_for_status()
+        return response.json()
+
+    def bootstrap(self, node, length):
+        # replaces our chain, which shares no block with the node's, with the node's latest checkpoint
+        # and the blocks after it. None when the node has no checkpoint to start from,
+        # otherwise whether the chain changed
+        blockchain = self.blockchain
+        if not self.enabled:
+            return None
+        checkpoint = self.fetch(node)
+        if checkpoint is None or not 1 < checkpoint['height'] <= length:
+            return None
+        height = checkpoint['height']
+
+        genesis = blockchain.fetch_blocks(node, 0, 1)[:1]
+        blocks = blockchain.fetch_blocks(node, height - 1, length)
+        if not genesis or not blocks or not blockchain.valid_suffix(genesis, None, True) or \
+                genesis[0]['hash'] != checkpoint['genesis'] or not verify_checkpoint(genesis[0]['admin'], checkpoint):
+            self.bootstraps.inc(outcome='signature')
+            return False
+        admin = genesis[0]['admin']
+        if not blockchain.valid_suffix(blocks, None, True) or blocks[0]['hash'] != checkpoint['hash'] or \
+                blocks[0]['index'] != height or blocks[0]['admin'] != admin:
+            self.bootstraps.inc(outcome='hash')
+            return False
+        # the blocks after the checkpoint are checked against the signed state like any branch
+        registry = Registry()
+        registry.load_state(checkpoint['state'])
+        reason = blockchain.forkchoice.check_blocks(height, blocks[1:], BranchView(registry, []), blocks[0], admin)
+        if reason is not None:
+            blockchain.forkchoice.rejected.inc(reason=reason)
+            self.bootstraps.inc(outcome='rejected')
+            return False
+
+        with blockchain.lock:
+            if not blockchain.forkchoice.wins(height - 1 + len(blocks), blocks[-1]['hash']) or \
+                    not blockchain.forkchoice.within_reach(0):
+                self.bootstraps.inc(outcome='shorter')
+                return False
+            abandoned = list(blockchain.chain)
+            store = blockchain.store
+            if store is not None:
+                # the new blocks are on disk before the old ones are dropped
+                blocks = self.save_partial(store, checkpoint, genesis[0], blocks)
+                del store[0:]
+            self.adopt(checkpoint, admin, blocks, node)
+            blockchain.forkchoice.remember(abandoned)
+            blockchain.forkchoice.requeue(abandoned)
+            blockchain.publish()
+        self.bootstraps.inc(outcome='accepted')
+        self.history.start()
+        return True
+
+    def save_partial(self, store, checkpoint, genesis, blocks):
+        # a store next to the chain's own holding the blocks from the checkpoint on. it only counts
+        # once the checkpoint is written next to it, see resume
+        path = os.path.join(store.path, self.PARTIAL)
+        shutil.rmtree(path, ignore_errors=True)
+        partial = BlockStore(path, sync=store.sync)
+        partial.extend(blocks)
+        with open(os.path.join(path, self.BOOTSTRAP + '.tmp'), 'w') as f:
+            json.dump({'checkpoint': checkpoint, 'genesis': genesis}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(os.path.join(path, self.BOOTSTRAP + '.tmp'), os.path.join(path, self.BOOTSTRAP))
+        return partial
+
+    def resume(self):
+        # a node keeping its chain on disk that was stopped before the history was checked carries on
+        # from the checkpoint and the blocks it saved. False when there is nothing to resume
+        blockchain = self.blockchain
+        if blockchain.store is None or blockchain.store.readonly:
+            # replicas follow the partial store of their writer, see Replica
+            return False
+        path = os.path.join(blockchain.store.path, self.PARTIAL)
+        try:
+            with open(os.path.join(path, self.BOOTSTRAP)) as f:
+                saved = json.load(f)
+        except (OSError, ValueError):
+            return False
+        partial = BlockStore(path, sync=blockchain.store.sync)
+        with blockchain.lock:
+            # whatever the history got into the chain's store before the stop is written again
+            del blockchain.store[0:]
+            self.adopt(saved['checkpoint'], saved['genesis']['admin'], partial, None)
+            blockchain.publish()
+        self.history.start()
+        return True
+
+    def adopt(self, checkpoint, admin, blocks, source):
+        # makes the checkpoint and the blocks from its own on our chain, holding the lock.
+        # the chain's store and the columns are set aside until the history is checked
+        blockchain = self.blockchain
+        height = checkpoint['height']
+        store, blockchain.store = blockchain.store, None
+        columns, blockchain.registry.columns = blockchain.registry.columns, None
+        blockchain.chain = PartialChain(height - 1, blocks)
+        blockchain.registry.load_state(checkpoint['state'])
+        for block in blocks[1:]:
+            blockchain.registry.apply_block(block)
+        blockchain.admin = admin.encode()
+        blockchain.forkchoice.final = height
+        blockchain.restore_voting_flags()
+        self.use(checkpoint)
+        self.history = History(blockchain, checkpoint, source, store, columns)
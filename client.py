@@ -0,0 +1,384 @@
+# client library for voting applications and the load generator for capacity tests. votes are signed
+# offline with the voter's key and submitted over keep-alive connections, several at a time and spread
+# over the given nodes, with retries when a node is busy or unreachable:
+#
+#   client = VotingClient(['localhost:5000', 'localhost:5001'], concurrency=16)
+#   outcomes = client.wait(client.submit_many([sign_vote(key, wallet, candidate) for ...]))
+#
+# run as a script it enrolls voters, starts the vote with the admin key and casts one vote per voter,
+# printing the outcome counts and latencies as JSON:
+#
+#   python client.py --nodes localhost:5000,localhost:5001 --voters 1000 --concurrency 32
+import argparse
+import itertools
+import json
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter, sleep, time
+
+import requests
+from requests.adapters import HTTPAdapter
+from Crypto.PublicKey import RSA
+
+from ingest import COMMITTED, REJECTED
+from metrics import percentile
+from transaction import Transaction
+
+# outcome statuses on top of the ones the ingest queue reports
+ACCEPTED = 'accepted'
+FAILED = 'failed'
+# statuses a vote does not leave any more
+FINAL = {COMMITTED, REJECTED, FAILED}
+
+
+def load_key(key):
+    # an RSA key from PEM text or bytes, or from the file holding it
+    if isinstance(key, RSA.RsaKey):
+        return key
+    if isinstance(key, str) and not key.startswith('-----'):
+        with open(key, 'rb') as f:
+            key = f.read()
+    return RSA.import_key(key)
+
+
+def sign_vote(private_key, sender, receiver):
+    # the vote as /transaction/new takes it, signed without talking to a node
+    transaction = Transaction(sender, receiver)
+    return {
+        'sender': sender,
+        'receiver': receiver,
+        'signature': transaction.sign(load_key(private_key)),
+    }
+
+
+def sign_admin(private_key, data):
+    # signature of the admin over data, for adding candidates and starting or ending the vote
+    return Transaction.sign_data(data.encode('utf-8'), load_key(private_key))
+
+
+def chunks(items, size):
+    items = iter(items)
+    while True:
+        chunk = list(itertools.islice(items, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+class Outcome(object):
+    """ What became of one submitted vote """
+
+    __slots__ = ('sender', 'node', 'status', 'ticket', 'message', 'attempts', 'latency', 'submitted_at',
+                 'finished_at')
+
+    def __init__(self, sender):
+        self.sender = sender
+        self.node = None
+        self.status = None
+        self.ticket = None
+        self.message = None
+        self.attempts = 0
+        # seconds from the first attempt to the node's answer
+        self.latency = None
+        # wall clock times of the first attempt and of the first answer or poll with a final status
+        self.submitted_at = None
+        self.finished_at = None
+
+    def finish(self, status, message=None):
+        self.status = status
+        self.message = message
+        if status in FINAL and self.finished_at is None:
+            self.finished_at = time()
+
+    @property
+    def commit_latency(self):
+        # seconds from submission until the vote was seen committed, as closely as the polling shows it
+        if self.status != COMMITTED or self.finished_at is None:
+            return None
+        return self.finished_at - self.submitted_at
+
+    def to_dict(self):
+        return dict({name: getattr(self, name) for name in self.__slots__}, commit_latency=self.commit_latency)
+
+
+class VotingClient(object):
+    """ Keep-alive client for one or more nodes with bounded concurrency and retries """
+
+    def __init__(self, nodes, concurrency=8, retries=3, timeout=10, backoff=0.2, max_backoff=5):
+        self.nodes = [node.rstrip('/') for node in nodes]
+        if not self.nodes:
+            raise ValueError('at least one node is needed')
+        self.concurrency = concurrency
+        self.retries = retries
+        self.timeout = timeout
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=len(self.nodes), pool_maxsize=concurrency)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='client')
+
+    def close(self):
+        self.executor.shutdown()
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @staticmethod
+    def url(node, path):
+        return node + path if node.startswith(('http://', 'https://')) else f'http://{node}{path}'
+
+    def request(self, method, path, node=None, **kwargs):
+        # one request without retries, to the first node unless another is given
+        return self.session.request(method, self.url(node or self.nodes[0], path), timeout=self.timeout, **kwargs)
+
+    def delay(self, attempt):
+        return min(self.backoff * 2 ** attempt, self.max_backoff)
+
+    def send(self, path, payload, first_node=0):
+        # posts payload with retries, moving on to the next node after a failed connection.
+        # busy nodes are asked again after their Retry-After. returns (node, response, attempts, error)
+        error = node = None
+        for attempt in range(self.retries + 1):
+            node = self.nodes[(first_node + attempt) % len(self.nodes)]
+            try:
+                response = self.request('POST', path, node, json=payload)
+            except requests.exceptions.RequestException as exception:
+                error = str(exception)
+                if attempt < self.retries:
+                    sleep(self.delay(attempt))
+                continue
+            if response.status_code == 429 or response.status_code >= 500:
+                error = f'{node} answered {response.status_code}'
+                if attempt < self.retries:
+                    sleep(float(response.headers.get('Retry-After', self.delay(attempt))))
+                continue
+            return node, response, attempt + 1, None
+        return node, None, self.retries + 1, error
+
+    def submit(self, vote, first_node=0):
+        # hands one signed vote to a node. returns its Outcome, queued with a ticket when the node took it
+        outcome = Outcome(vote['sender'])
+        outcome.submitted_at = time()
+        start = perf_counter()
+        outcome.node, response, outcome.attempts, error = self.send('/transaction/new', vote, first_node)
+        outcome.latency = perf_counter() - start
+        if response is None:
+            outcome.finish(FAILED, error)
+        elif response.status_code == 202:
+            values = response.json()
+            outcome.ticket = values['ticket']
+            outcome.finish(values['status'])
+        else:
+            outcome.finish(REJECTED, self.error_message(response))
+        return outcome
+
+    def submit_batch(self, votes, first_node=0):
+        # hands votes to a node in one request, they are verified and committed right away
+        outcomes = [Outcome(vote['sender']) for vote in votes]
+        submitted_at = time()
+        start = perf_counter()
+        node, response, attempts, error = self.send('/transaction/batch', votes, first_node)
+        latency = perf_counter() - start
+        items = response.json()['results'] if response is not None and response.status_code == 200 else None
+        for position, outcome in enumerate(outcomes):
+            outcome.node, outcome.attempts, outcome.latency = node, attempts, latency
+            outcome.submitted_at = submitted_at
+            if response is None:
+                outcome.finish(FAILED, error)
+            elif items is None:
+                outcome.finish(REJECTED, self.error_message(response))
+            elif items[position]['accepted']:
+                outcome.finish(ACCEPTED)
+            else:
+                outcome.finish(REJECTED, items[position]['error_message'])
+        return outcomes
+
+    @staticmethod
+    def error_message(response):
+        try:
+            return response.json().get('error_message')
+        except ValueError:
+            return response.text
+
+    def submit_many(self, votes, batch_size=None):
+        # submits an iterable of signed votes, at most concurrency requests in flight and the nodes taken
+        # in turn. one vote per request, or batch_size per request to /transaction/batch.
+        # returns the outcomes in the order of the votes
+        items, submit = (chunks(votes, batch_size), self.submit_batch) if batch_size else (votes, self.submit)
+
+        # the votes are read lazily, only a bounded number of them is waiting for a worker
+        slots = threading.BoundedSemaphore(self.concurrency * 2)
+        futures = []
+        for position, item in enumerate(items):
+            slots.acquire()
+            future = self.executor.submit(submit, item, position)
+            future.add_done_callback(lambda _: slots.release())
+            futures.append(future)
+
+        outcomes = []
+        for future in futures:
+            result = future.result()
+            outcomes.extend(result if batch_size else [result])
+        return outcomes
+
+    def status(self, outcome):
+        # asks the node that took the vote how far it got, updating the outcome
+        try:
+            response = self.request('GET', f'/transaction/status/{outcome.ticket}', outcome.node)
+        except requests.exceptions.RequestException:
+            return outcome
+        if response.status_code == 200:
+            values = response.json()
+            outcome.finish(values['status'], values.get('message', outcome.message))
+        return outcome
+
+    def wait(self, outcomes, timeout=60, interval=0.2):
+        # polls the queued votes until they are committed or rejected, or timeout seconds passed
+        deadline = time() + timeout
+        while True:
+            waiting = [outcome for outcome in outcomes if outcome.ticket is not None and outcome.status not in FINAL]
+            if not waiting or time() >= deadline:
+                return outcomes
+            list(self.executor.map(self.status, waiting))
+            if any(outcome.status not in FINAL for outcome in waiting):
+                sleep(interval)
+
+    def add_candidate(self, name, admin_key):
+        response = self.request('POST', '/candidate/new', json={'name': name, 'signature': sign_admin(admin_key, name)})
+        response.raise_for_status()
+        return response.json()['wallet']
+
+    def new_voters(self, count, block_size=100):
+        # enrolls count voters, yields (private key, wallet) as the node streams them
+        response = self.request('POST', '/voter/batch', json={'count': count, 'block_size': block_size}, stream=True)
+        response.raise_for_status()
+        for line in response.iter_lines():
+            if line:
+                voter = json.loads(line)
+                if 'error' in voter:
+                    raise RuntimeError(voter['error'])
+                yield RSA.import_key(voter['private_key']), voter['wallet']
+
+    def start_voting(self, admin_key, data='StartVote'):
+        self.request('POST', '/startvote', json={'signature': sign_admin(admin_key, data), 'data': data}).raise_for_status()
+
+    def end_voting(self, admin_key, data='EndVote'):
+        self.request('POST', '/endvote', json={'signature': sign_admin(admin_key, data), 'data': data}).raise_for_status()
+
+    def results(self, node=None):
+        response = self.request('GET', '/candidate/results', node)
+        response.raise_for_status()
+        return response.json()
+
+
+def percentiles(values, prefix=''):
+    # p50, p95, p99 and max of a list of seconds, in milliseconds
+    values = sorted(values)
+    summary = {}
+    for name, fraction in (('p50', 0.5), ('p95', 0.95), ('p99', 0.99), ('max', 1)):
+        summary[f'{prefix}{name}_ms'] = percentile(values, fraction) * 1000 if values else None
+    return summary
+
+
+def summarize(outcomes, elapsed):
+    # outcome counts and latencies of a run, submission latencies as p50_ms and so on,
+    # the time until votes were seen committed as commit_p50_ms and so on
+    statuses = {}
+    for outcome in outcomes:
+        statuses[outcome.status] = statuses.get(outcome.status, 0) + 1
+
+    summary = {
+        'count': len(outcomes),
+        'seconds': elapsed,
+        'throughput': len(outcomes) / elapsed if elapsed else None,
+        'statuses': statuses,
+        'retried': sum(outcome.attempts > 1 for outcome in outcomes),
+    }
+    summary.update(percentiles([outcome.latency for outcome in outcomes if outcome.latency is not None]))
+    summary.update(percentiles([outcome.commit_latency for outcome in outcomes if outcome.commit_latency is not None],
+                               'commit_'))
+    return summary
+
+
+def save_voters(path, voters):
+    with open(path, 'w') as f:
+        for key, wallet in voters:
+            f.write(json.dumps({'private_key': key.export_key('PEM').decode('utf-8'), 'wallet': wallet}) + '\n')
+
+
+def load_voters(path):
+    # (private key, wallet) of every voter in a file written by save_voters or downloaded from /voter/batch
+    with open(path) as f:
+        return [(RSA.import_key(voter['private_key']), voter['wallet'])
+                for voter in (json.loads(line) for line in f if line.strip())]
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Cast votes against running nodes.')
+    parser.add_argument('--nodes', default='localhost:5000', help='comma separated, votes are spread over them')
+    parser.add_argument('--voters', type=int, default=100)
+    parser.add_argument('--candidates', type=int, default=3, help='added before voting starts')
+    parser.add_argument('--admin-key', default='private.pem', help='PEM file with the key of the first node')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--retries', type=int, default=3)
+    parser.add_argument('--batch-size', type=int, default=0, help='votes per /transaction/batch request, 0 for one '
+                                                                  'vote per /transaction/new request')
+    parser.add_argument('--no-setup', action='store_true',
+                        help='skip adding candidates, enrolling voters and starting the vote, they were done '
+                             'already. the voters are read from --voters-file')
+    parser.add_argument('--voters-file', help='voter credentials, one JSON document per line as /voter/batch '
+                                              'streams them. written when the voters are enrolled, read with '
+                                              '--no-setup')
+    parser.add_argument('--wait', type=float, default=60, help='seconds to wait for queued votes to be committed')
+    parser.add_argument('--output', help='write the summary here instead of stdout')
+    args = parser.parse_args(argv)
+    if args.no_setup and not args.voters_file:
+        # the vote has started, so no voters can be enrolled anymore
+        parser.error('--no-setup needs --voters-file with the voters enrolled before')
+    return args
+
+
+def run(argv=None):
+    args = parse_args(argv)
+    client = VotingClient(args.nodes.split(','), args.concurrency, args.retries)
+    with client:
+        # everything goes to the first node, the others pick it up from its chain
+        if not args.no_setup:
+            for number in range(args.candidates):
+                client.add_candidate(f'Candidate {number + 1}', args.admin_key)
+            voters = list(client.new_voters(args.voters))
+            if args.voters_file:
+                save_voters(args.voters_file, voters)
+        else:
+            voters = load_voters(args.voters_file)[:args.voters]
+        candidates = [candidate['wallet_address'] for candidate in client.results()]
+        if not args.no_setup:
+            client.start_voting(args.admin_key)
+        print(f'signing {len(voters)} votes', file=sys.stderr)
+        votes = [sign_vote(key, wallet, candidates[number % len(candidates)])
+                 for number, (key, wallet) in enumerate(voters)]
+
+        start = perf_counter()
+        outcomes = client.submit_many(votes, args.batch_size)
+        elapsed = perf_counter() - start
+        client.wait(outcomes, args.wait)
+        summary = summarize(outcomes, elapsed)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(summary, f, indent=2)
+    else:
+        json.dump(summary, sys.stdout, indent=2)
+        print()
+    return summary
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,465 @@
+# brings up a cluster of voting nodes on this machine and runs an election on it through the HTTP API.
+# nodes run in this process, each behind its own HTTP server, or as main.py subprocesses, and are wired
+# up in a topology. requests between nodes can be delayed or lost and nodes can crash during the vote:
+#
+#   python cluster.py --nodes 5 --topology ring --latency 0.02 --jitter 0.01 --loss 0.05
+#   python cluster.py --nodes 4 --mode subprocess --voters 500 --crash 1 --downtime 2
+#
+# the report has the outcome of the votes and, per node, how long it took to settle on the final chain,
+# how many bytes it received syncing and how long its votes took to be committed.
+import argparse
+import contextlib
+import contextvars
+import json
+import logging
+import os
+import random
+import re
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+from collections import deque
+from time import perf_counter, sleep, time
+
+import requests
+from werkzeug.serving import make_server
+
+import client
+import main
+from blockchain import BlockChain
+from keypool import KeyPool
+from peers import Link
+
+MODES = ('inprocess', 'subprocess')
+MAIN = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'main.py')
+
+
+def mesh(size):
+    return {node: set(range(size)) - {node} for node in range(size)}
+
+
+def ring(size):
+    return {node: {(node - 1) % size, (node + 1) % size} - {node} for node in range(size)}
+
+
+def line(size):
+    return {node: {neighbour for neighbour in (node - 1, node + 1) if 0 <= neighbour < size} for node in range(size)}
+
+
+def star(size):
+    # node 0 in the middle
+    topology = {node: {0} for node in range(1, size)}
+    topology[0] = set(range(1, size))
+    return topology
+
+
+TOPOLOGIES = {'mesh': mesh, 'ring': ring, 'line': line, 'star': star}
+
+
+def start_order(topology):
+    # breadth first from node 0, every node after the first has a running neighbour to sync from
+    order, queue = [], deque([0])
+    while queue:
+        node = queue.popleft()
+        if node not in order:
+            order.append(node)
+            queue.extend(sorted(topology[node]))
+    return order + [node for node in sorted(topology) if node not in order]
+
+
+def metric_total(text, name):
+    # sum of all samples of a metric in the Prometheus text format
+    pattern = re.compile(rf'^{re.escape(name)}(?:{{[^}}]*}})? (\S+)$', re.MULTILINE)
+    return sum(float(value) for value in pattern.findall(text))
+
+
+class NodeDispatch(object):
+    """ Stands in for main.blockchain while several in-process nodes share the Flask app """
+
+    def __init__(self):
+        self.current = contextvars.ContextVar('blockchain')
+
+    def __getattr__(self, name):
+        return getattr(self.current.get(), name)
+
+
+dispatch = NodeDispatch()
+
+
+class InProcessNode(object):
+    """ A BlockChain of this process behind its own HTTP server """
+
+    def __init__(self, name, directory, block_size, block_interval, key_bits):
+        self.name = name
+        self.directory = directory
+        self.block_size = block_size
+        self.block_interval = block_interval
+        self.key_bits = key_bits
+        self.blockchain = None
+        # a crashed node answers every request with 503 and does nothing on its own, see crash
+        self.down = False
+        self.server = make_server('localhost', 0, self.serve, threaded=True)
+        self.address = f'localhost:{self.server.server_port}'
+        self.thread = None
+
+    def serve(self, environ, start_response):
+        if self.blockchain is None or self.down:
+            start_response('503 Service Unavailable', [('Content-Type', 'text/plain')])
+            return [b'node is down']
+        dispatch.current.set(self.blockchain)
+        return main.app(environ, start_response)
+
+    def start(self, peers, links):
+        self.thread = threading.Thread(target=self.server.serve_forever, name=self.name, daemon=True)
+        self.thread.start()
+        self.blockchain = BlockChain(set(peers), self.block_size, self.block_interval,
+                                     key_pool=KeyPool(bits=self.key_bits),
+                                     admin_key_file=os.path.join(self.directory, f'{self.name}.pem'))
+        self.blockchain.address = self.address
+        for address, link in links.items():
+            self.blockchain.peers.links[address] = link
+
+    def crash(self):
+        # as if the process died: the votes in the ingest queue are committed, then the block
+        # timer stops and the blocks not pushed to the peers yet are dropped
+        self.down = True
+        blockchain = self.blockchain
+        blockchain.ingest.stop()
+        with blockchain.lock:
+            blockchain.producer.cancel()
+        blockchain.peers.stop()
+
+    def restart(self):
+        # the chain survives the crash, as it would in a block store. so do the pending votes, they
+        # are sealed once the node is back
+        blockchain = self.blockchain
+        blockchain.peers.start()
+        self.down = False
+        if blockchain.producer.pending():
+            blockchain.producer.submit()
+
+    def stop(self):
+        self.server.shutdown()
+        if self.blockchain is not None:
+            self.blockchain.ingest.stop()
+
+
+class SubprocessNode(object):
+    """ A main.py process, configured through its environment """
+
+    def __init__(self, name, directory, block_size, block_interval, key_bits):
+        self.name = name
+        self.directory = directory
+        self.block_size = block_size
+        self.block_interval = block_interval
+        self.key_bits = key_bits
+        # the port is reserved by binding it once, the node binds it again right after
+        with socket.socket() as probe:
+            probe.bind(('localhost', 0))
+            self.port = probe.getsockname()[1]
+        self.address = f'localhost:{self.port}'
+        self.process = None
+        self.environment = None
+        self.down = False
+
+    def start(self, peers, links):
+        self.environment = dict(
+            os.environ,
+            PEERS=','.join(peers),
+            NODE_ADDRESS=self.address,
+            LINKS=json.dumps({address: vars(link) for address, link in links.items()}),
+            DATA_DIR=self.directory,
+            ADMIN_KEY_FILE=os.path.join(self.directory, f'{self.name}.pem'),
+            BLOCK_SIZE=str(self.block_size),
+            BLOCK_INTERVAL=str(self.block_interval),
+            KEY_BITS=str(self.key_bits),
+            KEY_POOL_SIZE='0',
+        )
+        self.launch()
+
+    def launch(self):
+        log = open(os.path.join(self.directory, f'{self.name}.log'), 'ab')
+        self.process = subprocess.Popen([sys.executable, MAIN, str(self.port)], env=self.environment,
+                                        cwd=self.directory, stdout=log, stderr=subprocess.STDOUT)
+        log.close()
+        self.wait_ready()
+
+    def wait_ready(self, timeout=60):
+        deadline = time() + timeout
+        while time() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError(f'{self.name} exited, see {self.name}.log in {self.directory}')
+            try:
+                requests.get(f'http://{self.address}/chain/head', timeout=1).raise_for_status()
+                return
+            except requests.exceptions.RequestException:
+                sleep(0.1)
+        raise RuntimeError(f'{self.name} did not come up')
+
+    def crash(self):
+        self.down = True
+        self.process.kill()
+        self.process.wait()
+
+    def restart(self):
+        # comes back from its block store in DATA_DIR
+        self.launch()
+        self.down = False
+
+    def stop(self):
+        if self.process is not None and self.process.poll() is None:
+            self.process.terminate()
+            self.process.wait()
+
+
+class Cluster(object):
+    """ Nodes on this machine wired up in a topology, with simulated links between them """
+
+    def __init__(self, size=3, mode='inprocess', topology='mesh', latency=0, jitter=0, loss=0, block_size=10,
+                 block_interval=0.2, key_bits=1024, sync_interval=0.5, directory=None):
+        if mode not in MODES:
+            raise ValueError(f'unknown mode {mode}')
+        self.size = size
+        self.mode = mode
+        self.topology = TOPOLOGIES[topology](size)
+        self.topology_name = topology
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        self.block_size = block_size
+        # votes left over from a full block, or from blocks lost to another branch, are sealed after this long
+        self.block_interval = block_interval
+        self.key_bits = key_bits
+        # every node asks its neighbours for a better chain this often, 0 leaves it to the blocks the
+        # nodes push to each other. it catches up nodes that missed a block nobody built on yet
+        self.sync_interval = sync_interval
+        self.directory = directory
+        self.temporary = directory is None
+        self.nodes = []
+        self.session = requests.Session()
+        self.stopped = threading.Event()
+        self.syncer = None
+        self.saved_blockchain = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def start(self):
+        if self.temporary:
+            self.directory = tempfile.mkdtemp(prefix='cluster-')
+        else:
+            os.makedirs(self.directory, exist_ok=True)
+        node_class = InProcessNode if self.mode == 'inprocess' else SubprocessNode
+        self.nodes = [node_class(f'node{number}', self.directory, self.block_size, self.block_interval, self.key_bits)
+                      for number in range(self.size)]
+        if self.mode == 'inprocess':
+            self.saved_blockchain = getattr(main, 'blockchain', None)
+            main.blockchain = dispatch
+
+        try:
+            for number in start_order(self.topology):
+                peers = [self.nodes[neighbour].address for neighbour in sorted(self.topology[number])]
+                self.nodes[number].start(peers, {address: self.link() for address in peers})
+        except Exception:
+            self.stop()
+            raise
+
+        if self.sync_interval:
+            self.syncer = threading.Thread(target=self.sync, name='cluster-sync', daemon=True)
+            self.syncer.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        if self.syncer is not None:
+            self.syncer.join()
+        for node in self.nodes:
+            node.stop()
+        if self.mode == 'inprocess':
+            main.blockchain = self.saved_blockchain
+        self.session.close()
+        if self.temporary and self.directory is not None:
+            shutil.rmtree(self.directory, ignore_errors=True)
+
+    def link(self):
+        return Link(self.latency, self.jitter, self.loss)
+
+    def set_link(self, source, target, **conditions):
+        # changes the conditions on the way from node source to node target, in-process nodes only
+        self.nodes[source].blockchain.peers.links[self.nodes[target].address] = Link(**conditions)
+
+    def up(self):
+        return [node for node in self.nodes if not node.down]
+
+    def sync(self):
+        while not self.stopped.wait(self.sync_interval):
+            for node in self.up():
+                try:
+                    self.session.get(f'http://{node.address}/miner/nodes/resolve', timeout=30)
+                except requests.exceptions.RequestException:
+                    pass
+
+    def get(self, node, path):
+        response = self.session.get(f'http://{node.address}{path}', timeout=10)
+        response.raise_for_status()
+        return response
+
+    def heads(self):
+        heads = {}
+        for node in self.up():
+            try:
+                heads[node.name] = self.get(node, '/chain/head').json()
+            except requests.exceptions.RequestException:
+                heads[node.name] = None
+        return heads
+
+    def wait_converged(self, timeout=60, interval=0.05):
+        # waits until every running node has the same chain. returns the seconds after which each node
+        # had settled on it for good, None for all of them when they did not agree within timeout
+        start = perf_counter()
+        settled = {}
+        while perf_counter() - start < timeout:
+            heads = self.heads()
+            now = perf_counter() - start
+            hashes = {head['hash'] if head is not None else None for head in heads.values()}
+            for name, head in heads.items():
+                key = head['hash'] if head is not None else None
+                if settled.get(name, (None,))[0] != key:
+                    settled[name] = (key, now)
+            if len(hashes) == 1 and None not in hashes:
+                return {name: since for name, (_, since) in settled.items()}
+            sleep(interval)
+        return {node.name: None for node in self.up()}
+
+    def sync_bytes(self):
+        # bytes each node received from its peers since it last started
+        received = {}
+        for node in self.up():
+            received[node.name] = metric_total(self.get(node, '/metrics').text, 'peer_received_bytes_total')
+        return received
+
+    def election(self, voters=100, candidates=3, concurrency=8, crashes=0, crash_after=0.5, downtime=2, wait=60):
+        # runs an election through the HTTP API: candidates and voters are added on node 0, which
+        # also starts the vote, the signed votes are spread over every node. crashes nodes other than
+        # node 0 go down crash_after seconds into the votes and come back downtime seconds later
+        admin_key = os.path.join(self.directory, 'node0.pem')
+        addresses = [node.address for node in self.nodes]
+        with client.VotingClient(addresses, concurrency) as admin:
+            for number in range(candidates):
+                admin.add_candidate(f'Candidate {number + 1}', admin_key)
+            enrolled = list(admin.new_voters(voters))
+            admin.start_voting(admin_key)
+            candidate_wallets = [candidate['wallet_address'] for candidate in admin.results()]
+        setup_convergence = self.wait_converged(wait)
+
+        votes = [client.sign_vote(key, wallet, candidate_wallets[number % len(candidate_wallets)])
+                 for number, (key, wallet) in enumerate(enrolled)]
+        crashed = random.sample(self.nodes[1:], min(crashes, self.size - 1))
+        faults = threading.Thread(target=self.crash_and_restart, args=(crashed, crash_after, downtime), daemon=True)
+
+        with client.VotingClient(addresses, concurrency) as voting:
+            start = perf_counter()
+            faults.start()
+            outcomes = voting.submit_many(votes)
+            elapsed = perf_counter() - start
+            voting.wait(outcomes, wait, interval=0.02)
+            faults.join()
+        received = self.sync_bytes()
+        convergence = self.wait_converged(wait)
+        heads = self.heads()
+
+        report = {
+            'config': {
+                'nodes': self.size,
+                'mode': self.mode,
+                'topology': self.topology_name,
+                'latency': self.latency,
+                'jitter': self.jitter,
+                'loss': self.loss,
+                'block_size': self.block_size,
+                'block_interval': self.block_interval,
+                'voters': voters,
+                'candidates': candidates,
+                'crashes': [node.name for node in crashed],
+            },
+            'votes': client.summarize(outcomes, elapsed),
+            'converged': all(seconds is not None for seconds in convergence.values()),
+            'nodes': {},
+        }
+        for node in self.nodes:
+            mine = [outcome for outcome in outcomes if outcome.node == node.address]
+            report['nodes'][node.name] = dict({
+                'address': node.address,
+                'height': heads[node.name]['length'] if heads.get(node.name) else None,
+                'setup_convergence_seconds': setup_convergence.get(node.name),
+                'convergence_seconds': convergence.get(node.name),
+                'sync_bytes': received.get(node.name),
+                'votes': len(mine),
+                'crashed': node in crashed,
+            }, **client.percentiles([outcome.commit_latency for outcome in mine
+                                     if outcome.commit_latency is not None], 'commit_'))
+        return report
+
+    def crash_and_restart(self, nodes, crash_after, downtime):
+        if not nodes:
+            return
+        sleep(crash_after)
+        for node in nodes:
+            node.crash()
+        sleep(downtime)
+        for node in nodes:
+            node.restart()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Run an election on a local cluster of nodes.')
+    parser.add_argument('--nodes', type=int, default=3)
+    parser.add_argument('--mode', choices=MODES, default='inprocess')
+    parser.add_argument('--topology', choices=sorted(TOPOLOGIES), default='mesh')
+    parser.add_argument('--latency', type=float, default=0, help='seconds added to every request between nodes')
+    parser.add_argument('--jitter', type=float, default=0, help='up to this many seconds more')
+    parser.add_argument('--loss', type=float, default=0, help='share of the requests between nodes that get lost')
+    parser.add_argument('--block-size', type=int, default=10)
+    parser.add_argument('--block-interval', type=float, default=0.2, help='seconds after which a partial block is sealed')
+    parser.add_argument('--key-bits', type=int, default=1024, help='size of the voter keys')
+    parser.add_argument('--sync-interval', type=float, default=0.5,
+                        help='seconds between the checks every node makes for a better chain, 0 for none')
+    parser.add_argument('--voters', type=int, default=100)
+    parser.add_argument('--candidates', type=int, default=3)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--crash', type=int, default=0, help='nodes that crash while the votes come in')
+    parser.add_argument('--crash-after', type=float, default=0.5)
+    parser.add_argument('--downtime', type=float, default=2)
+    parser.add_argument('--wait', type=float, default=60, help='seconds to wait for commits and convergence')
+    parser.add_argument('--directory', help='keep the keys, chains and logs of the nodes here')
+    parser.add_argument('--output', help='write the report here instead of stdout')
+    return parser.parse_args(argv)
+
+
+def run(argv=None):
+    args = parse_args(argv)
+    cluster = Cluster(args.nodes, args.mode, args.topology, args.latency, args.jitter, args.loss, args.block_size,
+                      args.block_interval, args.key_bits, args.sync_interval, args.directory)
+    # in-process nodes print as they go, stdout is kept for the report
+    with contextlib.redirect_stdout(sys.stderr), cluster:
+        report = cluster.election(args.voters, args.candidates, args.concurrency, args.crash, args.crash_after,
+                                  args.downtime, args.wait)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    return report
+
+
+if __name__ == '__main__':
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    run()
@@ -0,0 +1,255 @@
+# columnar copy of the election state for statistics and audits. wallet addresses are interned to
+# integer ids once and every vote, voter and block becomes a few numbers in typed columns, so memory
+# grows by a handful of bytes per vote instead of a dict. queries are vectorized with numpy when it is
+# installed and fall back to plain loops over array.array columns when it is not.
+import array
+import threading
+
+from metrics import percentile
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# typecodes of array.array and the numpy types with the same width
+DTYPES = {'i': 'int32', 'd': 'float64'}
+
+
+class Column(object):
+    """ Append-only typed column that can be cut back to an earlier length """
+
+    def __init__(self, typecode):
+        self.typecode = typecode
+        self.length = 0
+        self.data = numpy.zeros(64, dtype=DTYPES[typecode]) if numpy is not None else array.array(typecode)
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, position):
+        return self.data[position]
+
+    def __setitem__(self, position, value):
+        self.data[position] = value
+
+    def append(self, value):
+        if numpy is None:
+            self.data.append(value)
+        else:
+            if self.length == len(self.data):
+                # doubled, so appends stay amortized constant time
+                self.data = numpy.concatenate((self.data, numpy.zeros_like(self.data)))
+            self.data[self.length] = value
+        self.length += 1
+
+    def truncate(self, length):
+        if numpy is None:
+            del self.data[length:]
+        self.length = length
+
+    def values(self):
+        # the filled part, a view without copying
+        return self.data[:self.length] if numpy is not None else self.data
+
+    def slice(self, start):
+        return self.data[start:self.length]
+
+    @property
+    def nbytes(self):
+        return self.data.nbytes if numpy is not None else self.data.itemsize * len(self.data)
+
+
+def count(values, size):
+    # how often each of 0..size-1 occurs in values
+    if numpy is not None:
+        return numpy.bincount(values, minlength=size)[:size].tolist()
+    counts = [0] * size
+    for value in values:
+        counts[value] += 1
+    return counts
+
+
+class ColumnarState(object):
+    """ Columns of the election state, kept in step with the chain by the registry """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            # wallet address <-> id
+            self.ids = {}
+            self.wallets = []
+            # per id: position of the block enrolling it as a voter and its place among the candidates, -1 for none
+            self.enrolled_in = Column('i')
+            self.candidate_position = Column('i')
+            # per block: timestamp and where its voters, candidates and votes start in the columns below
+            self.block_timestamps = Column('d')
+            self.block_voters = Column('i')
+            self.block_candidates = Column('i')
+            self.block_votes = Column('i')
+            # ids of the voters and candidates in the order they were enrolled
+            self.voters = Column('i')
+            self.candidates = Column('i')
+            # per vote: sender id, receiver id and block position
+            self.senders = Column('i')
+            self.receivers = Column('i')
+            self.vote_blocks = Column('i')
+
+    def intern(self, wallet_address):
+        wallet_id = self.ids.get(wallet_address)
+        if wallet_id is None:
+            wallet_id = self.ids[wallet_address] = len(self.wallets)
+            self.wallets.append(wallet_address)
+            self.enrolled_in.append(-1)
+            self.candidate_position.append(-1)
+        return wallet_id
+
+    def columns(self):
+        return [self.enrolled_in, self.candidate_position, self.block_timestamps, self.block_voters,
+                self.block_candidates, self.block_votes, self.voters, self.candidates, self.senders,
+                self.receivers, self.vote_blocks]
+
+    @property
+    def height(self):
+        return len(self.block_timestamps)
+
+    def apply_block(self, block):
+        with self.lock:
+            position = len(self.block_timestamps)
+            self.block_timestamps.append(block['timestamp'])
+            self.block_voters.append(len(self.voters))
+            self.block_candidates.append(len(self.candidates))
+            self.block_votes.append(len(self.senders))
+            for voter in block['voters']:
+                wallet_id = self.intern(voter['wallet_address'])
+                self.enrolled_in[wallet_id] = position
+                self.voters.append(wallet_id)
+            for candidate in block['candidates']:
+                wallet_id = self.intern(candidate['wallet_address'])
+                self.candidate_position[wallet_id] = len(self.candidates)
+                self.candidates.append(wallet_id)
+            for transaction in block['transactions']:
+                self.senders.append(self.intern(transaction['sender']))
+                self.receivers.append(self.intern(transaction['receiver']))
+                self.vote_blocks.append(position)
+
+    def revert_block(self, block):
+        # undoes the last apply_block. interned ids are kept, they cost nothing once unused
+        with self.lock:
+            position = len(self.block_timestamps) - 1
+            voters, candidates, votes = (int(column[position]) for column in (
+                self.block_voters, self.block_candidates, self.block_votes))
+            for wallet_id in list(self.voters.slice(voters)):
+                self.enrolled_in[wallet_id] = -1
+            for wallet_id in list(self.candidates.slice(candidates)):
+                self.candidate_position[wallet_id] = -1
+            self.voters.truncate(voters)
+            self.candidates.truncate(candidates)
+            for column in (self.senders, self.receivers, self.vote_blocks):
+                column.truncate(votes)
+            for column in (self.block_timestamps, self.block_voters, self.block_candidates, self.block_votes):
+                column.truncate(position)
+
+    def stats(self, window=None):
+        # tallies, turnout and audit figures of everything on the chain, with the votes per window
+        # seconds when a window is given
+        with self.lock:
+            voted = self.voted()
+            stats = {
+                'engine': 'numpy' if numpy is not None else 'array',
+                'height': self.height,
+                'voters': len(self.voters),
+                'candidates': len(self.candidates),
+                'votes': len(self.senders),
+                'turnout': voted / len(self.voters) if len(self.voters) else None,
+                'tallies': self.tallies(),
+                'turnout_by_block': self.turnout_by_block(),
+                'vote_times': self.vote_times(),
+                'audit': self.audit(),
+                'memory_bytes': sum(column.nbytes for column in self.columns()),
+            }
+            if window:
+                stats['turnout_by_window'] = self.turnout_by_window(window)
+        return stats
+
+    def voted(self):
+        # voters with at least one vote
+        if numpy is not None:
+            return int(numpy.unique(self.senders.values()).size)
+        return len(set(self.senders.values()))
+
+    def tallies(self):
+        counts = count(self.receivers.values(), len(self.wallets))
+        return [{'wallet_address': self.wallets[wallet_id], 'votes': counts[wallet_id]}
+                for wallet_id in self.candidates.values()]
+
+    def turnout_by_block(self):
+        counts = count(self.vote_blocks.values(), self.height)
+        turnout, cumulative = [], 0
+        for position, votes in enumerate(counts):
+            if votes:
+                cumulative += votes
+                turnout.append({'block': position + 1, 'votes': votes, 'cumulative': cumulative})
+        return turnout
+
+    def vote_timestamps(self):
+        # votes carry the time of the block sealing them, sorted
+        if numpy is not None:
+            return numpy.sort(self.block_timestamps.values()[self.vote_blocks.values()])
+        timestamps = self.block_timestamps.values()
+        return sorted(timestamps[position] for position in self.vote_blocks.values())
+
+    def vote_times(self):
+        timestamps = self.vote_timestamps()
+        if not len(timestamps):
+            return None
+        return {
+            'first': float(timestamps[0]),
+            'p50': float(percentile(timestamps, 0.5)),
+            'p90': float(percentile(timestamps, 0.9)),
+            'p99': float(percentile(timestamps, 0.99)),
+            'last': float(timestamps[-1]),
+        }
+
+    def turnout_by_window(self, window):
+        timestamps = self.vote_timestamps()
+        if not len(timestamps):
+            return []
+        start = float(timestamps[0])
+        if numpy is not None:
+            counts = numpy.bincount(((timestamps - start) // window).astype('int64')).tolist()
+        else:
+            counts = [0] * (int((timestamps[-1] - start) // window) + 1)
+            for timestamp in timestamps:
+                counts[int((timestamp - start) // window)] += 1
+        return [{'start': start + number * window, 'votes': votes} for number, votes in enumerate(counts) if votes]
+
+    def audit(self):
+        # cross-checks between the votes and the enrollments. on a chain the fork choice accepted all
+        # but voters_without_vote are zero, that one counts the voters who abstained so far
+        senders, receivers, blocks = self.senders.values(), self.receivers.values(), self.vote_blocks.values()
+        enrolled_in, candidate_position = self.enrolled_in.values(), self.candidate_position.values()
+        if numpy is not None:
+            sender_enrolled = enrolled_in[senders]
+            unknown_voters = int((sender_enrolled < 0).sum())
+            before_enrollment = int((sender_enrolled > blocks).sum())
+            unknown_candidates = int((candidate_position[receivers] < 0).sum())
+            has_voted = numpy.zeros(len(self.wallets), dtype=bool)
+            has_voted[senders] = True
+            without_vote = int((~has_voted[self.voters.values()]).sum())
+        else:
+            unknown_voters = sum(enrolled_in[sender] < 0 for sender in senders)
+            before_enrollment = sum(enrolled_in[sender] > block for sender, block in zip(senders, blocks))
+            unknown_candidates = sum(candidate_position[receiver] < 0 for receiver in receivers)
+            has_voted = set(senders)
+            without_vote = sum(voter not in has_voted for voter in self.voters.values())
+        return {
+            'votes_from_unknown_voters': unknown_voters,
+            'votes_before_enrollment': before_enrollment,
+            'votes_for_unknown_candidates': unknown_candidates,
+            'double_votes': len(senders) - self.voted(),
+            'voters_without_vote': without_vote,
+        }
@@ -0,0 +1,420 @@
+# compact, versioned binary encoding of blocks used for hashing, storage and peer transfer.
+# blocks stay plain dicts wherever the API shows them, the slotted classes below are their typed
+# form on the way to and from bytes. format version 3, big-endian integers and varint lengths:
+#
+#   header: u8 version | u32 index | f64 timestamp | u8 flags | previous hash | admin key | merkle root
+#   body:   voters | candidates | transactions
+#
+# the block hash covers the header only, the merkle root ties the body to it (see merkle.py).
+#
+# wallet addresses take the 20 bytes of the RIPEMD-160 digest behind the base58 text and public
+# keys are stored as DER. votes carry the voter's signature so any node can check them again.
+# values without the canonical shape are kept verbatim behind a tag byte,
+# so every dict survives the round trip unchanged.
+import base64
+import binascii
+import hashlib
+import struct
+
+import base58
+
+FORMAT_VERSION = 3
+
+HEADER = struct.Struct('>BIdB')
+RECORD_LENGTH = struct.Struct('>I')
+
+PEM_HEADER = '-----BEGIN PUBLIC KEY-----'
+PEM_FOOTER = '-----END PUBLIC KEY-----'
+
+# tags in front of values that have a compact form
+COMPACT = 0
+VERBATIM = 1
+NUMBER = 2
+MISSING = 3
+
+STARTED_VOTING = 1
+ENDED_VOTING = 2
+
+
+class Vote(object):
+    __slots__ = ('sender', 'receiver', 'signature')
+
+    def __init__(self, sender, receiver, signature=None):
+        self.sender = sender
+        self.receiver = receiver
+        # hex encoded, None for votes recorded without one
+        self.signature = signature
+
+    @classmethod
+    def from_dict(cls, vote):
+        return cls(vote['sender'], vote['receiver'], vote.get('signature'))
+
+    def to_dict(self):
+        vote = {'sender': self.sender, 'receiver': self.receiver}
+        if self.signature is not None:
+            vote['signature'] = self.signature
+        return vote
+
+
+class Voter(object):
+    __slots__ = ('wallet_address', 'public_key')
+
+    def __init__(self, wallet_address, public_key):
+        self.wallet_address = wallet_address
+        self.public_key = public_key
+
+    def to_dict(self):
+        return {'public_key': self.public_key, 'wallet_address': self.wallet_address}
+
+
+class Candidate(object):
+    __slots__ = ('wallet_address', 'name')
+
+    def __init__(self, wallet_address, name):
+        self.wallet_address = wallet_address
+        self.name = name
+
+    def to_dict(self):
+        return {'name': self.name, 'wallet_address': self.wallet_address}
+
+
+class Block(object):
+    __slots__ = ('index', 'timestamp', 'admin', 'previous_hash', 'started_voting', 'ended_voting',
+                 'merkle_root', 'voters', 'candidates', 'transactions')
+
+    def __init__(self, index, timestamp, admin, previous_hash, started_voting, ended_voting,
+                 merkle_root, voters, candidates, transactions):
+        self.index = index
+        self.timestamp = timestamp
+        self.admin = admin
+        self.previous_hash = previous_hash
+        self.started_voting = started_voting
+        self.ended_voting = ended_voting
+        self.merkle_root = merkle_root
+        self.voters = voters
+        self.candidates = candidates
+        self.transactions = transactions
+
+    @classmethod
+    def from_dict(cls, block):
+        return cls(block['index'], block['timestamp'], block['admin'], block['previous_hash'],
+                   block['started_voting'], block['ended_voting'], block['merkle_root'],
+                   [Voter(voter['wallet_address'], voter['public_key']) for voter in block['voters']],
+                   [Candidate(candidate['wallet_address'], candidate['name']) for candidate in block['candidates']],
+                   [Vote.from_dict(vote) for vote in block['transactions']])
+
+    def to_dict(self):
+        return {
+            'admin': self.admin,
+            'index': self.index,
+            'timestamp': self.timestamp,
+            'voters': [voter.to_dict() for voter in self.voters],
+            'candidates': [candidate.to_dict() for candidate in self.candidates],
+            'transactions': [vote.to_dict() for vote in self.transactions],
+            'previous_hash': self.previous_hash,
+            'started_voting': self.started_voting,
+            'ended_voting': self.ended_voting,
+            'merkle_root': self.merkle_root,
+        }
+
+
+def write_varint(out, value):
+    while value >= 0x80:
+        out.append(value & 0x7f | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def read_varint(data, position):
+    value = shift = 0
+    while True:
+        byte = data[position]
+        position += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, position
+        shift += 7
+
+
+def write_bytes(out, value):
+    write_varint(out, len(value))
+    out += value
+
+
+def read_bytes(data, position):
+    length, position = read_varint(data, position)
+    return bytes(data[position:position + length]), position + length
+
+
+def write_text(out, value):
+    write_bytes(out, value.encode('utf-8'))
+
+
+def read_text(data, position):
+    value, position = read_bytes(data, position)
+    return value.decode('utf-8'), position
+
+
+def address_bytes(address):
+    # the 20 byte digest behind a wallet address, None when the address is not a canonical one
+    try:
+        digest = binascii.unhexlify(base58.b58decode(address))
+    except (ValueError, binascii.Error):
+        return None
+    if len(digest) != 20 or base58.b58encode(binascii.hexlify(digest)).decode('utf-8') != address:
+        return None
+    return digest
+
+
+def write_address(out, address):
+    digest = address_bytes(address) if isinstance(address, str) else None
+    if digest is None:
+        out.append(VERBATIM)
+        write_text(out, str(address))
+    else:
+        out.append(COMPACT)
+        out += digest
+
+
+def read_address(data, position):
+    tag = data[position]
+    if tag == COMPACT:
+        digest = bytes(data[position + 1:position + 21])
+        return base58.b58encode(binascii.hexlify(digest)).decode('utf-8'), position + 21
+    return read_text(data, position + 1)
+
+
+def der_to_pem(der):
+    body = base64.b64encode(der).decode('ascii')
+    lines = [body[start:start + 64] for start in range(0, len(body), 64)]
+    return '\n'.join([PEM_HEADER] + lines + [PEM_FOOTER])
+
+
+def pem_to_der(pem):
+    # the DER bytes inside a PEM public key, None when they would not give back the same text
+    lines = pem.split('\n')
+    if len(lines) < 3 or lines[0] != PEM_HEADER or lines[-1] != PEM_FOOTER:
+        return None
+    try:
+        der = base64.b64decode(''.join(lines[1:-1]), validate=True)
+    except binascii.Error:
+        return None
+    return der if der_to_pem(der) == pem else None
+
+
+def write_key(out, pem):
+    der = pem_to_der(pem)
+    if der is None:
+        out.append(VERBATIM)
+        write_text(out, pem)
+    else:
+        out.append(COMPACT)
+        write_bytes(out, der)
+
+
+def read_key(data, position):
+    tag = data[position]
+    if tag == COMPACT:
+        der, position = read_bytes(data, position + 1)
+        return der_to_pem(der), position
+    return read_text(data, position + 1)
+
+
+def digest_bytes(value):
+    # the 32 bytes behind a lowercase sha256 hex digest, None for anything else
+    if not isinstance(value, str) or len(value) != 64:
+        return None
+    try:
+        digest = binascii.unhexlify(value)
+    except binascii.Error:
+        return None
+    return digest if binascii.hexlify(digest).decode('ascii') == value else None
+
+
+def write_hash(out, value):
+    # a sha256 hex digest, or the number the genesis block carries as previous hash
+    digest = digest_bytes(value)
+    if isinstance(value, int) and value >= 0:
+        out.append(NUMBER)
+        write_varint(out, value)
+    elif digest is not None:
+        out.append(COMPACT)
+        out += digest
+    else:
+        out.append(VERBATIM)
+        write_text(out, str(value))
+
+
+def read_hash(data, position):
+    tag = data[position]
+    if tag == NUMBER:
+        return read_varint(data, position + 1)
+    if tag == COMPACT:
+        return binascii.hexlify(data[position + 1:position + 33]).decode('ascii'), position + 33
+    return read_text(data, position + 1)
+
+
+def write_signature(out, value):
+    # a lowercase hex signature is stored as its bytes
+    try:
+        signature = binascii.unhexlify(value) if isinstance(value, str) else None
+    except binascii.Error:
+        signature = None
+    if value is None:
+        out.append(MISSING)
+    elif signature is not None and binascii.hexlify(signature).decode('ascii') == value:
+        out.append(COMPACT)
+        write_bytes(out, signature)
+    else:
+        out.append(VERBATIM)
+        write_text(out, str(value))
+
+
+def read_signature(data, position):
+    tag = data[position]
+    if tag == MISSING:
+        return None, position + 1
+    if tag == COMPACT:
+        signature, position = read_bytes(data, position + 1)
+        return binascii.hexlify(signature).decode('ascii'), position
+    return read_text(data, position + 1)
+
+
+def write_voter(out, voter: Voter):
+    write_address(out, voter.wallet_address)
+    write_key(out, voter.public_key)
+
+
+def read_voter(data, position):
+    wallet_address, position = read_address(data, position)
+    public_key, position = read_key(data, position)
+    return Voter(wallet_address, public_key), position
+
+
+def write_candidate(out, candidate: Candidate):
+    write_address(out, candidate.wallet_address)
+    write_text(out, candidate.name)
+
+
+def read_candidate(data, position):
+    wallet_address, position = read_address(data, position)
+    name, position = read_text(data, position)
+    return Candidate(wallet_address, name), position
+
+
+def write_vote(out, vote: Vote):
+    write_address(out, vote.sender)
+    write_address(out, vote.receiver)
+    write_signature(out, vote.signature)
+
+
+def read_vote(data, position):
+    sender, position = read_address(data, position)
+    receiver, position = read_address(data, position)
+    signature, position = read_signature(data, position)
+    return Vote(sender, receiver, signature), position
+
+
+# how each body list is written, in body order
+BODY = (
+    ('voters', write_voter, read_voter),
+    ('candidates', write_candidate, read_candidate),
+    ('transactions', write_vote, read_vote),
+)
+
+
+def encode_item(write, item) -> bytes:
+    out = bytearray()
+    write(out, item)
+    return bytes(out)
+
+
+def encode_header(block: Block) -> bytes:
+    flags = (STARTED_VOTING if block.started_voting else 0) | (ENDED_VOTING if block.ended_voting else 0)
+    out = bytearray(HEADER.pack(FORMAT_VERSION, block.index, block.timestamp, flags))
+    write_hash(out, block.previous_hash)
+    write_key(out, block.admin)
+    write_hash(out, block.merkle_root)
+    return bytes(out)
+
+
+def encode(block: Block) -> bytes:
+    out = bytearray(encode_header(block))
+    for name, write, _ in BODY:
+        items = getattr(block, name)
+        write_varint(out, len(items))
+        for item in items:
+            write(out, item)
+    return bytes(out)
+
+
+def decode(data):
+    # returns the block and the length of its header
+    version, index, timestamp, flags = HEADER.unpack_from(data)
+    if version != FORMAT_VERSION:
+        raise ValueError(f'unknown block format version {version}')
+    position = HEADER.size
+    previous_hash, position = read_hash(data, position)
+    admin, position = read_key(data, position)
+    merkle_root, position = read_hash(data, position)
+    header_length = position
+
+    body = {}
+    for name, _, read in BODY:
+        count, position = read_varint(data, position)
+        body[name] = []
+        for _ in range(count):
+            item, position = read(data, position)
+            body[name].append(item)
+
+    if position != len(data):
+        raise ValueError('trailing bytes after block')
+    block = Block(index, timestamp, admin, previous_hash, bool(flags & STARTED_VOTING), bool(flags & ENDED_VOTING),
+                  merkle_root, body['voters'], body['candidates'], body['transactions'])
+    # the hash is taken from these bytes, so only the one encoding of the block is accepted.
+    # anything else (unused flag bits, a verbatim value where a compact one belongs) would give
+    # the block another hash once it is encoded again
+    if encode(block) != data:
+        raise ValueError('block is not in canonical encoding')
+    return block, header_length
+
+
+def encode_block(block: dict) -> bytes:
+    return encode(Block.from_dict(block))
+
+
+def header_hash(block: dict) -> str:
+    # the block hash, the body only counts through the merkle root
+    header = Block(block['index'], block['timestamp'], block['admin'], block['previous_hash'],
+                   block['started_voting'], block['ended_voting'], block['merkle_root'], [], [], [])
+    return hashlib.sha256(encode_header(header)).hexdigest()
+
+
+def decode_block(data) -> dict:
+    # the dict view of an encoded block, with the hash of its header bytes filled in.
+    # raises ValueError for anything that is not an encoded block, cut off or garbled bytes included
+    try:
+        block, header_length = decode(data)
+    except (IndexError, struct.error) as error:
+        raise ValueError(f'not an encoded block: {error}') from error
+    block = block.to_dict()
+    block['hash'] = hashlib.sha256(data[:header_length]).hexdigest()
+    return block
+
+
+def write_record(out, data):
+    # framing used in the block log and on the wire: u32 length, then the encoded block
+    out += RECORD_LENGTH.pack(len(data))
+    out += data
+
+
+def read_records(data):
+    # yields the encoded blocks of a framed byte string, a cut off record at the end is ignored
+    position = 0
+    while position + RECORD_LENGTH.size <= len(data):
+        length, = RECORD_LENGTH.unpack_from(data, position)
+        end = position + RECORD_LENGTH.size + length
+        if end > len(data):
+            return
+        yield bytes(data[position + RECORD_LENGTH.size:end])
+        position = end
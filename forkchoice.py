@@ -0,0 +1,252 @@
+import binascii
+from collections import OrderedDict
+
+from transaction import Transaction
+
+
+class BranchView(object):
+    """ The registry as it stood at a fork point, with the blocks of a candidate branch applied on top
+
+    nothing is copied: lookups go to the live registry, minus what our blocks past the fork point added,
+    plus what the branch added so far.
+    """
+
+    def __init__(self, registry, abandoned):
+        self.registry = registry
+        self.removed_voters = set()
+        self.removed_candidates = set()
+        self.removed_votes = set()
+        for block in abandoned:
+            self.removed_voters.update(voter['wallet_address'] for voter in block['voters'])
+            self.removed_candidates.update(candidate['wallet_address'] for candidate in block['candidates'])
+            self.removed_votes.update(transaction['sender'] for transaction in block['transactions'])
+        self.voters = {}
+        self.candidates = set()
+        self.voted = set()
+
+    def voter(self, wallet_address):
+        voter = self.voters.get(wallet_address)
+        if voter is None and wallet_address not in self.removed_voters:
+            voter = self.registry.voters.get(wallet_address)
+        return voter
+
+    def is_candidate(self, wallet_address):
+        return wallet_address in self.candidates or (
+            wallet_address in self.registry.candidates and wallet_address not in self.removed_candidates)
+
+    def has_voted(self, wallet_address):
+        return wallet_address in self.voted or (
+            wallet_address in self.registry.voted and wallet_address not in self.removed_votes)
+
+    def enroll(self, block):
+        for voter in block['voters']:
+            self.voters[voter['wallet_address']] = voter
+        self.candidates.update(candidate['wallet_address'] for candidate in block['candidates'])
+
+
+class ForkChoice(object):
+    """ Picks the branch a node follows and moves its registry over to it
+
+    a branch is only taken when it wins over our chain, forks off at most max_reorg_depth blocks
+    below our tip and every block past the fork point checks out in full: hashes, merkle roots, the
+    voting flags, voter and candidate eligibility, one vote per voter and the vote signatures.
+    blocks of branches we left or did not take are kept by hash, so switching to them later only
+    downloads what is new.
+    """
+
+    def __init__(self, blockchain, max_reorg_depth=100, max_side_blocks=10000):
+        self.blockchain = blockchain
+        self.max_reorg_depth = max_reorg_depth
+        self.max_side_blocks = max_side_blocks
+        # hash -> block off our chain, oldest first
+        self.side_blocks = OrderedDict()
+        # height of the checkpoint we bootstrapped from, no branch forking below it is taken
+        self.final = 0
+
+        metrics = blockchain.metrics
+        metrics.gauge('forkchoice_side_blocks', 'Blocks kept from branches the node does not follow',
+                      function=lambda: len(self.side_blocks))
+        self.reorgs = metrics.counter('forkchoice_reorgs_total', 'Switches to a branch that replaced blocks')
+        self.reorg_depth = metrics.histogram('forkchoice_reorg_depth', 'Blocks replaced by a switch of branch',
+                                             buckets=(1, 2, 5, 10, 20, 50, 100, 500))
+        self.rejected = metrics.counter('forkchoice_rejected_branches_total', 'Branches that were not taken',
+                                        ('reason',))
+
+    def wins(self, length, tip_hash):
+        # a longer branch wins. between branches of the same length the lower tip hash wins,
+        # so nodes that sealed blocks at the same time still settle on one chain
+        chain = self.blockchain.chain
+        return length > len(chain) or (0 < length == len(chain) and tip_hash < chain[-1]['hash'])
+
+    def within_reach(self, fork):
+        # blocks up to a signed checkpoint are final, see checkpoint.py
+        return fork >= self.final and len(self.blockchain.chain) - fork <= self.max_reorg_depth
+
+    def remember(self, blocks):
+        for block in blocks:
+            self.side_blocks[block['hash']] = block
+            self.side_blocks.move_to_end(block['hash'])
+        while len(self.side_blocks) > self.max_side_blocks:
+            self.side_blocks.popitem(last=False)
+
+    def known_blocks(self, headers):
+        # the leading blocks of a branch, given by its headers, that we kept already
+        blocks = []
+        for header in headers:
+            block = self.side_blocks.get(header['hash'])
+            if block is None:
+                break
+            blocks.append(block)
+        return blocks
+
+    def check_branch(self, fork, blocks, hashed=False, chain=None):
+        # None when the blocks are a valid continuation of the first fork blocks of chain, ours by
+        # default, else the reason they are not
+        if chain is None:
+            chain = self.blockchain.chain
+        last_hash = chain[fork - 1]['hash'] if fork > 0 else None
+        if not self.blockchain.valid_suffix(blocks, last_hash, hashed):
+            return 'hash'
+
+        view = BranchView(self.blockchain.registry, chain[fork:])
+        previous = chain[fork - 1] if fork > 0 else None
+        admin = self.blockchain.admin.decode('utf-8') if fork > 0 else (blocks[0]['admin'] if blocks else None)
+        return self.check_blocks(fork, blocks, view, previous, admin)
+
+    def check_blocks(self, fork, blocks, view, previous, admin):
+        # the checks of check_branch past the hashes, for blocks following previous at position fork
+        # of a chain whose registry view gives as it stood before them
+        signatures = []
+        for position, block in enumerate(blocks, fork):
+            if block['index'] != position + 1 or block['admin'] != admin:
+                return 'header'
+            started = previous is not None and previous['started_voting']
+            ended = previous is not None and previous['ended_voting']
+            # the voting flags only ever go from unset to set, and voting ends after it started
+            if (started and not block['started_voting']) or (ended and not block['ended_voting']) or \
+                    (block['ended_voting'] and not block['started_voting']):
+                return 'flags'
+            # the block that starts voting still seals the enrollments queued before
+            if started and (block['voters'] or block['candidates']):
+                return 'enrollment'
+            for voter in block['voters']:
+                if view.voter(voter['wallet_address']) is not None:
+                    return 'enrollment'
+            for candidate in block['candidates']:
+                if view.is_candidate(candidate['wallet_address']):
+                    return 'enrollment'
+            view.enroll(block)
+
+            # the block that ends voting still seals the votes cast before
+            if block['transactions'] and (not block['started_voting'] or ended):
+                return 'vote'
+            for transaction in block['transactions']:
+                voter = view.voter(transaction['sender'])
+                if voter is None or not view.is_candidate(transaction['receiver']) or \
+                        view.has_voted(transaction['sender']):
+                    return 'vote'
+                try:
+                    signature = binascii.unhexlify(transaction.get('signature') or '')
+                except (binascii.Error, TypeError):
+                    return 'signature'
+                view.voted.add(transaction['sender'])
+                data = Transaction(transaction['sender'], transaction['receiver']).generate_data()
+                signatures.append((voter['public_key'], signature, data))
+            previous = block
+
+        # every signature of the branch in one batch, spread over the verifier's processes
+        with self.blockchain.metrics.track('verify_branch'):
+            if not all(self.blockchain.verifier.verify_batch(signatures)):
+                return 'signature'
+        return None
+
+    def switch(self, fork, blocks, hashed=True):
+        # makes the branch of blocks following our first fork blocks our chain if it wins.
+        # returns True when the chain changed
+        blockchain = self.blockchain
+        with blockchain.lock:
+            if not self.takes(fork, blocks, hashed):
+                return False
+            chain, head = blockchain.chain, self.head()
+        # the branch is checked, signatures and all, without the lock so votes keep coming in and
+        # blocks get sealed meanwhile. it is checked again under the lock only when our tip moved
+        reason = self.check_branch(fork, blocks, hashed, chain)
+        with blockchain.lock:
+            if blockchain.chain is not chain or self.head() != head:
+                if not self.takes(fork, blocks, hashed):
+                    return False
+                reason = self.check_branch(fork, blocks, hashed)
+            if reason is not None:
+                self.rejected.inc(reason=reason)
+                return False
+
+            abandoned = list(blockchain.chain[fork:])
+            if abandoned:
+                # roll the registry back to the fork point and forward onto the new blocks
+                for block in reversed(abandoned):
+                    blockchain.registry.revert_block(block)
+                if blockchain.store is not None:
+                    del blockchain.chain[fork:]
+                else:
+                    # a new list, readers still going through the old snapshot keep the replaced blocks.
+                    # a PartialChain is cut into a new one the same way
+                    blockchain.chain = blockchain.chain[:fork]
+                self.reorgs.inc()
+                self.reorg_depth.observe(len(abandoned))
+            for block in blocks:
+                self.side_blocks.pop(block['hash'], None)
+                blockchain.append_block(block)
+            if fork == 0:
+                blockchain.admin = blockchain.chain[0]['admin'].encode()
+            self.remember(abandoned)
+            blockchain.restore_voting_flags()
+            self.requeue(abandoned)
+            blockchain.publish()
+        return True
+
+    def takes(self, fork, blocks, hashed):
+        # the cheap checks of switch, done holding the lock
+        blockchain = self.blockchain
+        if not blocks or not self.wins(fork + len(blocks), blocks[-1]['hash']):
+            self.rejected.inc(reason='shorter')
+            if blockchain.valid_suffix(blocks, blockchain.chain[fork - 1]['hash'] if fork > 0 else None, hashed):
+                self.remember(blocks)
+            return False
+        if not self.within_reach(fork):
+            self.rejected.inc(reason='depth')
+            return False
+        return True
+
+    def head(self):
+        chain = self.blockchain.chain
+        return len(chain), chain[-1]['hash'] if len(chain) else None
+
+    def requeue(self, abandoned):
+        # what is pending or only was in the blocks we left goes into our next block,
+        # as far as the new branch does not have it already and would still take it
+        blockchain = self.blockchain
+        registry = blockchain.registry
+
+        voters, candidates = {}, {}
+        if not blockchain.started_voting:
+            for voter in [voter for block in abandoned for voter in block['voters']] + blockchain.voters:
+                if voter['wallet_address'] not in registry.voters:
+                    voters.setdefault(voter['wallet_address'], voter)
+            for candidate in [candidate for block in abandoned for candidate in block['candidates']] + \
+                    blockchain.candidates:
+                if candidate['wallet_address'] not in registry.candidates:
+                    candidates.setdefault(candidate['wallet_address'], candidate)
+        blockchain.voters = list(voters.values())
+        blockchain.candidates = list(candidates.values())
+
+        votes = {}
+        for transaction in [transaction for block in abandoned for transaction in block['transactions']] + \
+                blockchain.current_transactions:
+            sender = transaction['sender']
+            registry.pending.discard(sender)
+            if blockchain.started_voting and not blockchain.ended_voting and sender in registry.voters and \
+                    transaction['receiver'] in registry.candidates and sender not in registry.voted:
+                votes.setdefault(sender, transaction)
+        blockchain.current_transactions = list(votes.values())
+        for sender in votes:
+            registry.add_pending_vote(sender)
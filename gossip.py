@@ -0,0 +1,100 @@
+import threading
+from collections import OrderedDict
+
+import requests
+
+from encoding import decode_block, encode_block
+
+# what became of a block pushed by a peer
+ACCEPTED = 'accepted'
+DUPLICATE = 'duplicate'
+KNOWN = 'known'
+STALE = 'stale'
+REJECTED = 'rejected'
+
+
+class Gossip(object):
+    """ Pushes new blocks to the peers, which pass them on to theirs, every block once
+
+    a block that extends our tip is checked and appended on its own. one that leaves a gap, or belongs
+    to a better branch, makes us sync from the peer that sent it.
+    """
+
+    PATH = '/block/gossip'
+
+    def __init__(self, blockchain, max_seen=10000):
+        self.blockchain = blockchain
+        # hashes of the blocks received or sent recently, oldest first, so a block is never handled twice
+        self.seen = OrderedDict()
+        self.max_seen = max_seen
+        self.lock = threading.Lock()
+
+        metrics = blockchain.metrics
+        self.received = metrics.counter('gossip_blocks_received_total', 'Blocks pushed by peers', ('outcome',))
+        self.sent = metrics.counter('gossip_blocks_sent_total', 'Blocks pushed to peers')
+
+    def first_sight(self, block_hash):
+        # marks the block as seen, returns False when it was seen already
+        with self.lock:
+            if block_hash in self.seen:
+                self.seen.move_to_end(block_hash)
+                return False
+            self.seen[block_hash] = True
+            while len(self.seen) > self.max_seen:
+                self.seen.popitem(last=False)
+        return True
+
+    def publish(self, block, encoded=None, exclude=None):
+        # pushes a block to every healthy peer but the one it came from, without waiting for them
+        if encoded is None:
+            encoded = encode_block(block)
+        self.first_sight(block['hash'])
+        peers = self.blockchain.peers
+        headers = {'Content-Type': 'application/octet-stream'}
+        if self.blockchain.address is not None:
+            headers['X-Node-Address'] = self.blockchain.address
+        for address in peers.healthy():
+            if address != exclude:
+                self.sent.inc()
+                peers.executor.submit(peers.notify, address, 'POST', self.PATH, self.blockchain.NOTIFY_TIMEOUT,
+                                      {'data': encoded, 'headers': headers})
+
+    def receive(self, data, source=None):
+        # handles a block pushed by the node at source (host:port, None if it did not say).
+        # raises ValueError for data that is not an encoded block
+        block = decode_block(data)
+        outcome = self.handle(block, source)
+        self.received.inc(outcome=outcome)
+        if outcome == ACCEPTED:
+            # the bytes we got are the block's one encoding, unless a sync left another block on top
+            tip = self.blockchain.last_block
+            self.publish(tip, data if tip['hash'] == block['hash'] else None, exclude=source)
+        return outcome
+
+    def handle(self, block, source):
+        blockchain = self.blockchain
+        if not self.first_sight(block['hash']):
+            return DUPLICATE
+
+        with blockchain.lock:
+            height = len(blockchain.chain)
+            position = block['index'] - 1
+            if blockchain.first_held <= position < height and blockchain.chain[position]['hash'] == block['hash']:
+                return KNOWN
+            if not blockchain.forkchoice.wins(block['index'], block['hash']):
+                return STALE
+            if 0 < position == height and block['previous_hash'] == blockchain.last_block['hash']:
+                # the usual case: the block extends our tip and is all that has to be checked
+                return ACCEPTED if blockchain.forkchoice.switch(height, [block]) else REJECTED
+
+        # a gap or another branch, the blocks in between come from the sender when it is one of our peers
+        if source in blockchain.nodes:
+            try:
+                synced = blockchain.sync_from(source, block['index'])
+            except (requests.exceptions.RequestException, ValueError, KeyError):
+                synced = False
+            if synced and blockchain.producer.pending():
+                blockchain.producer.submit()
+        else:
+            synced = blockchain.resolve_conflicts()
+        return ACCEPTED if synced else REJECTED
@@ -0,0 +1,147 @@
+import queue
+import threading
+from collections import OrderedDict
+from uuid import uuid4
+
+QUEUED = 'queued'
+# verified and waiting in the next block
+PENDING = 'pending'
+COMMITTED = 'committed'
+REJECTED = 'rejected'
+
+
+class Ticket(object):
+    """ Progress of one vote handed to the ingest queue """
+
+    __slots__ = ('id', 'transaction', 'verified', 'status', 'message')
+
+    def __init__(self, transaction, verified=False):
+        self.id = uuid4().hex
+        self.transaction = transaction
+        # the signature was checked by a worker process already
+        self.verified = verified
+        self.status = QUEUED
+        self.message = None
+
+
+class IngestQueue(object):
+    """ Accepts votes after the cheap checks and lets a single committer thread verify and seal them in batches """
+
+    def __init__(self, blockchain, size=10000, batch_size=256, max_tickets=100000):
+        self.blockchain = blockchain
+        self.queue = queue.Queue(size)
+        # at most this many votes are verified and committed together
+        self.batch_size = batch_size
+        # finished tickets are forgotten oldest first once there are more than this
+        self.max_tickets = max_tickets
+        self.tickets = OrderedDict()
+        # senders with a vote in the queue, a second vote is turned away before it gets there
+        self.queued = set()
+        self.lock = threading.Lock()
+        self.thread = None
+
+        metrics = blockchain.metrics
+        metrics.gauge('ingest_queue_depth', 'Votes waiting for the committer', function=self.queue.qsize)
+        self.outcomes = metrics.counter('ingest_votes_total', 'Votes seen by the ingest queue', ('outcome',))
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name='ingest', daemon=True)
+                self.thread.start()
+
+    def stop(self):
+        with self.lock:
+            thread, self.thread = self.thread, None
+        if thread is not None:
+            self.queue.put(None)
+            thread.join()
+
+    def submit(self, transaction, verified=False):
+        # returns (ticket, None) when the vote was queued, (None, message) when it failed the cheap checks.
+        # raises queue.Full when the committer is too far behind
+        _, message = self.blockchain.check_transaction(transaction)
+        if message is not None:
+            self.outcomes.inc(outcome='invalid')
+            return None, message
+
+        ticket = Ticket(transaction, verified)
+        with self.lock:
+            if transaction.sender_address in self.queued:
+                self.outcomes.inc(outcome='duplicate')
+                return None, "This voter already has a vote queued"
+            try:
+                self.queue.put_nowait(ticket)
+            except queue.Full:
+                self.outcomes.inc(outcome='full')
+                raise
+            self.queued.add(transaction.sender_address)
+            self.tickets[ticket.id] = ticket
+            self.forget()
+        self.outcomes.inc(outcome='queued')
+        self.start()
+        return ticket, None
+
+    def forget(self):
+        while len(self.tickets) > self.max_tickets:
+            ticket_id, ticket = next(iter(self.tickets.items()))
+            if ticket.status == QUEUED:
+                return
+            del self.tickets[ticket_id]
+
+    def run(self):
+        while True:
+            ticket = self.queue.get()
+            if ticket is None:
+                return
+            batch = [ticket]
+            while len(batch) < self.batch_size:
+                try:
+                    ticket = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if ticket is None:
+                    self.queue.put(None)
+                    break
+                batch.append(ticket)
+            self.commit(batch)
+
+    def commit(self, batch):
+        try:
+            results = self.blockchain.new_transactions([ticket.transaction for ticket in batch],
+                                                       [ticket.verified for ticket in batch])
+        except Exception as error:
+            # the committer keeps going, the votes of this batch can be sent again
+            results = [(False, f'Could not commit the vote: {error}')] * len(batch)
+
+        with self.lock:
+            for ticket, (accepted, message) in zip(batch, results):
+                ticket.status = PENDING if accepted else REJECTED
+                ticket.message = message
+                self.queued.discard(ticket.transaction.sender_address)
+                self.outcomes.inc(outcome='accepted' if accepted else 'rejected')
+
+    def status(self, ticket_id):
+        # the ticket as shown to clients, None for unknown or forgotten tickets
+        with self.lock:
+            ticket = self.tickets.get(ticket_id)
+            if ticket is None:
+                return None
+            status, message = ticket.status, ticket.message
+
+        response = {'ticket': ticket_id, 'status': status}
+        if status == PENDING:
+            position = self.blockchain.registry.vote_blocks.get(ticket.transaction.sender_address)
+            if position is not None:
+                response.update(status=COMMITTED, block=position + 1)
+        if message is not None:
+            response['message'] = message
+        return response
+
+    def stats(self):
+        with self.lock:
+            return {
+                'depth': self.queue.qsize(),
+                'capacity': self.queue.maxsize,
+                'tickets': len(self.tickets),
+            }
@@ -0,0 +1,150 @@
+import multiprocessing
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import base58
+from Crypto.Hash import RIPEMD160, SHA256
+from Crypto.PublicKey import RSA
+
+
+def wallet_address(public_key: bytes) -> str:
+    # SHA-256 -> RIPEMD-160 -> base58 of the hex digests, the same derivation BlockChain.calculate_hash does
+    hash_1 = SHA256.new(public_key).hexdigest()
+    hash_2 = RIPEMD160.new(bytearray(hash_1, "utf-8")).hexdigest()
+    return base58.b58encode(hash_2).decode("utf-8")
+
+
+def generate_keypair(bits=2048):
+    # runs in the worker processes, so everything returned is plain bytes and strings
+    private_key = RSA.generate(bits)
+    public_key = private_key.publickey().export_key()
+    return private_key.export_key('PEM'), public_key, wallet_address(public_key)
+
+
+class KeyPool(object):
+    """ Keeps ready made keypairs with their wallet addresses so enrolment does not wait for RSA keygen """
+
+    def __init__(self, size=0, processes=None, refill_batch=16, refill_interval=0.1, bits=2048):
+        # with size 0 there is no background generation and every key is made on demand
+        self.size = size
+        self.processes = processes
+        # at most refill_batch keys are generated per round, rounds are refill_interval seconds apart
+        self.refill_batch = refill_batch
+        self.refill_interval = refill_interval
+        self.bits = bits
+
+        self.keys = deque()
+        self.condition = threading.Condition()
+        self.generated = 0
+        self.served = 0
+        # keys handed out while the pool was empty and had to be generated on the request path
+        self.exhausted = 0
+        self.running = False
+        self.thread = None
+        self.executor = None
+
+    def start(self):
+        if self.size <= 0 or self.running:
+            return self
+        self.running = True
+        # spawned workers do not inherit the locks and threads of the flask process
+        self.executor = ProcessPoolExecutor(max_workers=self.processes,
+                                            mp_context=multiprocessing.get_context('spawn'))
+        self.thread = threading.Thread(target=self.refill, name='keypool', daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.executor is not None:
+            self.executor.shutdown(cancel_futures=True)
+            self.executor = None
+
+    def refill(self):
+        while True:
+            with self.condition:
+                while self.running and len(self.keys) >= self.size:
+                    self.condition.wait()
+                if not self.running:
+                    return
+                missing = min(self.size - len(self.keys), self.refill_batch)
+
+            futures = [self.executor.submit(generate_keypair, self.bits) for _ in range(missing)]
+            for future in as_completed(futures):
+                if future.cancelled():
+                    continue
+                with self.condition:
+                    self.keys.append(future.result())
+                    self.generated += 1
+                    self.condition.notify_all()
+
+            with self.condition:
+                self.condition.wait(self.refill_interval)
+
+    def get(self):
+        # returns (private key object, public key PEM bytes, wallet address)
+        with self.condition:
+            if self.keys:
+                private_pem, public_key, wallet = self.keys.popleft()
+                self.condition.notify_all()
+            else:
+                private_pem = None
+                if self.size > 0:
+                    self.exhausted += 1
+            self.served += 1
+
+        if private_pem is None:
+            private_pem, public_key, wallet = generate_keypair(self.bits)
+        return RSA.import_key(private_pem), public_key, wallet
+
+    def get_many(self, count, window=64):
+        # yields count keypairs like get does: pooled ones first,
+        # the rest generated in parallel, at most window keys in flight at a time
+        with self.condition:
+            taken = [self.keys.popleft() for _ in range(min(count, len(self.keys)))]
+            if self.size > 0:
+                self.exhausted += count - len(taken)
+            self.served += count
+            self.condition.notify_all()
+
+        for private_pem, public_key, wallet in taken:
+            yield RSA.import_key(private_pem), public_key, wallet
+
+        remaining = count - len(taken)
+        if remaining <= 0:
+            return
+
+        executor = self.executor
+        if executor is None:
+            executor = ProcessPoolExecutor(max_workers=self.processes, mp_context=multiprocessing.get_context('spawn'))
+        try:
+            for start in range(0, remaining, window):
+                futures = [executor.submit(generate_keypair, self.bits) for _ in range(min(window, remaining - start))]
+                for future in as_completed(futures):
+                    private_pem, public_key, wallet = future.result()
+                    yield RSA.import_key(private_pem), public_key, wallet
+        finally:
+            if executor is not self.executor:
+                executor.shutdown(cancel_futures=True)
+
+    def wait_full(self, timeout=None):
+        with self.condition:
+            return self.condition.wait_for(lambda: len(self.keys) >= self.size, timeout)
+
+    def stats(self):
+        with self.condition:
+            return {
+                'size': self.size,
+                'available': len(self.keys),
+                'generated': self.generated,
+                'served': self.served,
+                'exhausted': self.exhausted,
+                'refill_batch': self.refill_batch,
+                'refill_interval': self.refill_interval,
+            }
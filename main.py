@@ -1,13 +1,47 @@
 from blockchain import *
+from flask import Response, g, stream_with_context
+from metrics import SamplingProfiler
+from peers import Link
+from time import perf_counter
+import os
+import queue
 
 # initiate the node
 app = Flask(__name__)
 # generate a globally unique address for this node
 node_identifier = str(uuid4()).replace('-', '')
+# switched on through /profiler/start, or PROFILE=1 when the node starts
+profiler = SamplingProfiler()
+# shared with the worker processes serving this node (see wsgi.py), votes they send along
+# with it had their signatures checked there already
+writer_token = None
+
+
+def verified_by_worker():
+    return writer_token is not None and request.headers.get('X-Writer-Token') == writer_token
+
+
+@app.before_request
+def start_request_timer():
+    g.request_started = perf_counter()
+
+
+@app.after_request
+def record_request(response):
+    # streamed responses are measured up to their first byte
+    started = g.pop('request_started', None)
+    if started is not None:
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        blockchain.metrics.histogram('http_request_seconds', 'Time spent handling requests',
+                                     ('method', 'route', 'status')).observe(
+            perf_counter() - started, method=request.method, route=route, status=response.status_code)
+    return response
 
 
 @app.route('/transaction/new', methods=['POST'])
 def new_transaction():
+    # the vote is only checked against the registry here and queued, the signature check and
+    # the commit happen on the ingest thread. progress is reported by /transaction/status/<ticket>
     values = request.get_json()
     required = ['signature', 'sender', 'receiver']
 
@@ -17,21 +51,92 @@ def new_transaction():
     if not blockchain.started_voting or blockchain.ended_voting:
         return 'Voting is not allowed now', 400
 
-    # create a new transaction
-    result, message = blockchain.new_transaction(
-        Transaction(values['sender'], values['receiver'], values['signature'])
-    )
+    try:
+        ticket, message = blockchain.ingest.submit(
+            Transaction(values['sender'], values['receiver'], values['signature']),
+            verified_by_worker(),
+        )
+    except queue.Full:
+        response = {
+            'error_message': 'Too many votes are waiting, try again later',
+        }
+        return jsonify(response), 429, {'Retry-After': '1'}
 
-    if result:
+    if ticket is None:
         response = {
-            'message': f'Transaction has been added to the blockchain',
+            'error_message': f'{message}',
         }
-        return jsonify(response, 200)
+        return jsonify(response), 400
 
     response = {
-        'error_message': f'{message}',
+        'message': 'Transaction has been queued',
+        'ticket': ticket.id,
+        'status': ticket.status,
     }
-    return jsonify(response, 500)
+    return jsonify(response), 202
+
+
+@app.route('/transaction/status/<ticket>', methods=['GET'])
+def transaction_status(ticket):
+    response = blockchain.ingest.status(ticket)
+    if response is None:
+        return 'Unknown ticket', 404
+    return jsonify(response), 200
+
+
+@app.route('/transaction/queue', methods=['GET'])
+def transaction_queue():
+    return jsonify(blockchain.ingest.stats()), 200
+
+@app.route('/transaction/batch', methods=['POST'])
+def new_transactions():
+    values = request.get_json()
+    required = ['signature', 'sender', 'receiver']
+
+    if not isinstance(values, list):
+        return 'Expected a list of transactions.', 400
+
+    if not blockchain.started_voting or blockchain.ended_voting:
+        return 'Voting is not allowed now', 400
+
+    # malformed items are rejected on their own, the rest of the batch still goes through
+    well_formed = [position for position, item in enumerate(values)
+                   if isinstance(item, dict) and all(k in item for k in required)]
+    results = blockchain.new_transactions([
+        Transaction(values[position]['sender'], values[position]['receiver'], values[position]['signature'])
+        for position in well_formed
+    ], [verified_by_worker()] * len(well_formed))
+
+    items = [{
+        'index': position,
+        'accepted': False,
+        'error_message': 'Missing values.',
+    } for position in range(len(values))]
+    for position, (result, message) in zip(well_formed, results):
+        items[position] = {
+            'index': position,
+            'sender': values[position]['sender'],
+            'accepted': result,
+            'error_message': message,
+        }
+
+    response = {
+        'accepted': sum(item['accepted'] for item in items),
+        'rejected': sum(not item['accepted'] for item in items),
+        'results': items,
+    }
+    return jsonify(response), 200
+
+
+@app.route('/transaction/proof/<wallet>', methods=['GET'])
+def transaction_proof(wallet):
+    # lets a voter check that their vote is on the chain without downloading it,
+    # see merkle.verify_proof for checking the answer
+    proof = blockchain.vote_proof(wallet)
+    if proof is None:
+        return 'No vote of this voter is on the chain', 404
+    return jsonify(proof), 200
+
 
 @app.route('/transaction/all', methods=['GET'])
 def get_all_transactions():
@@ -53,6 +158,8 @@ def new_candidate():
         values['name'],
         values['signature']
     )
+    if wallet == -1:
+        return 'Vote has already started, adding candidates is not allowed', 400
 
     response = {
         'wallet': wallet
@@ -66,7 +173,10 @@ def new_voter():
     if blockchain.started_voting:
         return 'Vote has already started, adding candidates is not allowed', 400
 
-    private_key, public_key, wallet = blockchain.new_voter()
+    voter = blockchain.new_voter()
+    if voter == -1:
+        return 'Vote has already started, adding voters is not allowed', 400
+    private_key, public_key, wallet = voter
 
     response = {
         'private_key': private_key.export_key('PEM').decode('utf-8'),
@@ -77,6 +187,44 @@ def new_voter():
     return jsonify(response)
 
 
+@app.route('/voter/batch', methods=['POST'])
+def new_voters():
+    values = request.get_json()
+
+    if values is None or not isinstance(values.get('count'), int) or values['count'] < 1:
+        return 'Missing values.', 400
+
+    if blockchain.started_voting:
+        return 'Vote has already started, adding voters is not allowed', 400
+
+    block_size = values.get('block_size', 100)
+    if not isinstance(block_size, int) or block_size < 1:
+        return 'block_size has to be a positive number', 400
+
+    def generate():
+        # one JSON document per line, written out block by block. the status is sent already,
+        # so a vote started part way ends the stream with an error line
+        try:
+            for private_key, public_key, wallet in blockchain.new_voters(values['count'], block_size):
+                yield json.dumps({
+                    'private_key': private_key.export_key('PEM').decode('utf-8'),
+                    'public_key': public_key,
+                    'wallet': wallet,
+                }) + '\n'
+        except VotingStarted as error:
+            yield json.dumps({'error': str(error)}) + '\n'
+
+    response = Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+    if values.get('download'):
+        response.headers['Content-Disposition'] = 'attachment; filename=voters.ndjson'
+    return response
+
+
+@app.route('/keypool', methods=['GET'])
+def key_pool():
+    return jsonify(blockchain.key_pool.stats()), 200
+
+
 @app.route('/startvote', methods=['POST'])
 def start_vote():
     values = request.get_json()
@@ -122,13 +270,71 @@ def end_vote():
 
 @app.route('/chain', methods=['GET'])
 def full_chain():
+    # blocks are streamed one at a time so memory does not grow with the chain.
+    # ?since=N&limit=M selects a page (M defaults to one sync page once since is given),
+    # ?format=ndjson or an Accept: application/x-ndjson header gives one block per line and
+    # ?format=binary the length prefixed binary encoding nodes use between each other
+    # one snapshot for the whole response, blocks sealed meanwhile are not mixed in
+    snapshot = blockchain.snapshot
+    length = snapshot.height
+    since = request.args.get('since', 0, type=int)
+    default_limit = BlockChain.SYNC_PAGE_SIZE if 'since' in request.args else length
+    limit = request.args.get('limit', default_limit, type=int)
+    until = min(length, since + limit)
+
+    if request.args.get('format') == 'binary':
+        return Response(blockchain.block_records(since, until, snapshot), mimetype='application/octet-stream')
+
+    ndjson = request.args.get('format') == 'ndjson' or \
+        request.accept_mimetypes.best == 'application/x-ndjson'
+    if ndjson:
+        return Response(blockchain.block_lines(since, until, snapshot), mimetype='application/x-ndjson')
+
+    def generate():
+        yield '{"length": %d, "since": %d, "chain": [' % (length, since)
+        for position, line in enumerate(blockchain.block_lines(since, until, snapshot)):
+            yield (b',' if position else b'') + line.rstrip(b'\n')
+        yield ']}'
+
+    return Response(generate(), mimetype='application/json')
+
+
+@app.route('/chain/head', methods=['GET'])
+def chain_head():
+    return jsonify(blockchain.chain_head()), 200
+
+
+@app.route('/chain/headers', methods=['GET'])
+def chain_headers():
+    since = request.args.get('since', 0, type=int)
+    # headers are built in memory, so a page is never more than a sync page
+    limit = min(request.args.get('limit', BlockChain.SYNC_PAGE_SIZE, type=int), BlockChain.SYNC_PAGE_SIZE)
+    snapshot = blockchain.snapshot
     response = {
-        'chain': blockchain.chain,
-        'length': len(blockchain.chain),
+        'headers': [blockchain.block_header(block) for block in snapshot.blocks(since, since + limit)],
+        'length': snapshot.height,
     }
     return jsonify(response), 200
 
 
+@app.route('/checkpoint', methods=['GET'])
+def checkpoint():
+    # the latest registry state signed with the admin key, a new node starts from it instead of genesis
+    data = blockchain.checkpoints.latest_json
+    if data is None:
+        return 'No signed checkpoint yet.', 404
+    return Response(data, mimetype='application/json')
+
+
+@app.route('/checkpoint/history', methods=['GET'])
+def checkpoint_history():
+    # how far the check of the blocks below the checkpoint we started from got
+    history = blockchain.checkpoints.history
+    if history is None:
+        return 'The node did not start from a checkpoint.', 404
+    return jsonify(history.to_dict()), 200
+
+
 @app.route('/nodes/register', methods=['POST'])
 def register_nodes():
     values = request.get_json()
@@ -151,72 +357,119 @@ def register_nodes():
 
     return jsonify(response), 201
 
+@app.route('/block/gossip', methods=['POST'])
+def receive_block():
+    # a block pushed by a peer, in the encoding of /chain?format=binary without the length prefix
+    try:
+        outcome = blockchain.gossip.receive(request.get_data(), request.headers.get('X-Node-Address'))
+    except ValueError:
+        return 'Not an encoded block.', 400
+
+    response = dict(blockchain.chain_head(), outcome=outcome)
+    return jsonify(response), 200
+
 @app.route('/miner/nodes/resolve', methods=['GET'])
 def consensus():
     # an attempt to resolve conflicts to reach the consensus
+    # only a short status is returned, callers can fetch /chain if they want the blocks
     conflicts = blockchain.resolve_conflicts()
 
+    response = dict(blockchain.chain_head(), replaced=conflicts)
     if (conflicts):
-        response = {
-            'message': 'Our chain was replaced.',
-            'new_chain': blockchain.chain,
-        }
+        response['message'] = 'Our chain was replaced.'
         return jsonify(response), 200
 
-    response = {
-        'message': 'Our chain is authoritative.',
-        'chain': blockchain.chain,
-    }
+    response['message'] = 'Our chain is authoritative.'
     return jsonify(response), 200
 
 @app.route('/candidate/results', methods=['GET'])
 def candidate_result():
-    print(blockchain.candidate_votes())
-    return jsonify(blockchain.candidate_votes())
-
-@app.route('/test', methods=['GET'])
-def test():
-    import time
-
-    candidate_wallet = "Candidate1"
-
-    transactions = set()
-    times = set()
-    for x in range(0, 1000):
-        start = time.time()
-        private_key, public_key, wallet_address = blockchain.new_voter()
-        end = time.time()
-        times.add(end - start)
-        transaction = Transaction(wallet_address, candidate_wallet)
-        transaction.sign(private_key)
-
-        transactions.add(transaction)
-
-    with open('TimeResult.txt', 'w') as f:
-        for item in times:
-            f.write("%s\n" % item)
-
-    blockchain.started_voting = True
-    times = set()
-    for transaction in transactions:
-        start = time.time()
-        blockchain.new_transaction(transaction)
-        end = time.time()
-        print(end - start)
-        times.add(end - start)
-
-    with open('TimeResult.txt', 'w') as f:
-        for item in times:
-            f.write("%s\n" % item)
-
-    print(blockchain.get_all_transactions())
-    response = {
-        'message': 'Results are returned',
-        'candidate_gotten_votes': blockchain.candidate_votes(),
-    }
+    etag, version, results = blockchain.candidate_results()
+    if etag in request.if_none_match:
+        return '', 304, {'ETag': f'"{etag}"'}
+
+    response = jsonify(results)
+    response.set_etag(etag)
+    response.headers['X-Tally-Version'] = str(version)
+    return response
+
+
+@app.route('/stats', methods=['GET'])
+def stats():
+    # tallies, turnout and audit figures from the columnar state, ?window=<seconds> adds the votes per window
+    window = request.args.get('window', type=float)
+    if window is not None and window <= 0:
+        return 'window has to be a positive number of seconds', 400
+
+    if blockchain.first_held:
+        return 'Statistics are back once the blocks below the checkpoint are checked', 503
+    response = blockchain.stats(window)
+    if response is None:
+        return 'Statistics are off, start the node with COLUMNAR=1', 404
     return jsonify(response), 200
 
 
+@app.route('/candidate/results/stream', methods=['GET'])
+def candidate_result_stream():
+    # server-sent events: the full results first, then one delta event per block with votes.
+    # whenever deltas cannot keep up or describe a change the full results are sent again
+    tallies = blockchain.registry.tallies
+    subscriber = tallies.subscribe()
+    subscriber.lagged = True
+
+    def event(name, data):
+        return f'event: {name}\ndata: {json.dumps(data)}\n\n'
+
+    def generate():
+        version = 0
+        try:
+            while True:
+                if subscriber.lagged:
+                    subscriber.lagged = False
+                    etag, version, results = blockchain.candidate_results()
+                    yield event('results', {'version': version, 'etag': etag, 'results': results})
+                try:
+                    delta = subscriber.deltas.get(timeout=15)
+                except queue.Empty:
+                    yield ': keep-alive\n\n'
+                    continue
+                # deltas already contained in the last full results are skipped
+                if delta['version'] > version:
+                    version = delta['version']
+                    yield event('delta', delta)
+        finally:
+            tallies.unsubscribe(subscriber)
+
+    return Response(generate(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    return Response(blockchain.metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/profiler', methods=['GET'])
+def profiler_report():
+    # collapsed stacks, ready for flamegraph.pl or speedscope
+    return Response(profiler.report(request.args.get('limit', type=int)), mimetype='text/plain')
+
+
+@app.route('/profiler/start', methods=['POST'])
+def profiler_start():
+    values = request.get_json(silent=True) or {}
+    if values.get('reset'):
+        profiler.reset()
+    try:
+        profiler.start(values.get('interval'))
+    except (TypeError, ValueError) as e:
+        return str(e), 400
+    return jsonify(profiler.status()), 200
+
+
+@app.route('/profiler/stop', methods=['POST'])
+def profiler_stop():
+    profiler.stop()
+    return jsonify(profiler.status()), 200
+
 
 if __name__ == '__main__':
     defPort = str(5000)
@@ -225,13 +478,60 @@ if __name__ == '__main__':
     if len(sys.argv) > 1:
         defPort = sys.argv[1]
 
-    nodes = set()
-    for x in range(5000,5003):
-        if defPort == str(x):
-            continue
-        nodes.add("localhost:" + str(x))
+    # PEERS lists the other nodes as host:port, comma separated. without it the
+    # neighbours are looked for on localhost:5000-5002
+    if 'PEERS' in os.environ:
+        nodes = {node for node in os.environ['PEERS'].split(',') if node}
+    else:
+        nodes = set()
+        for x in range(5000,5003):
+            if defPort == str(x):
+                continue
+            nodes.add("localhost:" + str(x))
     print(nodes)
 
-    blockchain = BlockChain(nodes)
+    # votes are batched into blocks of BLOCK_SIZE operations or sealed every BLOCK_INTERVAL seconds
+    block_size = int(os.environ.get('BLOCK_SIZE', 1))
+    block_interval = os.environ.get('BLOCK_INTERVAL')
+    if block_interval is not None:
+        block_interval = float(block_interval)
+
+    # with DATA_DIR set the chain is kept on disk and survives a restart
+    store = None
+    if 'DATA_DIR' in os.environ:
+        store = BlockStore(os.path.join(os.environ['DATA_DIR'], defPort))
+
+    # keypairs for /voter/new are generated ahead of time by KEY_POOL_PROCESSES worker processes
+    pool = KeyPool(
+        size=int(os.environ.get('KEY_POOL_SIZE', 64)),
+        bits=int(os.environ.get('KEY_BITS', 2048)),
+        processes=int(os.environ['KEY_POOL_PROCESSES']) if 'KEY_POOL_PROCESSES' in os.environ else None,
+        refill_batch=int(os.environ.get('KEY_POOL_REFILL_BATCH', 16)),
+        refill_interval=float(os.environ.get('KEY_POOL_REFILL_INTERVAL', 0.1)),
+    ).start()
+
+    # /transaction/new answers 429 once INGEST_QUEUE_SIZE votes are waiting to be committed.
+    # a longer chain from a peer replaces at most MAX_REORG_DEPTH of our blocks.
+    # COLUMNAR=1 keeps the columnar copy of the state that /stats answers from.
+    # every CHECKPOINT_INTERVAL blocks the state is checkpointed, BOOTSTRAP=0 syncs a new node from genesis
+    writer_token = os.environ.get('WRITER_TOKEN')
+    blockchain = BlockChain(nodes, block_size, block_interval, store,
+                            checkpoint_interval=int(os.environ.get('CHECKPOINT_INTERVAL', 1000)),
+                            key_pool=pool,
+                            admin_key_file=os.environ.get('ADMIN_KEY_FILE', 'private.pem'),
+                            ingest_queue_size=int(os.environ.get('INGEST_QUEUE_SIZE', 10000)),
+                            max_reorg_depth=int(os.environ.get('MAX_REORG_DEPTH', 100)),
+                            columnar=bool(os.environ.get('COLUMNAR')),
+                            bootstrap=os.environ.get('BOOTSTRAP', '1') != '0')
+
+    # NODE_ADDRESS is where the other nodes reach this one, they sync from it when a block it pushed leaves a gap
+    blockchain.address = os.environ.get('NODE_ADDRESS', f'localhost:{defPort}')
+
+    # LINKS simulates the network towards peers, {"host:port": {"latency": 0.05, "loss": 0.1}} (see cluster.py)
+    for address, conditions in json.loads(os.environ.get('LINKS', '{}')).items():
+        blockchain.peers.links[address] = Link(**conditions)
+
+    if os.environ.get('PROFILE'):
+        profiler.start(float(os.environ.get('PROFILE_INTERVAL', 0.01)))
 
     app.run(host='0.0.0.0', port=defPort)
\ No newline at end of file
@@ -0,0 +1,69 @@
+import hashlib
+
+from encoding import BODY, Candidate, Vote, Voter, encode_item
+
+# leaves and inner nodes are hashed with different prefixes so one can never pass for the other
+LEAF = b'\x00'
+NODE = b'\x01'
+
+# leaf kinds, in front of the encoded item so a voter record cannot pass for a vote
+KINDS = {'voters': b'V', 'candidates': b'C', 'transactions': b'T'}
+ITEMS = {
+    'voters': lambda item: Voter(item['wallet_address'], item['public_key']),
+    'candidates': lambda item: Candidate(item['wallet_address'], item['name']),
+    'transactions': Vote.from_dict,
+}
+
+
+def block_leaves(block):
+    # the encoded voters, candidates and transactions of a block, in that order
+    return [KINDS[name] + encode_item(write, ITEMS[name](item))
+            for name, write, _ in BODY for item in block[name]]
+
+
+def leaf_hash(leaf: bytes) -> bytes:
+    return hashlib.sha256(LEAF + leaf).digest()
+
+
+def node_hash(left: bytes, right: bytes) -> bytes:
+    return hashlib.sha256(NODE + left + right).digest()
+
+
+def levels(leaves):
+    # every level of the tree, leaf hashes first. an unpaired node moves up a level unchanged
+    level = [leaf_hash(leaf) for leaf in leaves]
+    tree = [level]
+    while len(level) > 1:
+        level = [node_hash(level[position], level[position + 1]) if position + 1 < len(level) else level[position]
+                 for position in range(0, len(level), 2)]
+        tree.append(level)
+    return tree
+
+
+def merkle_root(leaves) -> str:
+    if not leaves:
+        return hashlib.sha256(b'').hexdigest()
+    return levels(leaves)[-1][0].hex()
+
+
+def block_root(block) -> str:
+    return merkle_root(block_leaves(block))
+
+
+def merkle_proof(leaves, position):
+    # the sibling hashes from the leaf up to the root, each with the side it sits on
+    proof = []
+    for level in levels(leaves)[:-1]:
+        sibling = position ^ 1
+        if sibling < len(level):
+            proof.append({'side': 'left' if sibling < position else 'right', 'hash': level[sibling].hex()})
+        position //= 2
+    return proof
+
+
+def verify_proof(leaf: bytes, proof, root: str) -> bool:
+    current = leaf_hash(leaf)
+    for step in proof:
+        sibling = bytes.fromhex(step['hash'])
+        current = node_hash(sibling, current) if step['side'] == 'left' else node_hash(current, sibling)
+    return current.hex() == root
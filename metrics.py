@@ -0,0 +1,270 @@
+import functools
+import math
+import os
+import sys
+import threading
+from bisect import bisect_left
+from collections import Counter as Tally
+from contextlib import contextmanager
+from time import perf_counter
+
+# upper bounds in seconds, from a quick dict lookup up to a slow sync
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def format_labels(names, values):
+    if not names:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for value in values)
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(names, escaped)) + '}'
+
+
+def percentile(values, fraction):
+    # nearest rank percentile of sorted values, None when there are none
+    if not len(values):
+        return None
+    return values[max(1, math.ceil(fraction * len(values))) - 1]
+
+
+class Metric(object):
+    """ A named family of values, one per combination of label values """
+
+    kind = 'untyped'
+
+    def __init__(self, name, documentation, labels=(), function=None):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        # read at render time instead of being updated. returns the value, or with labels
+        # a dict of label value tuples to values
+        self.function = function
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def key(self, labels):
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def value(self, **labels):
+        with self.lock:
+            return self.values.get(self.key(labels), 0)
+
+    def samples(self):
+        # (name, label names, label values, value) in the order they are rendered
+        if self.function is not None:
+            values = self.function()
+            if not self.labels:
+                values = {(): values}
+        else:
+            with self.lock:
+                values = dict(self.values)
+        for key, value in sorted(values.items()):
+            yield self.name, self.labels, key, value
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[self.key(labels)] = value
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            counts = self.values.get(key)
+            if counts is None:
+                # one count per bucket plus +Inf, then the sum
+                counts = self.values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[bisect_left(self.buckets, value)] += 1
+            counts[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(perf_counter() - start, **labels)
+
+    def value(self, **labels):
+        # (count, sum) of the observations
+        with self.lock:
+            counts = self.values.get(self.key(labels))
+        if counts is None:
+            return 0, 0.0
+        return sum(counts[:-1]), counts[-1]
+
+    def samples(self):
+        with self.lock:
+            values = {key: list(counts) for key, counts in self.values.items()}
+        for key, counts in sorted(values.items()):
+            total = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                total += count
+                yield self.name + '_bucket', self.labels + ('le',), key + (format_value(float(bound)),), total
+            yield self.name + '_sum', self.labels, key, counts[-1]
+            yield self.name + '_count', self.labels, key, total
+
+
+class Metrics(object):
+    """ Registry of the metrics of one node, rendered in the Prometheus text format """
+
+    def __init__(self):
+        self.families = {}
+        self.lock = threading.Lock()
+        self.operations = self.histogram('blockchain_operation_seconds', 'Time spent in BlockChain operations',
+                                         ('operation',))
+        self.errors = self.counter('blockchain_operation_errors_total', 'BlockChain operations that raised',
+                                   ('operation',))
+
+    def add(self, cls, name, *args, **kwargs):
+        # returns the family registered under name, creating it on first use
+        with self.lock:
+            metric = self.families.get(name)
+            if metric is None:
+                metric = self.families[name] = cls(name, *args, **kwargs)
+        return metric
+
+    def counter(self, name, documentation, labels=(), function=None) -> Counter:
+        return self.add(Counter, name, documentation, labels, function)
+
+    def gauge(self, name, documentation, labels=(), function=None) -> Gauge:
+        return self.add(Gauge, name, documentation, labels, function)
+
+    def histogram(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS) -> Histogram:
+        return self.add(Histogram, name, documentation, labels, buckets)
+
+    @contextmanager
+    def track(self, operation):
+        with self.operations.time(operation=operation):
+            try:
+                yield
+            except Exception:
+                self.errors.inc(operation=operation)
+                raise
+
+    def render(self):
+        with self.lock:
+            families = sorted(self.families.values(), key=lambda metric: metric.name)
+        lines = []
+        for metric in families:
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            for name, label_names, label_values, value in metric.samples():
+                lines.append(f'{name}{format_labels(label_names, label_values)} {format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+def timed(method):
+    # records the duration and the errors of a method of an object with a metrics registry
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.metrics.track(method.__name__):
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+class SamplingProfiler(object):
+    """ Samples the stack of every thread at a fixed interval while it is switched on """
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        # collapsed stacks, outermost frame first, as flame graph tools read them
+        self.stacks = Tally()
+        self.samples = 0
+        self.thread = None
+        self.stopped = threading.Event()
+        self.lock = threading.Lock()
+
+    @property
+    def running(self):
+        return self.thread is not None
+
+    def start(self, interval=None):
+        # the interval is checked here, a bad one would only fail inside the sampling thread
+        if interval is not None:
+            interval = float(interval)
+            if not 0 < interval < math.inf:
+                raise ValueError('the sampling interval must be a positive number of seconds')
+        with self.lock:
+            if self.thread is not None:
+                return False
+            if interval is not None:
+                self.interval = interval
+            self.stopped.clear()
+            self.thread = threading.Thread(target=self.run, name='profiler', daemon=True)
+            self.thread.start()
+        return True
+
+    def stop(self):
+        with self.lock:
+            thread, self.thread = self.thread, None
+            if thread is None:
+                return False
+            self.stopped.set()
+        thread.join()
+        return True
+
+    def reset(self):
+        with self.lock:
+            self.stacks = Tally()
+            self.samples = 0
+
+    def run(self):
+        own = threading.get_ident()
+        while not self.stopped.wait(self.interval):
+            frames = sys._current_frames()
+            with self.lock:
+                for thread_id, frame in frames.items():
+                    if thread_id != own:
+                        self.stacks[self.collapse(frame)] += 1
+                self.samples += 1
+
+    @staticmethod
+    def collapse(frame):
+        names = []
+        while frame is not None:
+            code = frame.f_code
+            names.append(f'{os.path.basename(code.co_filename)}:{code.co_name}')
+            frame = frame.f_back
+        return ';'.join(reversed(names))
+
+    def status(self):
+        with self.lock:
+            return {
+                'running': self.thread is not None,
+                'interval': self.interval,
+                'samples': self.samples,
+                'stacks': len(self.stacks),
+            }
+
+    def report(self, limit=None):
+        # one "stack count" line per distinct stack, most frequent first
+        with self.lock:
+            stacks = self.stacks.most_common(limit)
+        return ''.join(f'{stack} {count}\n' for stack, count in stacks)
@@ -0,0 +1,158 @@
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+from time import perf_counter, sleep, time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class Peer(object):
+    """ Keep-alive session and health state for a single node """
+
+    def __init__(self, address, pool_size):
+        self.address = address
+        self.session = requests.Session()
+        self.session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=pool_size))
+        self.failures = 0
+        # response bytes received from the peer
+        self.received = 0
+        # the peer is skipped until this time after failing
+        self.retry_at = 0
+
+    def healthy(self):
+        return time() >= self.retry_at
+
+
+class Link(object):
+    """ Simulated network conditions on the way to one peer, see cluster.py """
+
+    def __init__(self, latency=0, jitter=0, loss=0):
+        # seconds added to every request, plus up to jitter more
+        self.latency = latency
+        self.jitter = jitter
+        # share of the requests that are lost, 1 cuts the link
+        self.loss = loss
+
+    def apply(self):
+        # delays the request and raises like a failed connection when it gets lost
+        delay = self.latency + random.uniform(0, self.jitter)
+        if delay > 0:
+            sleep(delay)
+        if self.loss and random.random() < self.loss:
+            raise requests.exceptions.ConnectionError('request lost on a simulated link')
+
+
+class PeerPool(object):
+    """ Talks to the other nodes in parallel over pooled connections, keeping failing nodes off the hot path """
+
+    def __init__(self, addresses=(), timeout=2, max_workers=8, backoff=1, max_backoff=60, metrics=None):
+        self.timeout = timeout
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.max_workers = max_workers
+        self.peers = {}
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='peers')
+        self.metrics = metrics
+        # address -> Link, only set when simulating a network
+        self.links = {}
+        if metrics is not None:
+            self.latency = metrics.histogram('peer_request_seconds', 'Requests to other nodes', ('peer', 'path'))
+            self.errors = metrics.counter('peer_request_errors_total', 'Failed requests to other nodes', ('peer',))
+            self.received = metrics.counter('peer_received_bytes_total', 'Response bytes from other nodes', ('peer',))
+            metrics.gauge('peers_healthy', 'Nodes not backed off after failures', function=lambda: len(self.healthy()))
+        for address in addresses:
+            self.add(address)
+
+    def stop(self):
+        # requests under way finish, the queued ones are dropped and new ones refused until start
+        self.executor.shutdown(wait=True, cancel_futures=True)
+
+    def start(self):
+        # after stop
+        self.executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='peers')
+
+    def add(self, address):
+        with self.lock:
+            if address not in self.peers:
+                self.peers[address] = Peer(address, self.max_workers)
+
+    def healthy(self):
+        with self.lock:
+            return [peer.address for peer in self.peers.values() if peer.healthy()]
+
+    def status(self):
+        with self.lock:
+            return {peer.address: {
+                'healthy': peer.healthy(),
+                'failures': peer.failures,
+                'received': peer.received,
+            } for peer in self.peers.values()}
+
+    def request(self, address, method, path, timeout=None, check_status=True, route=None, **kwargs):
+        # with check_status an error status raises like a failed connection does,
+        # otherwise the response is returned whatever its status.
+        # route labels the request in the metrics instead of the path, for paths carrying ids
+        self.add(address)
+        peer = self.peers[address]
+        link = self.links.get(address)
+        start = perf_counter()
+        try:
+            if link is not None:
+                link.apply()
+            response = peer.session.request(method, f'http://{address}{path}', timeout=timeout or self.timeout, **kwargs)
+            if check_status:
+                response.raise_for_status()
+        except requests.exceptions.RequestException:
+            self.failed(peer)
+            if self.metrics is not None:
+                self.errors.inc(peer=address)
+            raise
+        finally:
+            if self.metrics is not None:
+                self.latency.observe(perf_counter() - start, peer=address, path=route or path)
+        # streamed bodies are not read here, they are left to the caller
+        if not kwargs.get('stream'):
+            peer.received += len(response.content)
+            if self.metrics is not None:
+                self.received.inc(len(response.content), peer=address)
+        self.succeeded(peer)
+        return response
+
+    def get_json(self, address, path, timeout=None, **params):
+        return self.request(address, 'GET', path, timeout=timeout, params=params).json()
+
+    def succeeded(self, peer):
+        peer.failures = 0
+        peer.retry_at = 0
+
+    def failed(self, peer):
+        # exponential backoff, the peer is left out of fan-outs until it is due for a retry
+        peer.failures += 1
+        peer.retry_at = time() + min(self.backoff * 2 ** (peer.failures - 1), self.max_backoff)
+
+    def map(self, function, addresses=None):
+        # runs function(address) for every healthy peer in parallel.
+        # returns address -> result, or the raised exception for peers that failed
+        if addresses is None:
+            addresses = self.healthy()
+        futures = {address: self.executor.submit(function, address) for address in addresses}
+        wait(futures.values())
+
+        results = {}
+        for address, future in futures.items():
+            error = future.exception()
+            results[address] = error if error is not None else future.result()
+        return results
+
+    def broadcast(self, method, path, timeout=None, **kwargs):
+        # fire and forget notification of every healthy peer, failures only count against the peer's health
+        for address in self.healthy():
+            self.executor.submit(self.notify, address, method, path, timeout, kwargs)
+
+    def notify(self, address, method, path, timeout, kwargs):
+        try:
+            self.request(address, method, path, timeout=timeout, **kwargs)
+        except requests.exceptions.RequestException:
+            pass
@@ -0,0 +1,60 @@
+import threading
+from time import time
+
+
+class BlockProducer(object):
+    """ Decides when the pending voters, candidates and votes get sealed into a block """
+
+    def __init__(self, blockchain, block_size=1, interval=None):
+        self.blockchain = blockchain
+        # seal as soon as this many operations are waiting
+        self.block_size = block_size
+        # seconds after which a non empty batch is sealed even if it is not full
+        self.interval = interval
+        self.last_sealed = time()
+        self.timer = None
+
+    def pending(self):
+        blockchain = self.blockchain
+        return len(blockchain.current_transactions) + len(blockchain.voters) + len(blockchain.candidates)
+
+    def submit(self):
+        # called after an operation was queued, seals the block when it is full or overdue
+        with self.blockchain.lock:
+            overdue = self.interval is not None and time() - self.last_sealed >= self.interval
+            if self.pending() >= self.block_size or overdue:
+                return self.seal()
+            self.schedule()
+        return None
+
+    def flush(self):
+        # explicit seal used by admin actions, produces a block even when nothing is pending
+        with self.blockchain.lock:
+            return self.seal()
+
+    def seal(self):
+        self.cancel()
+        block = self.blockchain.mine()
+        self.last_sealed = time()
+        return block
+
+    def schedule(self):
+        if self.interval is None or self.timer is not None:
+            return
+        self.timer = threading.Timer(self.interval, self.on_timer)
+        self.timer.daemon = True
+        self.timer.start()
+
+    def cancel(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+    def on_timer(self):
+        with self.blockchain.lock:
+            if self.timer is not threading.current_thread():
+                # a seal already happened while we were waiting for the lock
+                return
+            self.timer = None
+            if self.pending() > 0:
+                self.seal()
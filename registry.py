@@ -0,0 +1,119 @@
+from tally import TallyEngine
+
+
+class Registry(object):
+    """ In-memory index of voters, candidates and votes kept in step with the chain """
+
+    def __init__(self):
+        # candidate wallet_address -> number of votes received, outlives resets so listeners stay subscribed
+        self.tallies = TallyEngine()
+        # senders whose vote is queued but not sealed into a block yet
+        self.pending = set()
+        # optional ColumnarState for /stats, kept in step with the indexes below
+        self.columns = None
+        self.reset()
+
+    def reset(self, tallies=None):
+        # wallet_address -> voter record as stored in the block
+        self.voters = {}
+        # wallet addresses that already have a vote on the chain
+        self.voted = set()
+        # wallet_address -> candidate record as stored in the block
+        self.candidates = {}
+        # the lists below are only ever appended to, or replaced by a shorter copy when a block is reverted,
+        # so a reader holding a list and its length keeps seeing the same records
+        self.voter_records = []
+        self.candidate_records = []
+        self.transactions = []
+        # voter wallet_address -> position of the block holding the vote. entries are only added,
+        # a revert swaps in a copy without them, so readers of the old dict are not affected
+        self.vote_blocks = {}
+        self.tallies.reset(tallies)
+        if self.columns is not None:
+            self.columns.reset()
+
+    def apply_block(self, block):
+        # fold a newly appended block into the indexes
+        for voter in block['voters']:
+            self.voters[voter['wallet_address']] = voter
+            self.voter_records.append(voter)
+        for candidate in block['candidates']:
+            self.candidates[candidate['wallet_address']] = candidate
+            self.candidate_records.append(candidate)
+        for transaction in block['transactions']:
+            self.voted.add(transaction['sender'])
+            self.pending.discard(transaction['sender'])
+            self.vote_blocks[transaction['sender']] = block['index'] - 1
+            self.transactions.append(transaction)
+        self.tallies.apply_block(block)
+        if block['candidates']:
+            self.tallies.changed()
+        if self.columns is not None:
+            self.columns.apply_block(block)
+
+    def revert_block(self, block):
+        # undoes apply_block, blocks have to be reverted newest first
+        if block['transactions']:
+            self.vote_blocks = dict(self.vote_blocks)
+        for voter in block['voters']:
+            self.voters.pop(voter['wallet_address'], None)
+        for candidate in block['candidates']:
+            self.candidates.pop(candidate['wallet_address'], None)
+        for transaction in block['transactions']:
+            self.voted.discard(transaction['sender'])
+            self.vote_blocks.pop(transaction['sender'], None)
+        self.voter_records = self.voter_records[:len(self.voter_records) - len(block['voters'])]
+        self.candidate_records = self.candidate_records[:len(self.candidate_records) - len(block['candidates'])]
+        self.transactions = self.transactions[:len(self.transactions) - len(block['transactions'])]
+        self.tallies.revert_block(block)
+        if block['candidates']:
+            self.tallies.changed()
+        if self.columns is not None:
+            self.columns.revert_block(block)
+
+    def rebuild(self, chain):
+        # used when the whole chain gets replaced, queued votes stay queued
+        self.reset()
+        for block in chain:
+            self.apply_block(block)
+
+    def state(self):
+        # plain data snapshot of the indexes, used for checkpoints
+        return {
+            'voters': list(self.voters.values()),
+            'voted': list(self.voted),
+            'candidates': list(self.candidates.values()),
+            'tallies': dict(self.tallies.counts),
+            'transactions': self.transactions,
+            'vote_blocks': self.vote_blocks,
+        }
+
+    def load_state(self, state):
+        self.reset(state['tallies'])
+        self.voters = {voter['wallet_address']: voter for voter in state['voters']}
+        self.voted = set(state['voted'])
+        self.candidates = {candidate['wallet_address']: candidate for candidate in state['candidates']}
+        self.voter_records = list(state['voters'])
+        self.candidate_records = list(state['candidates'])
+        self.transactions = list(state['transactions'])
+        self.vote_blocks = dict(state['vote_blocks'])
+
+    def add_pending_vote(self, wallet_address):
+        self.pending.add(wallet_address)
+
+    def has_voted(self, wallet_address):
+        return wallet_address in self.voted or wallet_address in self.pending
+
+    def all_voters(self):
+        return [dict(voter, voted=wallet in self.voted) for wallet, voter in self.voters.items()]
+
+    def all_candidates(self):
+        return list(self.candidates.values())
+
+    def candidate_votes(self):
+        return [dict(candidate, votes=self.tallies[wallet]) for wallet, candidate in self.candidates.items()]
+
+    def results(self):
+        # (etag, results) taken together so the tag always matches the numbers
+        with self.tallies.lock:
+            return self.tallies.etag, self.tallies.version, self.candidate_votes()
@@ -0,0 +1,221 @@
+import json
+import os
+import queue
+import threading
+from time import sleep, time
+
+import requests
+
+from blockchain import BlockChain
+from checkpoint import Checkpoints, PartialChain
+from columnar import ColumnarState
+from peers import PeerPool
+from storage import BlockStore
+
+
+class ForwardedTicket(object):
+    """ Ticket handed out by the writer for a vote a worker passed on """
+
+    def __init__(self, id, status):
+        self.id = id
+        self.status = status
+
+
+class ForwardingIngest(object):
+    """ Stands in for the ingest queue in a worker: votes are checked here and queued on the writer """
+
+    def __init__(self, replica):
+        self.replica = replica
+
+    def submit(self, transaction, verified=False):
+        # same contract as IngestQueue.submit, the signature is checked here so the writer does not have to
+        result = self.replica.verify_transactions([transaction])[0]
+        if result is not None:
+            return None, result[1]
+
+        try:
+            response = self.replica.forward('POST', '/transaction/new', json={
+                'sender': transaction.sender_address,
+                'receiver': transaction.receiver_address,
+                'signature': transaction.signature,
+            })
+        except requests.exceptions.RequestException as error:
+            return None, f'Could not reach the writer: {error}'
+        if response.status_code == 429:
+            raise queue.Full
+        values = response.json()
+        if response.status_code != 202:
+            return None, values.get('error_message')
+        return ForwardedTicket(values['ticket'], values['status']), None
+
+    def status(self, ticket_id):
+        response = self.replica.forward('GET', f'/transaction/status/{ticket_id}', route='/transaction/status/<ticket>')
+        return response.json() if response.status_code == 200 else None
+
+    def stats(self):
+        return self.replica.forward('GET', '/transaction/queue').json()
+
+
+class Replica(BlockChain):
+    """ Read-only copy of a node's chain for the worker processes serving it
+
+    the blocks are read from the block store the writer process keeps on disk, memory mapped
+    and shared through the page cache. votes are checked, signatures included, in the worker and
+    passed on to the writer, which is the only process that seals blocks.
+    while the writer checks the history below a checkpoint it bootstrapped from, its chain is in
+    the partial store next to its own and the replica follows that one, see Checkpoints.save_partial.
+    """
+
+    def __init__(self, path, writer, token=None, refresh_interval=0.05, timeout=30, wait=30, columnar=False):
+        self.path = path
+        # the checkpoint the writer bootstrapped from while we follow its partial store, None otherwise
+        self.bootstrap = None
+        # the columns are set aside while following a partial store, as on the writer
+        self.columns = ColumnarState() if columnar else None
+        # waits up to wait seconds for the writer to create the store and its genesis block
+        deadline = time() + wait
+        while True:
+            store = self.open_store()
+            if store is not None:
+                break
+            if time() >= deadline:
+                raise RuntimeError(f'no chain to follow in {path}')
+            sleep(0.1)
+
+        # bootstrapping and resuming are left to the writer, the replica only reads what it wrote
+        super().__init__(set(), store=store, ingest_queue_size=1, bootstrap=False)
+        self.writer = writer
+        self.token = token
+        self.refresh_interval = refresh_interval
+        self.writer_pool = PeerPool([writer], timeout=timeout, metrics=self.metrics)
+        self.ingest = ForwardingIngest(self)
+        self.tip = bytes(store.raw(-1))
+        self.thread = None
+        self.publish()
+
+    def publish(self):
+        super().publish()
+        # every worker has to hand out the same tag for the same results,
+        # they come from the chain alone since votes are only counted once sealed
+        self.snapshot.etag = self.snapshot.head['hash'][:16]
+
+    def start(self):
+        # the refresh thread is started after the fork, in the worker that uses it
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.follow, name='replica', daemon=True)
+            self.thread.start()
+
+    def follow(self):
+        # whatever goes wrong, the next refresh tries again, the thread must not die with the old chain
+        while True:
+            try:
+                self.refresh()
+            except Exception as error:
+                print('replica refresh failed', repr(error))
+            sleep(self.refresh_interval)
+
+    def open_store(self):
+        # the store holding the writer's chain, None when it holds no block yet. sets bootstrap
+        partial = os.path.join(self.path, Checkpoints.PARTIAL)
+        try:
+            with open(os.path.join(partial, Checkpoints.BOOTSTRAP)) as f:
+                bootstrap = json.load(f)
+            store = BlockStore(partial, readonly=True)
+        except (OSError, ValueError):
+            bootstrap = None
+            try:
+                store = BlockStore(self.path, readonly=True)
+            except FileNotFoundError:
+                return None
+        if len(store) == 0:
+            store.close()
+            return None
+        self.bootstrap = bootstrap
+        return store
+
+    def bootstrapping(self):
+        return os.path.exists(os.path.join(self.path, Checkpoints.PARTIAL, Checkpoints.BOOTSTRAP))
+
+    def load_state(self):
+        if self.bootstrap is None:
+            self.chain = self.store
+            self.registry.columns = self.columns
+            super().load_state()
+            return
+        # the writer's chain from the checkpoint on, as Checkpoints.adopt sets it up
+        checkpoint = self.bootstrap['checkpoint']
+        self.chain = PartialChain(checkpoint['height'] - 1, self.store)
+        self.registry.columns = None
+        self.registry.load_state(checkpoint['state'])
+        for block in self.store[1:]:
+            self.registry.apply_block(block)
+        self.admin = self.bootstrap['genesis']['admin'].encode()
+        self.forkchoice.final = checkpoint['height']
+        self.restore_voting_flags()
+        self.publish()
+
+    def refresh(self):
+        # picks up what the writer appended. when it replaced blocks we already had, the registry
+        # is loaded again from the checkpoint. returns True when there was anything new
+        with self.lock:
+            if self.bootstrapping() != (self.bootstrap is not None):
+                # the writer started from a checkpoint or is done checking the history below it.
+                # the old store is not closed, snapshots may still read from it
+                store = self.open_store()
+                if store is None:
+                    return False
+                self.store = store
+                self.load_state()
+                self.tip = bytes(self.store.raw(-1))
+                return True
+
+            known = len(self.store)
+            changed = self.store.refresh()
+            if len(self.store) == 0:
+                # cut by a writer about to bootstrap, the blocks come back in the partial store
+                return False
+            if len(self.store) < known or known == 0 or bytes(self.store.raw(known - 1)) != self.tip:
+                self.store.reload()
+                self.load_state()
+            elif changed:
+                for block in self.store[known:]:
+                    self.registry.apply_block(block)
+                self.restore_voting_flags()
+                self.publish()
+            else:
+                return False
+            self.tip = bytes(self.store.raw(-1))
+        return True
+
+    def append_block(self, block, encoded=None):
+        raise RuntimeError('only the writer process appends blocks')
+
+    def forward(self, method, path, route=None, **kwargs):
+        # route is the path without ids and query, what the request is counted under in the metrics
+        headers = kwargs.pop('headers', {})
+        if self.token is not None:
+            headers['X-Writer-Token'] = self.token
+        return self.writer_pool.request(self.writer, method, path, headers=headers, check_status=False,
+                                        route=route or path, **kwargs)
+
+    def new_transactions(self, transactions, verified=None):
+        # votes that pass every check here go to the writer in one batch, marked as verified
+        results = self.verify_transactions(transactions, verified)
+        passed = [position for position, result in enumerate(results) if result is None]
+        if not passed:
+            return results
+
+        try:
+            response = self.forward('POST', '/transaction/batch', json=[{
+                'sender': transactions[position].sender_address,
+                'receiver': transactions[position].receiver_address,
+                'signature': transactions[position].signature,
+            } for position in passed])
+        except requests.exceptions.RequestException as error:
+            for position in passed:
+                results[position] = (False, f'Could not reach the writer: {error}')
+            return results
+
+        for position, item in zip(passed, response.json()['results']):
+            results[position] = (item['accepted'], item['error_message'])
+        return results
@@ -0,0 +1,50 @@
+class Snapshot(object):
+    """ Read-only view of the chain and the registry at one height, replaced as a whole by the writer
+
+    the chain, the record lists and the vote positions are shared with the writer, who only adds to
+    them or swaps in a new one, so a snapshot stays valid without copying by remembering how much of each it covers.
+    """
+
+    __slots__ = ('chain', 'start', 'height', 'head', 'etag', 'version', 'results', 'vote_blocks',
+                 'voters', 'voter_count', 'candidates', 'candidate_count', 'transactions', 'transaction_count')
+
+    def __init__(self, chain, registry):
+        # a block store is read through a view, a reorg cuts the store but not what the view covers.
+        # the same goes for the store of a PartialChain
+        if hasattr(chain, 'view'):
+            chain = chain.view()
+        self.chain = chain
+        # blocks below start are not held by a node that bootstrapped from a checkpoint
+        self.start = getattr(chain, 'start', 0)
+        self.height = len(chain)
+        self.head = {
+            'length': self.height,
+            'hash': chain[-1]['hash'] if self.height else None,
+        }
+        with registry.tallies.lock:
+            self.etag, self.version = registry.tallies.etag, registry.tallies.version
+            self.results = registry.candidate_votes()
+        self.vote_blocks = registry.vote_blocks
+        self.voters, self.voter_count = registry.voter_records, len(registry.voter_records)
+        self.candidates, self.candidate_count = registry.candidate_records, len(registry.candidate_records)
+        self.transactions, self.transaction_count = registry.transactions, len(registry.transactions)
+
+    def blocks(self, since=0, until=None):
+        until = self.height if until is None else min(until, self.height)
+        for position in range(max(since, self.start), until):
+            yield self.chain[position]
+
+    def vote_position(self, wallet_address):
+        # position of the block holding the wallet's vote, None if it is not in this snapshot
+        position = self.vote_blocks.get(wallet_address)
+        return position if position is not None and position < self.height else None
+
+    def all_voters(self):
+        return [dict(voter, voted=self.vote_position(voter['wallet_address']) is not None)
+                for voter in self.voters[:self.voter_count]]
+
+    def all_candidates(self):
+        return self.candidates[:self.candidate_count]
+
+    def all_transactions(self):
+        return self.transactions[:self.transaction_count]
@@ -1 +0,0 @@
-start /B python main.py 5003
\ No newline at end of file
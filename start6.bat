@@ -1 +0,0 @@
-start /B python main.py 5007
\ No newline at end of file
@@ -0,0 +1,294 @@
+import json
+import mmap
+import os
+from array import array
+from collections import OrderedDict
+
+from encoding import FORMAT_VERSION, RECORD_LENGTH, decode_block, encode_block, write_record
+
+
+class BlockStore(object):
+    """ Append-only block log on disk with an offset index, used in place of the in-memory chain list
+
+    blocks.log holds the binary encoded blocks, each prefixed with its length, blocks.idx the byte
+    offset of every block as unsigned 64 bit integers and checkpoint.json the registry state at some height.
+    a read-only store follows the files of a store another process writes to, see refresh.
+    the log is never rewritten while the store is open: cutting the chain only shortens the index, so
+    a view taken before still reads the blocks it covers, see view.
+    """
+
+    LOG = 'blocks.log'
+    INDEX = 'blocks.idx'
+    CHECKPOINT = 'checkpoint.json'
+
+    def __init__(self, path, cache_size=256, sync=False, readonly=False):
+        self.path = path
+        self.readonly = readonly
+        # fsync after every block, slower but survives power loss and not just a crash
+        self.sync = sync
+        self.cache_size = cache_size
+        # recently read or written blocks by offset in the log, the tail is read all the time
+        self.cache = OrderedDict()
+        self.map = None
+
+        if readonly:
+            self.log = open(os.path.join(path, self.LOG), 'rb')
+            self.index = open(os.path.join(path, self.INDEX), 'rb')
+        else:
+            os.makedirs(path, exist_ok=True)
+            self.retire_old_format()
+            self.log = open(os.path.join(path, self.LOG), 'a+b')
+            self.index = open(os.path.join(path, self.INDEX), 'a+b')
+        self.offsets = array('Q')
+        self.load_index()
+
+    def retire_old_format(self):
+        # a log written in another block format cannot be read, it is renamed with its version
+        # appended and the store starts out empty, so the node syncs its chain again
+        try:
+            with open(os.path.join(self.path, self.LOG), 'rb') as log:
+                data = log.read(RECORD_LENGTH.size)
+                # skipping the empty records that mark a cut
+                while len(data) == RECORD_LENGTH.size and RECORD_LENGTH.unpack(data)[0] == 0:
+                    data = log.read(RECORD_LENGTH.size)
+                version = log.read(1)
+        except FileNotFoundError:
+            return
+        if not version or version[0] == FORMAT_VERSION:
+            return
+        print(f'{self.path} holds blocks in format version {version[0]}, it is moved aside and synced again')
+        for name in (self.LOG, self.INDEX, self.CHECKPOINT):
+            if os.path.exists(os.path.join(self.path, name)):
+                os.replace(os.path.join(self.path, name), os.path.join(self.path, f'{name}.v{version[0]}'))
+
+    def load_index(self):
+        if self.readonly:
+            self.reload()
+            return
+
+        self.index.seek(0)
+        data = self.index.read()
+        # a crash can leave a half written offset behind
+        data = data[:len(data) - len(data) % self.offsets.itemsize]
+        self.offsets.frombytes(data)
+        self.log.seek(0, os.SEEK_END)
+        size = self.log.tell()
+        while self.offsets and self.offsets[-1] >= size:
+            self.offsets.pop()
+
+        # pick up blocks that made it into the log but not into the index,
+        # a half written block at the end is dropped
+        indexed = len(self.offsets) > 0
+        end = self.offsets.pop() if indexed else 0
+        recovered = []
+        self.log.seek(end)
+        tail = self.log.read()
+        position = 0
+        while position + RECORD_LENGTH.size <= len(tail):
+            length, = RECORD_LENGTH.unpack_from(tail, position)
+            if position + RECORD_LENGTH.size + length > len(tail):
+                break
+            if length == 0:
+                # a cut: the blocks since the last indexed one were dropped from the chain
+                recovered = recovered[:1] if indexed else []
+            else:
+                recovered.append(end + position)
+            position += RECORD_LENGTH.size + length
+        end += position
+
+        # nobody reads the store yet, so the torn tail can go
+        self.log.truncate(end)
+        self.size = end
+        self.index.truncate(len(self.offsets) * self.offsets.itemsize)
+        self.offsets.extend(recovered)
+        self.index.write(array('Q', recovered).tobytes())
+        self.index.flush()
+
+    def reload(self):
+        # read-only stores: every indexed block whose bytes are in the log, nothing is repaired
+        self.map = None
+        self.cache.clear()
+        self.offsets = array('Q')
+        self.refresh()
+
+    def refresh(self):
+        # read-only stores: picks up the blocks the writer indexed since the last call and
+        # starts over when the writer cut the chain. returns True when the store changed
+        self.index.seek(0, os.SEEK_END)
+        count = self.index.tell() // self.offsets.itemsize
+        if count < len(self) or len(self) and self.indexed(len(self) - 1) != self.offsets[-1]:
+            # the log is only appended to, so a replaced block always moves to another offset
+            self.reload()
+            return True
+        if count == len(self):
+            return False
+        self.index.seek(len(self) * self.offsets.itemsize)
+        self.offsets.frombytes(self.index.read((count - len(self)) * self.offsets.itemsize))
+        self.log.seek(0, os.SEEK_END)
+        size = self.log.tell()
+        while self.offsets and self.offsets[-1] >= size:
+            self.offsets.pop()
+        return True
+
+    def indexed(self, position):
+        # the offset the index file holds for a position
+        self.index.seek(position * self.offsets.itemsize)
+        return array('Q', self.index.read(self.offsets.itemsize))[0]
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __iter__(self):
+        for position in range(len(self)):
+            yield self[position]
+
+    def __getitem__(self, position):
+        if isinstance(position, slice):
+            return [self[item] for item in range(*position.indices(len(self)))]
+        return self.block_at(self.offset(self.offsets, len(self), position))
+
+    def __delitem__(self, position):
+        # only cutting off the tail is supported, the log is append-only otherwise
+        if not isinstance(position, slice) or position.stop is not None or position.step is not None:
+            raise TypeError('only a tail slice can be deleted from the block store')
+        self.cut(min(len(self), position.start or 0))
+
+    def view(self):
+        # the chain as it is now, unchanged by later appends and cuts
+        return BlockStoreView(self, self.offsets, len(self))
+
+    @staticmethod
+    def offset(offsets, length, position):
+        if position < 0:
+            position += length
+        if not 0 <= position < length:
+            raise IndexError('block index out of range')
+        return offsets[position]
+
+    def block_at(self, start):
+        block = self.cache.get(start)
+        if block is None:
+            block = decode_block(self.record_at(start)[RECORD_LENGTH.size:])
+            self.remember(start, block)
+        return block
+
+    def raw(self, position):
+        # the stored record of a block, length prefix included, ready to be sent to a peer
+        return self.record_at(self.offset(self.offsets, len(self), position))
+
+    def record_at(self, start):
+        # the end is taken from the length prefix, a reader does not know where the writer's log ends
+        mapped = self.map
+        if mapped is None or len(mapped) < start + RECORD_LENGTH.size:
+            mapped = self.remap()
+        length, = RECORD_LENGTH.unpack_from(mapped, start)
+        end = start + RECORD_LENGTH.size + length
+        if len(mapped) < end:
+            mapped = self.remap()
+        return mapped[start:end]
+
+    def read(self, position):
+        # the encoded block without its length prefix
+        return self.raw(position)[RECORD_LENGTH.size:]
+
+    def remap(self):
+        # the old map is left to the garbage collector, other readers may still be slicing it
+        if not self.readonly:
+            self.log.flush()
+        self.map = mmap.mmap(self.log.fileno(), 0, access=mmap.ACCESS_READ)
+        return self.map
+
+    def remember(self, start, block):
+        self.cache[start] = block
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+    def append(self, block, encoded=None):
+        # encoded are the block's bytes when the caller has them already
+        data = bytearray()
+        write_record(data, encoded if encoded is not None else encode_block(block))
+        self.log.seek(0, os.SEEK_END)
+        self.log.write(data)
+        self.log.flush()
+        self.index.write(array('Q', [self.size]).tobytes())
+        self.index.flush()
+        if self.sync:
+            os.fsync(self.log.fileno())
+            os.fsync(self.index.fileno())
+        self.offsets.append(self.size)
+        self.remember(self.size, block)
+        self.size += len(data)
+
+    def extend(self, blocks):
+        for block in blocks:
+            self.append(block)
+
+    def cut(self, length):
+        # drops every block from position length on. their records stay in the log for the views
+        # still reading them, an empty record after them tells load_index they are not part of the chain.
+        # the offsets are replaced rather than shortened, views hold on to the old ones
+        data = bytearray()
+        write_record(data, b'')
+        self.log.seek(0, os.SEEK_END)
+        self.log.write(data)
+        self.log.flush()
+        if self.sync:
+            os.fsync(self.log.fileno())
+        self.size += len(data)
+        self.offsets = self.offsets[:length]
+        self.index.truncate(length * self.offsets.itemsize)
+
+    def save_checkpoint(self, height, state):
+        # written to a temporary file first so a crash never leaves a broken checkpoint
+        checkpoint = {
+            'height': height,
+            'hash': self[height - 1]['hash'],
+            'state': state,
+        }
+        path = os.path.join(self.path, self.CHECKPOINT)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(checkpoint, f)
+        os.replace(path + '.tmp', path)
+
+    def load_checkpoint(self):
+        # returns (height, state) of the latest checkpoint that still matches the log, or (0, None)
+        try:
+            with open(os.path.join(self.path, self.CHECKPOINT)) as f:
+                checkpoint = json.load(f)
+        except (OSError, ValueError):
+            return 0, None
+        height = checkpoint['height']
+        if height > len(self) or self[height - 1]['hash'] != checkpoint['hash']:
+            return 0, None
+        return height, checkpoint['state']
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        self.log.close()
+        self.index.close()
+
+
+class BlockStoreView(object):
+    """ The first length blocks of a store as they were when the view was taken, what snapshots read """
+
+    def __init__(self, store, offsets, length):
+        self.store = store
+        self.offsets = offsets
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        for position in range(self.length):
+            yield self[position]
+
+    def __getitem__(self, position):
+        if isinstance(position, slice):
+            return [self[item] for item in range(*position.indices(self.length))]
+        return self.store.block_at(self.store.offset(self.offsets, self.length, position))
+
+    def raw(self, position):
+        return self.store.record_at(self.store.offset(self.offsets, self.length, position))
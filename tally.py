@@ -0,0 +1,81 @@
+import queue
+import threading
+from collections import Counter
+from uuid import uuid4
+
+
+class Subscriber(object):
+    """ Queue of tally deltas for one listener, flagged as lagged when it cannot keep up """
+
+    def __init__(self, size):
+        self.deltas = queue.Queue(size)
+        self.lagged = False
+
+
+class TallyEngine(object):
+    """ Running vote counts per candidate, updated as blocks are applied or rolled back """
+
+    def __init__(self, subscriber_queue_size=1000):
+        self.counts = Counter()
+        # bumped on every change. the instance id keeps versions of different runs apart
+        self.version = 0
+        self.instance = uuid4().hex[:8]
+        self.subscriber_queue_size = subscriber_queue_size
+        self.subscribers = set()
+        self.lock = threading.Lock()
+
+    @property
+    def etag(self):
+        return f'{self.instance}-{self.version}'
+
+    def __getitem__(self, wallet_address):
+        return self.counts[wallet_address]
+
+    def apply_block(self, block):
+        self.update(Counter(transaction['receiver'] for transaction in block['transactions']))
+
+    def revert_block(self, block):
+        delta = Counter()
+        for transaction in block['transactions']:
+            delta[transaction['receiver']] -= 1
+        self.update(delta)
+
+    def update(self, delta):
+        if not delta:
+            return
+        with self.lock:
+            for wallet_address, change in delta.items():
+                self.counts[wallet_address] += change
+                if self.counts[wallet_address] <= 0:
+                    del self.counts[wallet_address]
+            self.version += 1
+            self.publish({'version': self.version, 'etag': self.etag, 'delta': dict(delta)})
+
+    def reset(self, counts=None):
+        with self.lock:
+            self.counts = Counter(counts or {})
+        self.changed()
+
+    def changed(self):
+        # a change deltas cannot describe (reset, new candidates), listeners start over from the full results
+        with self.lock:
+            self.version += 1
+            for subscriber in self.subscribers:
+                subscriber.lagged = True
+
+    def publish(self, event):
+        for subscriber in self.subscribers:
+            try:
+                subscriber.deltas.put_nowait(event)
+            except queue.Full:
+                subscriber.lagged = True
+
+    def subscribe(self):
+        subscriber = Subscriber(self.subscriber_queue_size)
+        with self.lock:
+            self.subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self.lock:
+            self.subscribers.discard(subscriber)
@@ -2,6 +2,14 @@ import unittest
 import time
 
 from main import *
+from merkle import verify_proof
+from checkpoint import verify_checkpoint
+from encoding import HEADER, RECORD_LENGTH
+import bench
+import client
+import cluster
+import columnar
+import ingest
 
 
 class TestBlockChain(unittest.TestCase):
@@ -186,5 +194,1471 @@ class TestCommunication(unittest.TestCase):
         print(blockchain.get_all_transactions())
         self.assertEqual(len(blockchain.get_all_transactions()), 10)
 
+class TestRegistry(unittest.TestCase):
+
+    @staticmethod
+    def block(voters=(), candidates=(), transactions=()):
+        return {
+            'index': 1,
+            'voters': list(voters),
+            'candidates': list(candidates),
+            'transactions': list(transactions),
+        }
+
+    def test_apply_block_indexes_votes(self):
+        registry = Registry()
+        registry.apply_block(self.block(
+            voters=[{'wallet_address': 'V1', 'public_key': 'K1'}, {'wallet_address': 'V2', 'public_key': 'K2'}],
+            candidates=[{'wallet_address': 'C1', 'name': 'First'}],
+        ))
+        registry.apply_block(self.block(transactions=[{'sender': 'V1', 'receiver': 'C1'}]))
+
+        self.assertTrue(registry.has_voted('V1'))
+        self.assertFalse(registry.has_voted('V2'))
+        self.assertEqual([voter['voted'] for voter in registry.all_voters()], [True, False])
+        self.assertEqual(registry.candidate_votes(), [{'wallet_address': 'C1', 'name': 'First', 'votes': 1}])
+
+    def test_rebuild_drops_old_state(self):
+        registry = Registry()
+        registry.apply_block(self.block(transactions=[{'sender': 'V1', 'receiver': 'C1'}]))
+        registry.rebuild([self.block(candidates=[{'wallet_address': 'C2', 'name': 'Second'}])])
+
+        self.assertFalse(registry.has_voted('V1'))
+        self.assertEqual(registry.transactions, [])
+        self.assertEqual(list(registry.candidates), ['C2'])
+
+
+class ElectionTestCase(unittest.TestCase):
+    """ Helpers for driving a voting flow with properly hex encoded signatures """
+
+    def setUp(self):
+        self.blockchain = BlockChain(set())
+        with open("private.pem", "r") as f:
+            self.admin_key = RSA.importKey(f.read())
+
+    def admin_sign(self, data):
+        return Transaction.sign_data(data.encode('utf-8'), self.admin_key)
+
+    def add_candidate(self, name):
+        return self.blockchain.new_candidate(name, self.admin_sign(name))
+
+    def start(self):
+        self.blockchain.start_voting(self.admin_sign("StartVote"), "StartVote")
+
+    def vote(self, private_key, wallet_address, candidate_wallet):
+        transaction = Transaction(wallet_address, candidate_wallet)
+        transaction.sign(private_key)
+        return transaction
+
+
+class ServedNodeMixin(object):
+    """ Serves a blockchain over http on a random local port for the duration of a test """
+
+    def serve(self, blockchain):
+        # returns host:port, main.blockchain is put back once the test is done
+        import main
+        import threading
+        from werkzeug.serving import make_server
+
+        self.addCleanup(setattr, main, 'blockchain', getattr(main, 'blockchain', None))
+        main.blockchain = blockchain
+        self.server = make_server('localhost', 0, app, threaded=True)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.shutdown)
+        return f'localhost:{self.server.server_port}'
+
+
+class TestElection(ElectionTestCase):
+
+    def test_vote_is_counted_once(self):
+        candidate_wallet = self.add_candidate('First')
+        private_key, public_key, wallet_address = self.blockchain.new_voter()
+        self.start()
+
+        transaction = self.vote(private_key, wallet_address, candidate_wallet)
+        self.assertEqual(self.blockchain.new_transaction(transaction), (True, None))
+        self.assertEqual(self.blockchain.new_transaction(transaction), (False, "This voter has already voted"))
+
+        self.assertEqual(self.blockchain.candidate_votes()[0]['votes'], 1)
+        self.assertTrue(self.blockchain.get_all_voters()[0]['voted'])
+
+    def test_vote_ended_before_the_commit_is_refused(self):
+        candidate_wallet = self.add_candidate('First')
+        private_key, public_key, wallet_address = self.blockchain.new_voter()
+        self.start()
+
+        # the vote ends while the signature is being checked
+        verify = self.blockchain.verifier.verify
+        def end_then_verify(*args):
+            self.blockchain.end_voting(self.admin_sign("EndVote"), "EndVote")
+            return verify(*args)
+        self.blockchain.verifier.verify = end_then_verify
+
+        transaction = self.vote(private_key, wallet_address, candidate_wallet)
+        self.assertEqual(self.blockchain.new_transaction(transaction), (False, "The vote is not started or ended"))
+        self.assertEqual(self.blockchain.current_transactions, [])
+        self.assertEqual(self.blockchain.candidate_votes()[0]['votes'], 0)
+
+    def test_unknown_candidate(self):
+        private_key, public_key, wallet_address = self.blockchain.new_voter()
+        self.start()
+
+        transaction = self.vote(private_key, wallet_address, "Candidate1")
+        self.assertEqual(self.blockchain.new_transaction(transaction),
+                         (False, "Candidate is not present in the given vote"))
+
+
+class TestBlockProducer(ElectionTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.blockchain.producer.block_size = 3
+
+    def test_votes_are_batched(self):
+        candidate_wallet = self.add_candidate('First')
+        voters = [self.blockchain.new_voter() for _ in range(2)]
+        self.start()
+        height = len(self.blockchain.chain)
+
+        for private_key, public_key, wallet_address in voters:
+            self.blockchain.new_transaction(self.vote(private_key, wallet_address, candidate_wallet))
+
+        self.assertEqual(len(self.blockchain.chain), height)
+        self.assertEqual(len(self.blockchain.current_transactions), 2)
+        # the queued vote still counts as cast
+        private_key, public_key, wallet_address = voters[0]
+        self.assertEqual(self.blockchain.new_transaction(self.vote(private_key, wallet_address, candidate_wallet)),
+                         (False, "This voter has already voted"))
+
+        self.blockchain.producer.flush()
+        self.assertEqual(len(self.blockchain.chain), height + 1)
+        self.assertEqual(len(self.blockchain.last_block['transactions']), 2)
+
+    def test_start_voting_flushes_pending_voters(self):
+        self.add_candidate('First')
+        self.blockchain.new_voter()
+        self.assertEqual(len(self.blockchain.chain), 1)
+
+        self.start()
+        self.assertEqual(len(self.blockchain.chain), 2)
+        self.assertEqual(len(self.blockchain.last_block['voters']), 1)
+        self.assertTrue(self.blockchain.last_block['started_voting'])
+
+    def test_interval_seals_partial_block(self):
+        import time
+        self.blockchain.producer.interval = 0.05
+        self.add_candidate('First')
+        time.sleep(0.2)
+        self.assertEqual(len(self.blockchain.chain), 2)
+
+
+class TestChainValidation(ElectionTestCase):
+
+    def peer_chain(self, blocks=2):
+        # a copy of our chain extended by a peer
+        import copy
+        chain = copy.deepcopy(self.blockchain.chain)
+        for _ in range(blocks):
+            block = dict(chain[-1], index=len(chain) + 1, previous_hash=chain[-1]['hash'])
+            block['hash'] = BlockChain.hash(block)
+            chain.append(block)
+        return chain
+
+    def test_sealed_blocks_carry_their_hash(self):
+        block = self.blockchain.mine()
+        self.assertEqual(block['hash'], BlockChain.hash(block))
+        self.assertEqual(block['previous_hash'], self.blockchain.chain[-2]['hash'])
+
+    def test_only_new_blocks_are_checked(self):
+        chain = self.peer_chain()
+        # the shared prefix is trusted from our own copy, so this edit goes unnoticed
+        chain[0]['admin'] = 'forged'
+
+        self.assertEqual(self.blockchain.common_prefix(chain), 1)
+        self.assertTrue(self.blockchain.valid_chain(chain))
+
+    def test_tampered_suffix_is_rejected(self):
+        chain = self.peer_chain()
+        chain[-1]['timestamp'] = 0
+        self.assertFalse(self.blockchain.valid_chain(chain))
+
+        chain = self.peer_chain()
+        chain[1]['previous_hash'] = 'abc'
+        chain[1]['hash'] = BlockChain.hash(chain[1])
+        self.assertFalse(self.blockchain.valid_chain(chain))
+
+
+class TestForkChoice(ElectionTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.candidates = [self.add_candidate('First'), self.add_candidate('Second')]
+        self.voters = [self.blockchain.new_voter() for _ in range(2)]
+        self.start()
+        for private_key, _, wallet in self.voters:
+            self.blockchain.new_transaction(self.vote(private_key, wallet, self.candidates[0]))
+        # the two votes are in the last two blocks, the branches below fork off before them
+        self.fork = len(self.blockchain.chain) - 2
+
+    def branch(self, *transactions):
+        # blocks following our first fork blocks, one per list of votes
+        blocks = []
+        previous = self.blockchain.chain[self.fork - 1]
+        for votes in transactions:
+            block = dict(previous, index=previous['index'] + 1, timestamp=time(), voters=[], candidates=[],
+                         transactions=votes, previous_hash=previous['hash'])
+            block['merkle_root'] = block_root(block)
+            block['hash'] = BlockChain.hash(block)
+            blocks.append(block)
+            previous = block
+        return blocks
+
+    def signed(self, voter, candidate):
+        private_key, _, wallet = voter
+        signature = self.vote(private_key, wallet, candidate).sign(private_key)
+        return {'sender': wallet, 'receiver': candidate, 'signature': signature}
+
+    def test_votes_carry_their_signature(self):
+        transaction = self.blockchain.last_block['transactions'][0]
+        self.assertEqual(transaction, self.signed(self.voters[1], self.candidates[0]))
+        self.assertEqual(decode_block(encode_block(self.blockchain.last_block)), self.blockchain.last_block)
+
+    def test_branch_is_checked_in_full(self):
+        forkchoice = self.blockchain.forkchoice
+        first = self.signed(self.voters[0], self.candidates[1])
+        self.assertIsNone(forkchoice.check_branch(self.fork, self.branch([first], [])))
+
+        forged = dict(first, signature=self.signed(self.voters[1], self.candidates[1])['signature'])
+        self.assertEqual(forkchoice.check_branch(self.fork, self.branch([forged], [])), 'signature')
+        self.assertEqual(forkchoice.check_branch(self.fork, self.branch([first], [first])), 'vote')
+        unknown = dict(first, receiver=self.voters[1][2])
+        self.assertEqual(forkchoice.check_branch(self.fork, self.branch([unknown], [])), 'vote')
+
+    def test_reorg_moves_the_tallies(self):
+        blocks = self.branch([self.signed(self.voters[0], self.candidates[1])], [], [])
+        abandoned = self.blockchain.chain[self.fork:]
+        self.assertTrue(self.blockchain.forkchoice.switch(self.fork, blocks))
+
+        self.assertEqual([block['hash'] for block in self.blockchain.chain[self.fork:]],
+                         [block['hash'] for block in blocks])
+        self.assertEqual([candidate['votes'] for candidate in self.blockchain.candidate_votes()], [0, 1])
+        self.assertEqual(self.blockchain.registry.vote_blocks[self.voters[0][2]], self.fork)
+        # the vote only the abandoned branch had goes into our next block
+        self.assertEqual([transaction['sender'] for transaction in self.blockchain.current_transactions],
+                         [self.voters[1][2]])
+        self.assertIn(abandoned[-1]['hash'], self.blockchain.forkchoice.side_blocks)
+
+    def test_reorg_depth_is_bounded(self):
+        self.blockchain.forkchoice.max_reorg_depth = 1
+        blocks = self.branch([self.signed(self.voters[0], self.candidates[1])], [], [])
+        self.assertFalse(self.blockchain.forkchoice.switch(self.fork, blocks))
+        self.assertEqual([candidate['votes'] for candidate in self.blockchain.candidate_votes()], [2, 0])
+
+    def test_branch_is_checked_without_the_lock(self):
+        verifier = self.blockchain.verifier
+        verify_batch = verifier.verify_batch
+        locked = []
+        def verify_while_a_block_is_sealed(signatures):
+            locked.append(self.blockchain.lock._is_owned())
+            if len(locked) == 1:
+                self.blockchain.new_block()
+            return verify_batch(signatures)
+        verifier.verify_batch = verify_while_a_block_is_sealed
+
+        blocks = self.branch([self.signed(self.voters[0], self.candidates[1])], [], [], [])
+        self.assertTrue(self.blockchain.forkchoice.switch(self.fork, blocks))
+        # the tip moved while the branch was checked, so it was checked again under the lock
+        self.assertEqual(locked, [False, True])
+        self.assertEqual(self.blockchain.last_block['hash'], blocks[-1]['hash'])
+
+
+class TestBulkEnrollment(ElectionTestCase):
+
+    def test_voters_are_sealed_per_block(self):
+        self.blockchain.key_pool = KeyPool(bits=1024, processes=2)
+        height = len(self.blockchain.chain)
+
+        credentials = list(self.blockchain.new_voters(5, block_size=2))
+
+        self.assertEqual(len(credentials), 5)
+        self.assertEqual([len(block['voters']) for block in self.blockchain.chain[height:]], [2, 2, 1])
+        self.assertEqual([voter['wallet_address'] for voter in self.blockchain.get_all_voters()],
+                         [wallet for _, _, wallet in credentials])
+
+    def test_enrollment_stops_when_the_vote_starts(self):
+        self.blockchain.key_pool = KeyPool(bits=1024, processes=1)
+        self.add_candidate('First')
+        enrollment = self.blockchain.new_voters(4, block_size=2)
+        enrolled = [next(enrollment), next(enrollment)]
+        self.start()
+
+        with self.assertRaises(VotingStarted):
+            next(enrollment)
+        self.assertEqual(self.blockchain.new_voter(), -1)
+        self.assertEqual([voter['wallet_address'] for voter in self.blockchain.get_all_voters()],
+                         [wallet for _, _, wallet in enrolled])
+        self.assertIsNone(self.blockchain.forkchoice.check_branch(0, list(self.blockchain.chain)))
+
+    def test_endpoint_streams_ndjson(self):
+        import main
+        main.blockchain = self.blockchain
+        self.blockchain.key_pool = KeyPool(bits=1024, processes=1)
+
+        response = app.test_client().post('/voter/batch', json={'count': 3, 'block_size': 3, 'download': True})
+
+        self.assertEqual(response.mimetype, 'application/x-ndjson')
+        self.assertIn('attachment', response.headers['Content-Disposition'])
+        lines = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+        self.assertEqual(len(lines), 3)
+        private_key = RSA.import_key(lines[0]['private_key'])
+        self.assertEqual(private_key.publickey().export_key().decode('utf-8'), lines[0]['public_key'])
+        self.assertEqual(len(self.blockchain.last_block['voters']), 3)
+
+
+class TestSignatureVerification(ElectionTestCase):
+
+    def test_batch_is_verified_in_arrival_order(self):
+        candidate_wallet = self.add_candidate('First')
+        voters = [self.blockchain.new_voter() for _ in range(3)]
+        self.start()
+
+        transactions = [self.vote(private_key, wallet, candidate_wallet) for private_key, _, wallet in voters]
+        transactions[1].signature = transactions[0].signature
+        transactions.append(transactions[2])
+
+        results = self.blockchain.new_transactions(transactions)
+        self.assertEqual(results, [
+            (True, None),
+            (False, "The signature is not valid"),
+            (True, None),
+            (False, "This voter has already voted in this batch"),
+        ])
+        self.assertEqual([item['sender'] for item in self.blockchain.get_all_transactions()],
+                         [voters[0][2], voters[2][2]])
+
+    def test_batch_endpoint_commits_one_block(self):
+        import main
+        main.blockchain = self.blockchain
+        candidate_wallet = self.add_candidate('First')
+        voters = [self.blockchain.new_voter() for _ in range(3)]
+        self.start()
+        height = len(self.blockchain.chain)
+
+        votes = []
+        for private_key, _, wallet in voters:
+            signature = Transaction(wallet, candidate_wallet).sign(private_key)
+            votes.append({'sender': wallet, 'receiver': candidate_wallet, 'signature': signature})
+        response = app.test_client().post('/transaction/batch', json=votes + [votes[0], {'sender': 'x'}])
+
+        values = response.get_json()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual((values['accepted'], values['rejected']), (3, 2))
+        self.assertEqual(values['results'][3]['error_message'], "This voter has already voted in this batch")
+        self.assertEqual(values['results'][4]['error_message'], "Missing values.")
+        self.assertEqual(len(self.blockchain.chain), height + 1)
+        self.assertEqual(len(self.blockchain.last_block['transactions']), 3)
+
+    def test_process_pool_matches_inline(self):
+        verifier = SignatureVerifier(processes=2, parallel_threshold=0)
+        key = RSA.generate(2048)
+        public_key = key.publickey().export_key()
+        data = b'{"receiver":"C","sender":"V"}'
+        signature = binascii.unhexlify(Transaction.sign_data(data, key))
+        items = [(public_key, signature, data), (public_key, signature, data + b' ')]
+        try:
+            self.assertEqual(verifier.verify_batch(items), [True, False])
+        finally:
+            verifier.close()
+        self.assertEqual([verifier.check(*item) for item in items], [True, False])
+
+    def test_cached_keys_belong_to_their_pem(self):
+        verifier = SignatureVerifier(processes=0)
+        data = b'{"receiver":"C","sender":"V"}'
+        key, other_key = RSA.generate(2048), RSA.generate(2048)
+        signature = binascii.unhexlify(Transaction.sign_data(data, other_key))
+        self.assertFalse(verifier.check(key.publickey().export_key(), signature, data))
+        # another key is checked against that key, not a cached one
+        self.assertTrue(verifier.check(other_key.publickey().export_key(), signature, data))
+        self.assertEqual(len(verifier.keys), 2)
+
+
+class TestChainSync(ServedNodeMixin, unittest.TestCase):
+    """ Syncs a node against a peer served over http on a random local port """
+
+    def setUp(self):
+        self.peer = BlockChain(set())
+        self.address = self.serve(self.peer)
+        self.node = BlockChain({self.address})
+
+    def hashes(self, blockchain):
+        return [block['hash'] for block in blockchain.chain]
+
+    def test_new_node_downloads_chain(self):
+        self.assertEqual(self.hashes(self.node), self.hashes(self.peer))
+        self.assertEqual(self.node.admin, self.peer.admin)
+
+    def test_only_missing_blocks_are_appended(self):
+        chain = self.node.chain
+        for _ in range(3):
+            self.peer.mine()
+
+        self.assertTrue(self.node.resolve_conflicts())
+        self.assertIs(self.node.chain, chain)
+        self.assertEqual(self.hashes(self.node), self.hashes(self.peer))
+        self.assertFalse(self.node.resolve_conflicts())
+
+    def test_fork_is_replaced_from_fork_point(self):
+        self.node.SYNC_PAGE_SIZE = 2
+        for _ in range(3):
+            self.peer.mine()
+        self.node.resolve_conflicts()
+        self.node.new_block()
+        for _ in range(4):
+            self.peer.mine()
+
+        self.assertEqual(self.node.find_fork_point(self.address, 8), 4)
+        self.assertTrue(self.node.resolve_conflicts())
+        self.assertEqual(self.hashes(self.node), self.hashes(self.peer))
+
+    def test_garbled_page_does_not_break_the_sync(self):
+        self.peer.mine()
+        self.peer.block_records = lambda *args: iter([RECORD_LENGTH.pack(1) + b'\x03'])
+        self.assertFalse(self.node.resolve_conflicts())
+        self.assertEqual(len(self.node.chain), len(self.peer.chain) - 1)
+
+    def test_fork_walk_stops_out_of_reach(self):
+        self.node.forkchoice.max_reorg_depth = 2
+        for _ in range(3):
+            self.peer.mine()
+        self.node.resolve_conflicts()
+        for _ in range(4):
+            self.node.new_block()
+            self.peer.mine()
+        self.peer.mine()
+
+        fetch = self.node.fetch
+        since = []
+        self.node.fetch = lambda node, path, **params: since.append(params.get('since')) or fetch(node, path, **params)
+        # the blocks are shared up to position 4, the walk gives up at 5, one below the deepest fork in reach
+        self.assertEqual(self.node.find_fork_point(self.address, 9), 5)
+        self.assertEqual(min(since), 5)
+        self.assertFalse(self.node.resolve_conflicts())
+        self.assertEqual(self.node.forkchoice.rejected.value(reason='depth'), 1)
+
+
+class TestGossip(ServedNodeMixin, unittest.TestCase):
+    """ Pushes blocks between a node and a peer served over http on a random local port """
+
+    def setUp(self):
+        self.peer = BlockChain(set())
+        self.address = self.serve(self.peer)
+        self.node = BlockChain({self.address})
+
+    def test_sealed_block_is_not_encoded_again(self):
+        import gossip
+        encode = gossip.encode_block
+        gossip.encode_block = None
+        try:
+            block = self.node.mine()
+        finally:
+            gossip.encode_block = encode
+        self.assertEqual(self.node.last_block, block)
+
+    def test_sealed_block_is_pushed_once(self):
+        import time
+        block = self.node.mine()
+        for _ in range(100):
+            if len(self.peer.chain) == len(self.node.chain):
+                break
+            time.sleep(0.05)
+        self.assertEqual(self.peer.last_block['hash'], block['hash'])
+        self.assertEqual(self.peer.gossip.received.value(outcome='accepted'), 1)
+        self.assertEqual(self.peer.gossip.receive(encode_block(block)), 'duplicate')
+
+    def test_gap_is_synced_from_the_sender(self):
+        for _ in range(3):
+            self.peer.mine()
+        outcome = self.node.gossip.receive(encode_block(self.peer.last_block), self.address)
+
+        self.assertEqual(outcome, 'accepted')
+        self.assertEqual([block['hash'] for block in self.node.chain], [block['hash'] for block in self.peer.chain])
+        self.assertEqual(self.node.gossip.receive(encode_block(self.peer.chain[1])), 'known')
+
+    def test_endpoint_rejects_garbage(self):
+        client = app.test_client()
+        self.assertEqual(client.post('/block/gossip', data=b'\x03').status_code, 400)
+        response = client.post('/block/gossip', data=encode_block(self.peer.last_block))
+        self.assertEqual(response.get_json()['outcome'], 'known')
+
+
+class TestBlockStore(ElectionTestCase):
+
+    def setUp(self):
+        import tempfile
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = self.directory.name
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def blocks(self, count):
+        blockchain = BlockChain()
+        for _ in range(count - 1):
+            blockchain.new_block()
+        return blockchain.full_chain()
+
+    def test_blocks_survive_reopening(self):
+        blocks = self.blocks(5)
+        store = BlockStore(self.path)
+        store.extend(blocks)
+        store.close()
+
+        store = BlockStore(self.path, cache_size=0)
+        self.assertEqual(len(store), 5)
+        self.assertEqual(store[-1], blocks[-1])
+        self.assertEqual([block['index'] for block in store[1:3]], [2, 3])
+        del store[3:]
+        self.assertEqual(len(store), 3)
+        store.append(blocks[4])
+        self.assertEqual(store[3]['hash'], blocks[4]['hash'])
+        store.close()
+
+    def test_views_keep_their_blocks_across_a_cut(self):
+        blocks = self.blocks(5)
+        other = self.blocks(5)
+        store = BlockStore(self.path, cache_size=0)
+        store.extend(blocks)
+        view = store.view()
+        store.raw(0)
+
+        del store[3:]
+        store.extend(other[3:])
+        self.assertEqual([block['hash'] for block in view], [block['hash'] for block in blocks])
+        self.assertEqual(bytes(view.raw(4))[4:], encode_block(blocks[4]))
+        self.assertEqual(store[4]['hash'], other[4]['hash'])
+
+        # the dropped block's record follows the last indexed one in the log, it is not picked up again
+        del store[4:]
+        store.close()
+        store = BlockStore(self.path)
+        self.assertEqual([block['hash'] for block in store], [block['hash'] for block in blocks[:3] + other[3:4]])
+
+    def test_old_format_is_moved_aside(self):
+        import os
+        store = BlockStore(self.path)
+        store.extend(self.blocks(2))
+        store.close()
+        # the format version is the first byte after the length of the first record
+        with open(os.path.join(self.path, BlockStore.LOG), 'r+b') as f:
+            f.seek(4)
+            f.write(bytes([2]))
+
+        store = BlockStore(self.path)
+        self.assertEqual(len(store), 0)
+        self.assertTrue(os.path.exists(os.path.join(self.path, BlockStore.LOG + '.v2')))
+        self.assertEqual(len(BlockChain(store=store).chain), 1)
+
+    def test_torn_writes_are_recovered(self):
+        import os
+        blocks = self.blocks(4)
+        store = BlockStore(self.path)
+        store.extend(blocks[:3])
+        store.close()
+        # the last offset never made it to the index and the next block was cut off half way
+        with open(os.path.join(self.path, BlockStore.INDEX), 'r+b') as f:
+            f.truncate(2 * 8 + 3)
+        with open(os.path.join(self.path, BlockStore.LOG), 'ab') as f:
+            record = bytearray()
+            write_record(record, encode_block(blocks[3]))
+            f.write(record[:-10])
+
+        store = BlockStore(self.path)
+        self.assertEqual([block['index'] for block in store], [1, 2, 3])
+        store.append(blocks[3])
+        store.close()
+        self.assertEqual(BlockStore(self.path)[3], blocks[3])
+
+    def test_restart_resumes_from_checkpoint(self):
+        self.blockchain = BlockChain(store=BlockStore(self.path), checkpoint_interval=2)
+        with open("private.pem", "r") as f:
+            self.admin_key = RSA.importKey(f.read())
+        candidate_wallet = self.add_candidate('First')
+        private_key, public_key, wallet_address = self.blockchain.new_voter()
+        self.start()
+        self.blockchain.new_transaction(self.vote(private_key, wallet_address, candidate_wallet))
+        self.blockchain.store.close()
+
+        restarted = BlockChain(store=BlockStore(self.path), checkpoint_interval=2, columnar=True)
+        self.assertEqual(restarted.admin, self.blockchain.admin)
+        self.assertEqual(restarted.store.load_checkpoint()[0], 4)
+        self.assertEqual(restarted.full_chain(), self.blockchain.full_chain())
+        self.assertTrue(restarted.started_voting)
+        self.assertEqual(restarted.candidate_votes(), self.blockchain.candidate_votes())
+        self.assertTrue(restarted.registry.has_voted(wallet_address))
+        # the columns are built from every block, those under the checkpoint included
+        stats = restarted.stats()
+        self.assertEqual((stats['height'], stats['voters'], stats['votes']), (len(restarted.chain), 1, 1))
+
+
+class TestKeyPool(unittest.TestCase):
+
+    def test_pool_is_refilled_in_background(self):
+        pool = KeyPool(size=2, processes=1, bits=1024).start()
+        try:
+            self.assertTrue(pool.wait_full(timeout=60))
+            private_key, public_key, wallet = pool.get()
+            self.assertEqual(private_key.publickey().export_key(), public_key)
+            self.assertEqual(wallet, base58.b58encode(BlockChain.calculate_hash(
+                BlockChain.calculate_hash(public_key), hash_function="ripemd160")).decode('utf-8'))
+            self.assertTrue(pool.wait_full(timeout=60))
+        finally:
+            pool.stop()
+        self.assertEqual(pool.stats()['exhausted'], 0)
+        self.assertGreaterEqual(pool.stats()['generated'], 3)
+
+    def test_empty_pool_counts_exhaustion(self):
+        pool = KeyPool(size=5, bits=1024)
+        pool.get()
+        self.assertEqual((pool.stats()['served'], pool.stats()['exhausted']), (1, 1))
+
+
+class TestChainEndpoint(unittest.TestCase):
+
+    def setUp(self):
+        import main
+        self.blockchain = main.blockchain = BlockChain()
+        for _ in range(4):
+            self.blockchain.new_block()
+        self.client = app.test_client()
+
+    def test_full_chain_is_streamed_as_json(self):
+        values = self.client.get('/chain').get_json()
+        self.assertEqual(values['length'], 5)
+        self.assertEqual(values['chain'], self.blockchain.full_chain())
+
+    def test_range_as_ndjson(self):
+        response = self.client.get('/chain?since=1&limit=2&format=ndjson')
+        blocks = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+        self.assertEqual([block['index'] for block in blocks], [2, 3])
+
+        response = self.client.get('/chain?since=3', headers={'Accept': 'application/x-ndjson'})
+        self.assertEqual(len(response.get_data(as_text=True).splitlines()), 2)
+
+    def test_header_pages_are_capped(self):
+        page_size = BlockChain.SYNC_PAGE_SIZE
+        BlockChain.SYNC_PAGE_SIZE = 2
+        try:
+            values = self.client.get('/chain/headers?since=1&limit=1000000').get_json()
+        finally:
+            BlockChain.SYNC_PAGE_SIZE = page_size
+        self.assertEqual([header['index'] for header in values['headers']], [2, 3])
+        self.assertEqual(values['length'], 5)
+
+    def test_stored_blocks_are_sent_as_stored(self):
+        import tempfile
+        with tempfile.TemporaryDirectory() as path:
+            store = BlockStore(path)
+            store.extend(self.blockchain.chain)
+            self.blockchain.store = self.blockchain.chain = store
+            self.blockchain.publish()
+            values = self.client.get('/chain?since=0&limit=10').get_json()
+            store.close()
+        self.assertEqual(len(values['chain']), 5)
+
+    def test_resolve_returns_status_only(self):
+        values = self.client.get('/miner/nodes/resolve').get_json()
+        self.assertEqual(values, dict(self.blockchain.chain_head(), replaced=False,
+                                      message='Our chain is authoritative.'))
+
+
+class TestTallies(ElectionTestCase):
+
+    def setUp(self):
+        super().setUp()
+        import main
+        main.blockchain = self.blockchain
+        self.client = app.test_client()
+        self.candidate_wallet = self.add_candidate('First')
+        self.voters = [self.blockchain.new_voter() for _ in range(2)]
+        self.start()
+
+    def cast(self, voter):
+        private_key, _, wallet = voter
+        self.blockchain.new_transaction(self.vote(private_key, wallet, self.candidate_wallet))
+
+    def test_conditional_get(self):
+        etag = self.client.get('/candidate/results').headers['ETag']
+        self.assertEqual(self.client.get('/candidate/results', headers={'If-None-Match': etag}).status_code, 304)
+
+        self.cast(self.voters[0])
+        response = self.client.get('/candidate/results', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+        self.assertEqual(response.get_json()[0]['votes'], 1)
+
+    def test_reverted_block_takes_its_votes_back(self):
+        self.cast(self.voters[0])
+        self.cast(self.voters[1])
+        self.blockchain.registry.revert_block(self.blockchain.last_block)
+        self.blockchain.publish()
+
+        self.assertEqual(self.blockchain.candidate_votes()[0]['votes'], 1)
+        self.assertFalse(self.blockchain.registry.has_voted(self.voters[1][2]))
+        self.assertEqual(len(self.blockchain.get_all_transactions()), 1)
+
+    def test_stream_sends_deltas(self):
+        response = self.client.get('/candidate/results/stream', buffered=False)
+        events = iter(response.response)
+        self.assertTrue(next(events).startswith(b'event: results'))
+
+        self.cast(self.voters[0])
+        name, data = next(events).decode('utf-8').splitlines()[:2]
+        self.assertEqual(name, 'event: delta')
+        self.assertEqual(json.loads(data[len('data: '):])['delta'], {self.candidate_wallet: 1})
+
+        response.close()
+        self.assertEqual(self.blockchain.registry.tallies.subscribers, set())
+
+
+class TestEncoding(ElectionTestCase):
+
+    def test_blocks_round_trip(self):
+        candidate_wallet = self.add_candidate('First')
+        private_key, public_key, wallet_address = self.blockchain.new_voter()
+        self.start()
+        self.blockchain.new_transaction(self.vote(private_key, wallet_address, candidate_wallet))
+
+        for block in self.blockchain.chain:
+            encoded = encode_block(block)
+            self.assertEqual(decode_block(encoded), block)
+            self.assertEqual(BlockChain.hash(block), block['hash'])
+
+        voter_block = self.blockchain.chain[2]
+        self.assertLess(len(encode_block(voter_block)), len(json.dumps(voter_block)) * 2 / 3)
+
+    def test_unusual_values_are_kept_verbatim(self):
+        block = dict(self.blockchain.last_block, previous_hash='abc', transactions=[
+            {'sender': 'Voter 1', 'receiver': 'Candidate1'},
+        ])
+        del block['hash']
+        self.assertEqual({key: value for key, value in decode_block(encode_block(block)).items() if key != 'hash'},
+                         block)
+
+    def test_non_canonical_bytes_are_refused(self):
+        import main
+        main.blockchain = self.blockchain
+        encoded = bytearray(encode_block(self.blockchain.last_block))
+        # an unused bit of the flags byte, which follows version, index and timestamp
+        encoded[13] |= 0x10
+        with self.assertRaises(ValueError):
+            decode_block(bytes(encoded))
+        self.assertEqual(app.test_client().post('/block/gossip', data=bytes(encoded)).status_code, 400)
+
+    def test_garbled_bytes_raise_value_error(self):
+        encoded = encode_block(self.blockchain.last_block)
+        # a single byte, a cut off header and a varint cut off after its continuation bit
+        for data in (b'\x03', encoded[:HEADER.size + 1], encoded[:HEADER.size] + b'\x02\x80'):
+            with self.assertRaises(ValueError):
+                decode_block(data)
+
+    def test_signed_bytes_are_unchanged(self):
+        transaction = Transaction('V1', 'C1')
+        self.assertEqual(transaction.generate_data(), b'{"receiver":"C1","sender":"V1"}')
+
+
+class TestMerkleProofs(ElectionTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.blockchain.producer.block_size = 5
+        self.candidate_wallet = self.add_candidate('First')
+        self.voters = [self.blockchain.new_voter() for _ in range(3)]
+        self.start()
+        for private_key, _, wallet in self.voters:
+            self.blockchain.new_transaction(self.vote(private_key, wallet, self.candidate_wallet))
+        self.blockchain.producer.flush()
+
+    def test_every_vote_has_a_valid_proof(self):
+        for _, _, wallet in self.voters:
+            proof = self.blockchain.vote_proof(wallet)
+            self.assertEqual(proof['transaction']['sender'], wallet)
+            self.assertTrue(verify_proof(bytes.fromhex(proof['leaf']), proof['proof'], proof['block']['merkle_root']))
+            self.assertEqual(BlockChain.hash(proof['block']), proof['block']['hash'])
+        self.assertIsNone(self.blockchain.vote_proof(self.candidate_wallet))
+
+    def test_proof_endpoint(self):
+        import main
+        main.blockchain = self.blockchain
+        client = app.test_client()
+        proof = client.get(f'/transaction/proof/{self.voters[1][2]}').get_json()
+        self.assertNotIn('transactions', proof['block'])
+        self.assertTrue(verify_proof(bytes.fromhex(proof['leaf']), proof['proof'], proof['block']['merkle_root']))
+        self.assertEqual(client.get('/transaction/proof/unknown').status_code, 404)
+
+    def test_body_is_bound_by_the_root(self):
+        import copy
+        chain = copy.deepcopy(self.blockchain.full_chain())
+        chain[-1]['transactions'][0]['receiver'] = 'someone else'
+        for block in chain:
+            del block['hash']
+        self.assertFalse(BlockChain(set()).valid_suffix(chain, None))
+
+
+class TestPeerPool(unittest.TestCase):
+
+    @staticmethod
+    def closed_address():
+        import socket
+        with socket.socket() as sock:
+            sock.bind(('localhost', 0))
+            return f'localhost:{sock.getsockname()[1]}'
+
+    def test_failing_peer_is_backed_off(self):
+        address = self.closed_address()
+        pool = PeerPool([address], timeout=0.5, backoff=60)
+        self.assertEqual(pool.healthy(), [address])
+
+        results = pool.map(lambda node: pool.get_json(node, '/chain/head'))
+        self.assertIsInstance(results[address], requests.exceptions.ConnectionError)
+        self.assertEqual(pool.healthy(), [])
+        self.assertEqual(pool.status()[address]['failures'], 1)
+        # nothing is sent to it until the backoff runs out
+        self.assertEqual(pool.map(lambda node: node), {})
+
+    def test_nodes_are_not_shared_between_chains(self):
+        BlockChain().register_node('http://localhost:5001')
+        self.assertEqual(BlockChain().nodes, set())
+
+
+class TestMetrics(ElectionTestCase):
+
+    def setUp(self):
+        super().setUp()
+        import main
+        main.blockchain = self.blockchain
+        self.client = app.test_client()
+
+    def test_histogram_is_rendered_cumulatively(self):
+        from metrics import Metrics
+        metrics = Metrics()
+        latency = metrics.histogram('latency_seconds', 'Latency', ('path',), buckets=(0.1, 1))
+        for value in (0.05, 0.5, 0.5, 3):
+            latency.observe(value, path='/a')
+        text = metrics.render()
+        self.assertIn('# TYPE latency_seconds histogram', text)
+        self.assertIn('latency_seconds_bucket{path="/a",le="0.1"} 1', text)
+        self.assertIn('latency_seconds_bucket{path="/a",le="1"} 3', text)
+        self.assertIn('latency_seconds_bucket{path="/a",le="+Inf"} 4', text)
+        self.assertIn('latency_seconds_count{path="/a"} 4', text)
+        self.assertEqual(latency.value(path='/a'), (4, 4.05))
+
+    def test_operations_and_requests_are_exposed(self):
+        candidate_wallet = self.add_candidate('First')
+        private_key, _, wallet = self.blockchain.new_voter()
+        self.start()
+        self.blockchain.new_transaction(self.vote(private_key, wallet, candidate_wallet))
+        self.client.get('/chain/head')
+
+        response = self.client.get('/metrics')
+        self.assertTrue(response.mimetype.startswith('text/plain'))
+        text = response.get_data(as_text=True)
+        self.assertIn(f'blockchain_height {len(self.blockchain.chain)}', text)
+        self.assertIn('blockchain_pending{kind="votes"} 0', text)
+        self.assertIn('blockchain_operation_seconds_count{operation="new_transaction"} 1', text)
+        self.assertIn('blockchain_operation_seconds_count{operation="verify_signature"} 1', text)
+        self.assertIn('http_request_seconds_count{method="GET",route="/chain/head",status="200"} 1', text)
+        self.assertIn('keypool_served_total 2', text)
+
+    def test_errors_are_counted(self):
+        with self.assertRaises(ValueError):
+            self.blockchain.new_candidate('First', '00')
+        self.assertEqual(self.blockchain.metrics.errors.value(operation='new_candidate'), 1)
+
+    def test_failing_peer_is_counted(self):
+        address = TestPeerPool.closed_address()
+        self.blockchain.register_node(f'http://{address}')
+        self.blockchain.resolve_conflicts()
+        text = self.blockchain.metrics.render()
+        self.assertIn(f'peer_request_errors_total{{peer="{address}"}} 1', text)
+        self.assertIn(f'peer_request_seconds_count{{peer="{address}",path="/chain/head"}} 1', text)
+
+    def test_profiler_is_toggled_at_runtime(self):
+        import time
+        self.assertEqual(self.client.post('/profiler/start', json={'interval': 0.001, 'reset': True})
+                         .get_json()['running'], True)
+        time.sleep(0.05)
+        status = self.client.post('/profiler/stop').get_json()
+        self.assertFalse(status['running'])
+        self.assertGreater(status['samples'], 0)
+        self.assertIn('tests.py:test_profiler_is_toggled_at_runtime', self.client.get('/profiler').get_data(as_text=True))
+
+    def test_profiler_refuses_bad_intervals(self):
+        for interval in (0, -1, 'often', [1], 'inf'):
+            self.assertEqual(self.client.post('/profiler/start', json={'interval': interval}).status_code, 400)
+        self.assertFalse(profiler.running)
+
+
+class TestIngestQueue(ElectionTestCase):
+
+    def setUp(self):
+        super().setUp()
+        import main
+        main.blockchain = self.blockchain
+        self.client = app.test_client()
+        self.candidate_wallet = self.add_candidate('First')
+        self.voters = [self.blockchain.new_voter() for _ in range(3)]
+        self.start()
+
+    def tearDown(self):
+        self.blockchain.ingest.stop()
+
+    def post(self, voter, signed_by=None):
+        private_key, _, wallet = voter
+        signature = Transaction(wallet, self.candidate_wallet).sign(signed_by or private_key)
+        return self.client.post('/transaction/new', json={
+            'sender': wallet, 'receiver': self.candidate_wallet, 'signature': signature})
+
+    def wait(self, ticket, status):
+        import time
+        for _ in range(100):
+            values = self.client.get(f'/transaction/status/{ticket}').get_json()
+            if values['status'] == status:
+                return values
+            time.sleep(0.05)
+        self.fail(f'ticket stayed {values["status"]}')
+
+    def test_vote_is_committed_through_a_ticket(self):
+        response = self.post(self.voters[0])
+        self.assertEqual(response.status_code, 202)
+        values = self.wait(response.get_json()['ticket'], 'committed')
+        self.assertEqual(values['block'], len(self.blockchain.chain))
+        self.assertEqual(self.blockchain.candidate_votes()[0]['votes'], 1)
+        self.assertEqual(self.client.get('/transaction/status/unknown').status_code, 404)
+
+    def test_bad_signature_is_rejected_by_the_committer(self):
+        ticket = self.post(self.voters[0], signed_by=self.voters[1][0]).get_json()['ticket']
+        self.assertEqual(self.wait(ticket, 'rejected')['message'], "The signature is not valid")
+        # the voter can try again
+        self.assertEqual(self.post(self.voters[0]).status_code, 202)
+
+    def test_vote_is_never_committed_twice(self):
+        self.blockchain.ingest.start = lambda: None
+        self.assertEqual(self.post(self.voters[0]).status_code, 202)
+        response = self.post(self.voters[0])
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.get_json()['error_message'], "This voter already has a vote queued")
+
+        # a vote that slipped past the cheap checks is still only committed once
+        transaction = self.vote(self.voters[0][0], self.voters[0][2], self.candidate_wallet)
+        self.blockchain.ingest.queue.put(ingest.Ticket(transaction))
+        self.blockchain.ingest.commit([self.blockchain.ingest.queue.get(), self.blockchain.ingest.queue.get()])
+        self.assertEqual(len(self.blockchain.get_all_transactions()), 1)
+
+    def test_full_queue_answers_429(self):
+        self.blockchain.ingest = IngestQueue(self.blockchain, size=1)
+        self.blockchain.ingest.start = lambda: None
+        self.assertEqual(self.post(self.voters[0]).status_code, 202)
+        response = self.post(self.voters[1])
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response.headers['Retry-After'], '1')
+        self.assertEqual(self.client.get('/transaction/queue').get_json()['depth'], 1)
+
+
+class TestSnapshots(ElectionTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.candidate_wallet = self.add_candidate('First')
+        self.voters = [self.blockchain.new_voter() for _ in range(2)]
+        self.start()
+
+    def cast(self, voter):
+        private_key, _, wallet = voter
+        self.blockchain.new_transaction(self.vote(private_key, wallet, self.candidate_wallet))
+
+    def test_snapshot_does_not_change_under_the_reader(self):
+        before = self.blockchain.snapshot
+        self.cast(self.voters[0])
+        after = self.blockchain.snapshot
+
+        self.assertEqual(before.all_transactions(), [])
+        self.assertEqual([voter['voted'] for voter in before.all_voters()], [False, False])
+        self.assertEqual(before.results[0]['votes'], 0)
+        self.assertEqual(after.height, before.height + 1)
+        self.assertEqual(len(after.all_transactions()), 1)
+
+        # reverting swaps in new lists, the published snapshot keeps its records
+        self.blockchain.registry.revert_block(self.blockchain.last_block)
+        self.assertEqual(len(after.all_transactions()), 1)
+        self.assertEqual(len(self.blockchain.get_all_transactions()), 1)
+        self.blockchain.publish()
+        self.assertEqual(self.blockchain.get_all_transactions(), [])
+
+    def test_votes_stay_in_a_snapshot_taken_before_a_revert(self):
+        wallet = self.voters[0][2]
+        self.cast(self.voters[0])
+        before = self.blockchain.snapshot
+
+        # cut the way a reorg does it
+        self.blockchain.registry.revert_block(self.blockchain.last_block)
+        self.blockchain.chain = self.blockchain.chain[:-1]
+        self.blockchain.publish()
+        self.assertIsNone(self.blockchain.vote_proof(wallet))
+
+        self.assertEqual([voter['voted'] for voter in before.all_voters()], [True, False])
+        self.assertEqual(before.vote_position(wallet), before.height - 1)
+        self.assertEqual(before.chain[before.vote_position(wallet)]['transactions'], before.all_transactions())
+
+    def test_readers_never_see_a_torn_state(self):
+        import threading
+        errors = []
+        done = threading.Event()
+
+        def read():
+            while not done.is_set():
+                snapshot = self.blockchain.snapshot
+                blocks = list(snapshot.blocks())
+                if len(blocks) != snapshot.head['length'] or blocks[-1]['hash'] != snapshot.head['hash']:
+                    errors.append(snapshot.height)
+                if len(snapshot.all_transactions()) != sum(result['votes'] for result in snapshot.results):
+                    errors.append(snapshot.height)
+
+        readers = [threading.Thread(target=read) for _ in range(4)]
+        for reader in readers:
+            reader.start()
+        for voter in self.voters:
+            self.cast(voter)
+        for _ in range(100):
+            self.blockchain.new_block()
+        done.set()
+        for reader in readers:
+            reader.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(self.blockchain.chain_head()['length'], len(self.blockchain.chain))
+
+
+class TestCheckpoints(ServedNodeMixin, ElectionTestCase):
+    """ A new node starts from the signed checkpoint of a peer served over http on a random local port """
+
+    def setUp(self):
+        self.blockchain = BlockChain(set(), checkpoint_interval=4, max_reorg_depth=2, columnar=True)
+        with open("private.pem", "r") as f:
+            self.admin_key = RSA.importKey(f.read())
+        candidate_wallet = self.add_candidate('First')
+        voters = [self.blockchain.new_voter() for _ in range(3)]
+        self.start()
+        for private_key, _, wallet in voters:
+            self.blockchain.new_transaction(self.vote(private_key, wallet, candidate_wallet))
+        for _ in range(4):
+            self.blockchain.new_block()
+        self.address = self.serve(self.blockchain)
+
+    def test_checkpoint_is_signed_once_buried(self):
+        checkpoint = self.blockchain.checkpoints.latest
+        self.assertEqual(checkpoint['height'], 8)
+        self.assertEqual(checkpoint['hash'], self.blockchain.chain[7]['hash'])
+        self.assertTrue(verify_checkpoint(self.blockchain.admin, checkpoint))
+        self.assertFalse(verify_checkpoint(self.blockchain.admin, dict(checkpoint, height=9)))
+
+    def test_new_node_starts_from_the_checkpoint(self):
+        import time
+        node = BlockChain(set(), columnar=True)
+        node.register_node(f'http://{self.address}')
+        # the history is only put in place once the lock is free
+        with node.lock:
+            self.assertTrue(node.resolve_conflicts())
+            self.assertEqual(node.chain_head(), self.blockchain.chain_head())
+            self.assertEqual(node.candidate_votes(), self.blockchain.candidate_votes())
+            self.assertEqual(node.forkchoice.final, 8)
+            self.assertEqual(node.blocks_since(0, 100)[0]['index'], 8)
+            self.assertIsNone(node.vote_proof(self.blockchain.get_all_transactions()[0]['sender']))
+
+        history = node.checkpoints.history
+        history.thread.join(30)
+        self.assertEqual(history.to_dict()['status'], 'complete')
+        self.assertEqual(node.full_chain(), self.blockchain.full_chain())
+        self.assertEqual(node.stats()['tallies'], self.blockchain.stats()['tallies'])
+
+        # new blocks come on top, a branch forking below the checkpoint does not
+        node.new_block()
+        self.assertEqual(len(node.chain), len(self.blockchain.chain) + 1)
+        self.assertFalse(node.forkchoice.within_reach(7))
+
+    def test_stopped_node_resumes_from_its_checkpoint(self):
+        import os
+        import tempfile
+        from checkpoint import History
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+
+        # the history check never gets to run, as if the node was stopped right after the bootstrap
+        start = History.start
+        History.start = lambda history: history
+        try:
+            node = BlockChain({self.address}, store=BlockStore(directory.name))
+            self.assertIsNone(node.store)
+            self.assertEqual(node.chain_head(), self.blockchain.chain_head())
+            node.checkpoints.history.store.close()
+            node.chain.blocks.close()
+
+            restarted = BlockChain(set(), store=BlockStore(directory.name))
+        finally:
+            History.start = start
+        self.assertEqual(restarted.chain_head(), self.blockchain.chain_head())
+        self.assertEqual(restarted.admin, self.blockchain.admin)
+        self.assertEqual(restarted.forkchoice.final, 8)
+
+        restarted.nodes.add(self.address)
+        restarted.checkpoints.history.start().thread.join(30)
+        self.assertEqual(restarted.checkpoints.history.status, 'complete')
+        self.assertIsInstance(restarted.chain, BlockStore)
+        self.assertEqual(restarted.full_chain(), self.blockchain.full_chain())
+        self.assertFalse(os.path.exists(os.path.join(directory.name, 'partial')))
+
+    def test_replica_follows_its_writer_through_a_bootstrap(self):
+        import os
+        import tempfile
+        from checkpoint import History
+        from replica import Replica
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+
+        writer = BlockChain(set(), store=BlockStore(directory.name),
+                            admin_key_file=os.path.join(directory.name, 'admin.pem'))
+        replica = Replica(directory.name, 'localhost:1', columnar=True)
+        replica.start()
+        self.assertEqual(replica.chain_head(), writer.chain_head())
+
+        # the writer starts over from the checkpoint, the history check waits until we let it run
+        start = History.start
+        History.start = lambda history: history
+        try:
+            writer.register_node(f'http://{self.address}')
+            self.assertTrue(writer.resolve_conflicts())
+            # a replica started meanwhile follows the partial store right away
+            late = Replica(directory.name, 'localhost:1', wait=0, columnar=True)
+        finally:
+            History.start = start
+        for follower in (replica, late):
+            follower.refresh()
+            self.assertEqual(follower.chain_head(), self.blockchain.chain_head())
+            self.assertEqual(follower.candidate_votes(), self.blockchain.candidate_votes())
+            self.assertEqual(follower.first_held, 7)
+            self.assertFalse(os.path.exists(os.path.join(directory.name, 'partial', 'checkpoint.json')))
+        self.assertTrue(replica.thread.is_alive())
+
+        writer.checkpoints.history.start().thread.join(30)
+        self.assertEqual(writer.checkpoints.history.status, 'complete')
+        for follower in (replica, late):
+            follower.refresh()
+            self.assertEqual(follower.full_chain(), self.blockchain.full_chain())
+            self.assertEqual(follower.stats()['tallies'], self.blockchain.stats()['tallies'])
+        self.assertTrue(replica.thread.is_alive())
+
+    def test_forged_checkpoint_is_refused(self):
+        self.blockchain.checkpoints.use(dict(self.blockchain.checkpoints.latest, height=9))
+        node = BlockChain({self.address}, bootstrap=False)
+        self.assertIsNone(node.checkpoints.history)
+        node.checkpoints.enabled = True
+        self.assertEqual(node.checkpoints.bootstrap(self.address, len(self.blockchain.chain)), False)
+        self.assertEqual(node.checkpoints.bootstraps.value(outcome='signature'), 1)
+
+
+class TestColumnarStats(ElectionTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.blockchain = BlockChain(set(), columnar=True)
+        with open("private.pem", "r") as f:
+            self.admin_key = RSA.importKey(f.read())
+        self.candidates = [self.add_candidate(name) for name in ('First', 'Second')]
+        self.voters = [self.blockchain.new_voter() for _ in range(3)]
+        self.start()
+
+    def cast(self, voter, candidate_wallet):
+        private_key, _, wallet = voter
+        self.blockchain.new_transaction(self.vote(private_key, wallet, candidate_wallet))
+
+    def test_stats_follow_the_chain(self):
+        self.cast(self.voters[0], self.candidates[0])
+        self.cast(self.voters[1], self.candidates[1])
+        self.cast(self.voters[2], self.candidates[1])
+        stats = self.blockchain.stats(window=60)
+
+        self.assertEqual([tally['votes'] for tally in stats['tallies']], [1, 2])
+        self.assertEqual([tally['votes'] for tally in stats['tallies']],
+                         [result['votes'] for result in self.blockchain.candidate_votes()])
+        self.assertEqual((stats['height'], stats['voters'], stats['votes'], stats['turnout']),
+                         (len(self.blockchain.chain), 3, 3, 1.0))
+        self.assertEqual(stats['turnout_by_block'][-1]['cumulative'], 3)
+        self.assertEqual(sum(window['votes'] for window in stats['turnout_by_window']), 3)
+        self.assertEqual(set(stats['audit'].values()), {0})
+
+        # a reverted block takes its votes out of the columns
+        self.blockchain.registry.revert_block(self.blockchain.chain.pop())
+        stats = self.blockchain.stats()
+        self.assertEqual([tally['votes'] for tally in stats['tallies']], [1, 1])
+        self.assertEqual(stats['audit']['voters_without_vote'], 1)
+
+    def test_endpoint(self):
+        import main
+        self.cast(self.voters[0], self.candidates[0])
+        main.blockchain = self.blockchain
+        client = app.test_client()
+        response = client.get('/stats?window=1')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json()['votes'], 1)
+        self.assertEqual(client.get('/stats?window=0').status_code, 400)
+
+        main.blockchain = BlockChain(set())
+        self.assertEqual(client.get('/stats').status_code, 404)
+
+    @unittest.skipIf(columnar.numpy is None, 'numpy is not installed')
+    def test_numpy_and_array_columns_agree(self):
+        def blocks():
+            # enough voters and votes for the columns to grow, with a double vote, a vote from an
+            # unknown wallet, one before its voter was enrolled and one for an unknown candidate
+            yield {'timestamp': 1000.0, 'voters': [{'wallet_address': f'voter {n}'} for n in range(100)],
+                   'candidates': [{'wallet_address': 'first'}, {'wallet_address': 'second'}], 'transactions': []}
+            for number in range(10):
+                yield {'timestamp': 1000.0 + 7 * number, 'voters': [], 'candidates': [], 'transactions': [
+                    {'sender': f'voter {n}', 'receiver': ('first', 'second')[n % 3 == 0]}
+                    for n in range(10 * number, 10 * number + 8)]}
+            yield {'timestamp': 1100.0, 'voters': [], 'candidates': [], 'transactions': [
+                {'sender': 'voter 0', 'receiver': 'first'}, {'sender': 'stranger', 'receiver': 'second'},
+                {'sender': 'voter 98', 'receiver': 'nobody'}, {'sender': 'late', 'receiver': 'first'}]}
+            yield {'timestamp': 1200.0, 'voters': [{'wallet_address': 'late'}], 'candidates': [], 'transactions': []}
+
+        def stats(state):
+            for block in blocks():
+                state.apply_block(block)
+            before = state.stats(window=30)
+            state.revert_block(None)
+            return before, state.stats(window=30)
+
+        with_numpy = stats(columnar.ColumnarState())
+        numpy, columnar.numpy = columnar.numpy, None
+        try:
+            with_array = stats(columnar.ColumnarState())
+        finally:
+            columnar.numpy = numpy
+
+        for result in with_numpy + with_array:
+            del result['memory_bytes']
+        self.assertEqual([result.pop('engine') for result in with_numpy], ['numpy'] * 2)
+        self.assertEqual([result.pop('engine') for result in with_array], ['array'] * 2)
+        self.assertEqual(with_numpy, with_array)
+        self.assertEqual(with_numpy[0]['audit'], {
+            'votes_from_unknown_voters': 1, 'votes_before_enrollment': 1, 'votes_for_unknown_candidates': 1,
+            'double_votes': 1, 'voters_without_vote': 19})
+
+
+class TestReplica(ServedNodeMixin, ElectionTestCase):
+    """ A worker replica following a writer that keeps its chain in a block store """
+
+    def setUp(self):
+        import main
+        import tempfile
+        from replica import Replica
+
+        self.directory = tempfile.TemporaryDirectory()
+        self.blockchain = BlockChain(set(), store=BlockStore(self.directory.name))
+        with open("private.pem", "r") as f:
+            self.admin_key = RSA.importKey(f.read())
+        self.candidate_wallet = self.add_candidate('First')
+        self.voters = [self.blockchain.new_voter() for _ in range(2)]
+
+        main.writer_token = 'secret'
+        self.replica = Replica(self.directory.name, self.serve(self.blockchain), 'secret')
+
+    def tearDown(self):
+        import main
+        main.writer_token = None
+        # stop serving before the stores close under it
+        self.server.shutdown()
+        self.blockchain.ingest.stop()
+        self.replica.store.close()
+        self.blockchain.store.close()
+        self.directory.cleanup()
+
+    def test_replica_follows_the_writer(self):
+        self.assertEqual(self.replica.chain_head(), self.blockchain.chain_head())
+        self.assertFalse(self.replica.refresh())
+
+        self.start()
+        self.assertTrue(self.replica.refresh())
+        self.assertTrue(self.replica.started_voting)
+        self.assertEqual(self.replica.chain_head(), self.blockchain.chain_head())
+        self.assertEqual(self.replica.get_all_voters(), self.blockchain.get_all_voters())
+        with self.assertRaises(RuntimeError):
+            self.replica.new_block()
+
+    def test_replica_starts_over_when_the_writer_replaces_blocks(self):
+        height = len(self.blockchain.chain)
+        self.blockchain.new_block()
+        self.replica.refresh()
+
+        with self.blockchain.lock:
+            self.blockchain.registry.revert_block(self.blockchain.last_block)
+            del self.blockchain.chain[height:]
+            self.blockchain.new_block()
+        self.assertEqual(len(self.replica.chain), height + 1)
+        self.assertTrue(self.replica.refresh())
+        self.assertEqual(self.replica.chain_head(), self.blockchain.chain_head())
+
+    def test_votes_are_verified_in_the_worker(self):
+        self.start()
+        self.replica.refresh()
+        (key, _, wallet), (other_key, _, other_wallet) = self.voters
+        results = self.replica.new_transactions([
+            Transaction(wallet, self.candidate_wallet, Transaction(wallet, self.candidate_wallet).sign(key)),
+            Transaction(other_wallet, self.candidate_wallet, Transaction(other_wallet, self.candidate_wallet).sign(key)),
+        ])
+        self.assertEqual(results, [(True, None), (False, "The signature is not valid")])
+        self.assertEqual(len(self.blockchain.get_all_transactions()), 1)
+        # the writer trusted the worker and parsed no key itself
+        self.assertEqual(len(self.blockchain.verifier.keys), 0)
+
+    def test_ticket_comes_from_the_writer(self):
+        import time
+        self.start()
+        self.replica.refresh()
+        key, _, wallet = self.voters[0]
+        ticket, message = self.replica.ingest.submit(
+            Transaction(wallet, self.candidate_wallet, Transaction(wallet, self.candidate_wallet).sign(key)))
+        self.assertIsNone(message)
+        for _ in range(100):
+            if self.replica.ingest.status(ticket.id)['status'] == 'committed':
+                break
+            time.sleep(0.05)
+        self.assertTrue(self.replica.refresh())
+        self.assertEqual(self.replica.candidate_votes()[0]['votes'], 1)
+        self.assertIsNone(self.replica.ingest.status('unknown'))
+        # the ticket ids are not part of the metric labels
+        text = self.replica.metrics.render()
+        self.assertIn('path="/transaction/status/<ticket>"', text)
+        self.assertNotIn(ticket.id, text)
+
+
+class TestVotingClient(ServedNodeMixin, ElectionTestCase):
+    """ Drives a node served over http on a random local port through the client library """
+
+    def setUp(self):
+        super().setUp()
+        self.node = self.serve(self.blockchain)
+        self.client = client.VotingClient([self.node], concurrency=4)
+
+        self.candidate_wallet = self.client.add_candidate('First', 'private.pem')
+        self.voters = list(self.client.new_voters(3))
+        self.client.start_voting('private.pem')
+
+    def tearDown(self):
+        self.client.close()
+
+    def votes(self):
+        return [client.sign_vote(key, wallet, self.candidate_wallet) for key, wallet in self.voters]
+
+    def test_offline_signed_votes_are_committed(self):
+        votes = self.votes()
+        outcomes = self.client.wait(self.client.submit_many(votes + votes[:1]), timeout=10)
+
+        self.assertEqual(sorted(outcome.status for outcome in outcomes), ['committed'] * 3 + ['rejected'])
+        self.assertEqual(self.client.results()[0]['votes'], 3)
+        summary = client.summarize(outcomes, 1.0)
+        self.assertEqual(summary['statuses'], {'committed': 3, 'rejected': 1})
+        self.assertLessEqual(summary['p50_ms'], summary['max_ms'])
+
+    def test_batches_move_on_from_unreachable_nodes(self):
+        self.client.close()
+        self.client = client.VotingClient(['localhost:1', self.node], retries=1, backoff=0)
+        outcomes = self.client.submit_many(self.votes(), batch_size=2)
+
+        self.assertEqual([outcome.status for outcome in outcomes], [client.ACCEPTED] * 3)
+        self.assertEqual([outcome.attempts for outcome in outcomes], [2, 2, 1])
+        self.assertEqual(len(self.blockchain.get_all_transactions()), 3)
+
+    def test_no_setup_votes_with_the_saved_voters(self):
+        import os
+        import tempfile
+
+        path = os.path.join(tempfile.mkdtemp(), 'voters.ndjson')
+        client.save_voters(path, self.voters)
+        output = path + '.json'
+        client.run(['--nodes', self.node, '--voters', '2', '--no-setup', '--voters-file', path,
+                    '--wait', '10', '--output', output])
+
+        with open(output) as f:
+            self.assertEqual(json.load(f)['statuses'], {'committed': 2})
+        self.assertEqual(self.client.results()[0]['votes'], 2)
+        with self.assertRaises(SystemExit):
+            client.parse_args(['--no-setup'])
+
+
+class TestCluster(unittest.TestCase):
+
+    def test_topologies(self):
+        self.assertEqual(cluster.ring(4)[0], {1, 3})
+        self.assertEqual(cluster.line(3), {0: {1}, 1: {0, 2}, 2: {1}})
+        self.assertEqual(cluster.star(3), {0: {1, 2}, 1: {0}, 2: {0}})
+        self.assertEqual(cluster.start_order(cluster.line(4)), [0, 1, 2, 3])
+
+    def test_election_on_in_process_nodes(self):
+        import main
+        before = main.blockchain
+        with cluster.Cluster(3, topology='line', latency=0.005, block_size=2, sync_interval=0.2) as nodes:
+            report = nodes.election(voters=4, candidates=2, wait=30)
+
+        self.assertIs(main.blockchain, before)
+        self.assertTrue(report['converged'])
+        self.assertEqual(report['votes']['statuses'], {'committed': 4})
+        self.assertEqual(len({node['height'] for node in report['nodes'].values()}), 1)
+        self.assertGreater(report['nodes']['node2']['sync_bytes'], 0)
+
+    def test_crashed_in_process_node_stops_working(self):
+        with cluster.Cluster(2, sync_interval=0) as nodes:
+            node = nodes.nodes[1]
+            node.crash()
+            blockchain = node.blockchain
+            self.assertIsNone(blockchain.ingest.thread)
+            self.assertIsNone(blockchain.producer.timer)
+            # nothing is pushed to the peers while the node is down
+            with self.assertRaises(RuntimeError):
+                blockchain.gossip.publish(blockchain.last_block)
+            self.assertEqual(nodes.session.get(f'http://{node.address}/chain/head').status_code, 503)
+
+            node.restart()
+            self.assertEqual(nodes.get(node, '/chain/head').json(), nodes.get(nodes.nodes[0], '/chain/head').json())
+            blockchain.gossip.publish(blockchain.last_block)
+
+
+class TestBenchmark(unittest.TestCase):
+
+    def test_small_run_covers_every_scenario(self):
+        results = bench.Benchmark(voters=4, candidates=2, nodes=2, block_size=2, key_bits=1024,
+                                  tally_queries=5, store=True).run()
+        self.assertEqual(set(results['scenarios']), set(bench.SCENARIOS))
+        self.assertEqual(results['scenarios']['ingestion']['count'], 4)
+        self.assertEqual(results['scenarios']['tally']['count'], 5)
+        self.assertGreater(results['scenarios']['sync']['bytes_per_node'], 0)
+        for figures in results['scenarios'].values():
+            self.assertLessEqual(figures['p50_ms'], figures['p99_ms'])
+            self.assertGreater(figures['peak_memory_bytes'], 0)
+
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(bench.percentile(values, 0.5), 50)
+        self.assertEqual(bench.percentile(values, 0.99), 99)
+        self.assertEqual(bench.percentile([7], 0.95), 7)
+
+    def test_compare_flags_regressions_only(self):
+        baseline = {'scenarios': {'tally': {'p95_ms': 2.0, 'throughput': 500.0, 'peak_memory_bytes': 1000}}}
+        current = {'scenarios': {'tally': {'p95_ms': 3.0, 'throughput': 520.0, 'peak_memory_bytes': 1050},
+                                 'sync': {'p95_ms': 40.0}}}
+        self.assertEqual(bench.compare(baseline, current, 0.1), [('tally', 'p95_ms', 2.0, 3.0)])
+
+        current['scenarios']['tally']['throughput'] = 400.0
+        self.assertIn(('tally', 'throughput', 500.0, 400.0), bench.compare(baseline, current, 0.1))
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -43,8 +43,8 @@ class Transaction:
         new_transaction_data = transaction_data.copy()
         new_transaction_data["receiver"] = str(transaction_data["receiver"])
         new_transaction_data["sender"] = str(transaction_data["sender"])
-        print(json.dumps(new_transaction_data).replace(" ", ""))
-        return json.dumps(new_transaction_data).replace(" ", "").encode('utf-8')
+        # compact separators give the same bytes the old json.dumps(...).replace(" ", "") did for addresses
+        return json.dumps(new_transaction_data, separators=(',', ':')).encode('utf-8')
 
     @staticmethod
     def sign_data(data, private_key):
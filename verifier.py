@@ -0,0 +1,90 @@
+import multiprocessing
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+from Crypto.Hash import SHA256
+from Crypto.PublicKey import RSA
+from Crypto.Signature import pkcs1_15
+
+# parsed keys inside a worker process, keyed by the PEM they came from
+_worker_keys = {}
+
+
+def verify_in_worker(public_key, signature, data):
+    key = _worker_keys.get(public_key)
+    if key is None:
+        key = _worker_keys[public_key] = RSA.import_key(public_key)
+    try:
+        pkcs1_15.new(key).verify(SHA256.new(data), signature)
+    except (ValueError, TypeError):
+        return False
+    return True
+
+
+class SignatureVerifier(object):
+    """ Checks vote signatures, caching parsed public keys and spreading bursts over a process pool """
+
+    def __init__(self, processes=None, parallel_threshold=32, cache_size=100000):
+        # batches smaller than this are verified inline, the pool round trip is not worth it
+        self.parallel_threshold = parallel_threshold
+        self.processes = processes
+        self.cache_size = cache_size
+        # PEM -> parsed RSA key, least recently used first. keyed by the PEM as in the workers, a
+        # transaction can pair any wallet address with any key
+        self.keys = OrderedDict()
+        # flask serves requests on several threads
+        self.lock = threading.Lock()
+        self.pool = None
+
+    def key(self, public_key):
+        with self.lock:
+            key = self.keys.get(public_key)
+            if key is not None:
+                self.keys.move_to_end(public_key)
+                return key
+        # parsed outside the lock, it is the slow part
+        key = RSA.import_key(public_key)
+        with self.lock:
+            self.keys[public_key] = key
+            if len(self.keys) > self.cache_size:
+                self.keys.popitem(last=False)
+        return key
+
+    def verify(self, public_key, signature: bytes, data: bytes):
+        # raises ValueError when the signature does not match, like pkcs1_15 does
+        pkcs1_15.new(self.key(public_key)).verify(SHA256.new(data), signature)
+
+    def verify_batch(self, items):
+        # items are (public_key, signature, data) tuples.
+        # returns one bool per item, in the same order
+        if len(items) < self.parallel_threshold or self.processes == 0:
+            return [self.check(*item) for item in items]
+
+        pool = self.get_pool()
+        chunksize = max(1, len(items) // (4 * (self.processes or os.cpu_count() or 1)))
+        return list(pool.map(verify_in_worker,
+                             [public_key for public_key, _, _ in items],
+                             [signature for _, signature, _ in items],
+                             [data for _, _, data in items],
+                             chunksize=chunksize))
+
+    def check(self, public_key, signature, data):
+        try:
+            self.verify(public_key, signature, data)
+        except (ValueError, TypeError):
+            return False
+        return True
+
+    def get_pool(self):
+        if self.pool is None:
+            # spawned workers do not inherit the locks and threads of the flask process
+            self.pool = ProcessPoolExecutor(max_workers=self.processes,
+                                            mp_context=multiprocessing.get_context('spawn'))
+        return self.pool
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
@@ -0,0 +1,61 @@
+# serves a node from several worker processes under a pre-fork WSGI server. the node itself runs as
+# usual with its chain on disk and becomes the single writer, the workers follow its block store and
+# answer the reads themselves:
+#
+#   WRITER_TOKEN=secret DATA_DIR=data python main.py 5000
+#   WRITER=localhost:5000 WRITER_TOKEN=secret DATA_DIR=data/5000 gunicorn -w 8 -b 0.0.0.0:8000 wsgi:app
+#
+# votes are checked in the worker, signature included, and queued on the writer with the shared token
+# so it does not verify them again. every other write is passed on to the writer as it is.
+import os
+
+from flask import Response, request
+
+import main
+from replica import Replica
+
+app = main.app
+
+# endpoints the workers answer by passing the request on to the writer
+FORWARDED = {
+    'new_candidate',
+    'new_voter',
+    'new_voters',
+    'key_pool',
+    'start_vote',
+    'end_vote',
+    'register_nodes',
+    'consensus',
+    'receive_block',
+    'checkpoint',
+    'checkpoint_history',
+}
+# hop-by-hop headers and the ones the body is sent with again
+DROPPED_HEADERS = {'connection', 'content-length', 'content-encoding', 'transfer-encoding', 'keep-alive', 'host'}
+
+# the replica of the current process, made on its first request so nothing is shared over the fork
+replica_pid = None
+
+
+@app.before_request
+def serve_from_replica():
+    global replica_pid
+    if replica_pid != os.getpid():
+        replica_pid = os.getpid()
+        main.blockchain = Replica(os.environ['DATA_DIR'], os.environ['WRITER'], os.environ.get('WRITER_TOKEN'),
+                                  columnar=bool(os.environ.get('COLUMNAR')))
+        main.blockchain.start()
+
+    if request.endpoint in FORWARDED:
+        return forward()
+    return None
+
+
+def forward():
+    headers = {key: value for key, value in request.headers.items() if key.lower() not in DROPPED_HEADERS}
+    path = request.full_path if request.query_string else request.path
+    upstream = main.blockchain.forward(request.method, path, route=request.url_rule.rule, data=request.get_data(),
+                                       headers=headers, stream=True)
+    return Response(upstream.iter_content(chunk_size=None), status=upstream.status_code,
+                    headers=[(key, value) for key, value in upstream.headers.items()
+                             if key.lower() not in DROPPED_HEADERS])